@@ -0,0 +1,104 @@
+"""Column-oriented audit tables.
+
+The flow builders produce the conversion, balance and stage audits as one
+``AuditTable`` each. Rows are appended a block at a time (one block per
+transition or stage), every field a NumPy column or a scalar repeated over the
+block, so no per-row dict is built. ``pipeline`` writes the CSVs straight from
+the columns and checks the residual columns with array operations.
+
+Indexing or iterating a table still yields ``{column: value}`` dicts with
+plain Python values, for tests and callers that read individual rows.
+"""
+from __future__ import annotations
+
+from collections.abc import Iterator, Mapping
+from typing import Any, Sequence
+
+import numpy as np
+import pandas as pd
+
+
+def _column(value: Any, count: int) -> Any:
+    if isinstance(value, np.ndarray):
+        if len(value) != count:
+            raise ValueError(f"Audit column has {len(value)} values for {count} rows.")
+        return value
+    if isinstance(value, str):
+        return np.full(count, value, dtype=object)
+    return np.full(count, value)
+
+
+class AuditTable:
+    """Aligned audit columns, in the order of the first appended block."""
+
+    def __init__(self) -> None:
+        self.names: tuple[str, ...] = ()
+        self._blocks: list[dict[str, Any]] = []
+        self._length = 0
+        self._columns: dict[str, Any] | None = None
+        self._lists: dict[str, list[Any]] | None = None
+
+    def append(self, count: int, values: Mapping[str, Any]) -> None:
+        """Add ``count`` rows; each value is a column of that length or a scalar."""
+        if count <= 0:
+            return
+        if not self.names:
+            self.names = tuple(values)
+        elif set(values) != set(self.names):
+            raise ValueError("Audit blocks must have the same columns.")
+        self._blocks.append({name: _column(values[name], count) for name in self.names})
+        self._length += count
+        self._columns = None
+        self._lists = None
+
+    def __len__(self) -> int:
+        return self._length
+
+    @property
+    def columns(self) -> dict[str, Any]:
+        if self._columns is None:
+            self._columns = {
+                name: self._blocks[0][name] if len(self._blocks) == 1
+                else np.concatenate([block[name] for block in self._blocks])
+                for name in self.names
+            }
+        return self._columns
+
+    def column(self, name: str) -> Any:
+        """One column as an array; an empty table has empty float columns."""
+        if not self._length:
+            return np.zeros(0)
+        return self.columns[name]
+
+    def _row_lists(self) -> dict[str, list[Any]]:
+        if self._lists is None:
+            self._lists = {name: values.tolist() for name, values in self.columns.items()}
+        return self._lists
+
+    def __getitem__(self, position: int) -> dict[str, Any]:
+        if not -self._length <= position < self._length:
+            raise IndexError(position)
+        lists = self._row_lists()
+        return {name: lists[name][position] for name in self.names}
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        lists = self._row_lists()
+        for position in range(self._length):
+            yield {name: lists[name][position] for name in self.names}
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, AuditTable):
+            return NotImplemented
+        return self.names == other.names and list(self) == list(other)
+
+    __hash__ = None  # type: ignore[assignment]
+
+    def to_frame(self, columns: Sequence[str]) -> pd.DataFrame:
+        """DataFrame with ``columns`` in order; columns the table lacks are NaN."""
+        if not self._length:
+            return pd.DataFrame(columns=list(columns))
+        data = self.columns
+        return pd.DataFrame(
+            {name: data[name] if name in data else np.full(self._length, np.nan) for name in columns},
+            columns=list(columns),
+        )
@@ -183,6 +183,34 @@ PRODUCTION_SHEETS = "all"
 TRADE_ROOT = DATA_ROOT
 REFERENCE_FILE = DATA_ROOT / "reference" / "ListOfreference.xlsx"
 
+# Raw partner CSV files parsed concurrently for HS codes that have no compiled
+# partition (see trade_store.py). Output order does not depend on this value.
+TRADE_READ_WORKERS = 4
+
+# Per-country balance of each production-basis transition: "scalar" walks the
+# trade rows country by country, "sparse" uses exporter x importer matrices and
+# matrix-vector products (see material_balance.py). Results are identical.
+BALANCE_ENGINE = "scalar"
+
+# Monte Carlo uncertainty (production-basis runs only). With MONTE_CARLO_DRAWS
+# above zero, each run also draws the distributions below, evaluates every draw
+# in one batched pass and writes per-node and per-link percentile bands to
+# _uncertainty_bands.csv. Distributions: ("uniform", low, high),
+# ("triangular", low, mode, high), ("normal", mean, sd), ("lognormal", median, sigma).
+MONTE_CARLO_DRAWS = 0
+MONTE_CARLO_SEED = 2024
+# HS code -> factor distribution, e.g. {"282520": ("triangular", 0.15, 0.19, 0.22)}.
+FACTOR_DISTRIBUTIONS = {}
+# Stage -> relative production multiplier drawn per country, e.g.
+# {"refining": ("normal", 1.0, 0.1)} for SCInsight status-mix uncertainty.
+PRODUCTION_DISTRIBUTIONS = {}
+MONTE_CARLO_PERCENTILES = (5, 50, 95)
+# Adds each node's outer percentile band to its hover text. Bands are computed
+# per country, so only country-level nodes are annotated; the chemistry-split
+# cathode and battery nodes of the chemistry_only and country_chemistry views
+# are not.
+MONTE_CARLO_HOVER = False
+
 # Each run creates a new timestamped folder here. Every output filename contains
 # metal, year, canonical route, and the active stage/source selection.
 OUTPUT_ROOT = Path(__file__).resolve().parent / "outputs"
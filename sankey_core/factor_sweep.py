@@ -0,0 +1,502 @@
+"""Batched production-basis flows over many conversion-factor settings.
+
+Before the production cap, every trade row is linear in its HS code's
+conversion factor. The cap ``min(1, available / exporter_total)``, the domestic
+remainder, the unknown-source gap and the unknown-destination surplus are all
+element-wise minimums and maximums. A set of factor settings ("points") can
+therefore be evaluated at once as ``points x rows`` and ``points x countries``
+arrays over the loaded trade tables, with no graph, audit rows or output
+files per point.
+
+``build_flow_model`` prepares that computation once per run: classification,
+chemistry-weighted factors, row and country positions, and the Sankey links
+each row and country feeds. ``FlowModel.evaluate`` then returns the link
+values of every point, and ``sweep_conversion_factors`` evaluates a grid of HS
+factor values.
+
+Flows are evaluated at country level, as with ``NODE_VIEW = "country"``, and
+node keys are the keys ``build_flow_graph`` gives those nodes. Rows whose
+factor comes from ``CHEMISTRY_CONVERSION_FACTORS`` keep their weighted factor at
+every point. Production membership and trade classification are those of the
+loaded production totals.
+"""
+from __future__ import annotations
+
+from collections.abc import Mapping, Sequence
+from dataclasses import dataclass, replace
+from typing import Any
+
+import numpy as np
+import pandas as pd
+
+from flow_builder import ChemistryTables, _apply_chemistry_weighted_factors, _classify
+from material_balance import _clipped
+from models import EPSILON, ProductionData, RouteSpec, RunInputs, Settings, TransitionSpec
+from production_arrays import CountryIndex
+from trade_table import (
+    NON_SOURCE_TO_NON_TARGET,
+    NON_SOURCE_TO_PRODUCER,
+    PRODUCER_TO_NON_TARGET,
+    PRODUCER_TO_PRODUCER,
+    TradeTable,
+)
+
+
+# Upper bound on points x trade rows held in memory by one evaluation chunk.
+SWEEP_CELL_BUDGET = 4_000_000
+
+
+def _point_bincount(positions: Any, weights: Any, size: int) -> Any:
+    """``np.bincount`` of each row of ``weights`` (points x n) into ``size`` bins."""
+    points = weights.shape[0]
+    offsets = (np.arange(points, dtype=np.int64) * size)[:, None]
+    counts = np.bincount((offsets + positions).ravel(), weights=weights.ravel(), minlength=points * size)
+    # Empty input gives integer counts.
+    return counts.astype(float, copy=False).reshape(points, size)
+
+
+class _LinkIndex:
+    """Node keys and (source, target) links in first-seen order."""
+
+    def __init__(self) -> None:
+        self.nodes: dict[str, int] = {}
+        self.links: dict[tuple[int, int], int] = {}
+
+    def node(self, key: str) -> int:
+        return self.nodes.setdefault(key, len(self.nodes))
+
+    def link(self, source: str, target: str) -> int:
+        return self.links.setdefault((self.node(source), self.node(target)), len(self.links))
+
+    def country_links(self, source: Any, target: Any, country_ids: Any) -> Any:
+        """One link per country id; ``source`` and ``target`` map an id to a node key."""
+        return np.fromiter(
+            (self.link(source(country_id), target(country_id)) for country_id in country_ids.tolist()),
+            dtype=np.int64,
+            count=len(country_ids),
+        )
+
+
+@dataclass(frozen=True)
+class TransitionModel:
+    """One transition's trade rows and country links, ready for batched evaluation.
+
+    Row positions (``exporter``, ``importer``) and the per-country link arrays
+    index the model's route-wide ``CountryIndex``. ``parameter[i]`` is the
+    factor column of row ``i``; rows outside ``free`` keep ``base_factor``.
+    """
+
+    transition: TransitionSpec
+    source_stage: int
+    target_stage: int
+    raw: Any
+    base_factor: Any
+    parameter: Any
+    free: Any
+    exporter: Any
+    importer: Any
+    source_producer: Any
+    exported: Any
+    imported: Any
+    kept: Any
+    row_link: Any
+    domestic_countries: Any
+    domestic_link: Any
+    untraded_countries: Any
+    untraded_link: Any
+    target_countries: Any
+    gap_link: Any
+    excess_link: Any
+    output_link: Any
+
+    def __len__(self) -> int:
+        return int(len(self.raw))
+
+
+@dataclass(frozen=True)
+class TransitionFlows:
+    """Per-country flows of one transition for a chunk of points (points x countries)."""
+
+    final: Any
+    multiplier: Any
+    value: Any
+    domestic: Any
+    untraded: Any
+    gap: Any
+    surplus: Any
+
+
+@dataclass(frozen=True)
+class FlowBatch:
+    """Link values and unknown totals of a batch of points."""
+
+    links: Any
+    unknown_source: Any
+    unknown_destination: Any
+
+
+@dataclass(frozen=True)
+class FlowModel:
+    """A run's production-basis flows as arrays, evaluated for many points at once.
+
+    ``parameters[j]`` is the ``(transition, hs_code)`` of factor column ``j``
+    and ``base_factors[j]`` its configured value. ``stage_totals`` and
+    ``stage_members`` hold the loaded production per ``stages[i]`` over
+    ``countries``. Link ``k`` runs from node ``link_source[k]`` to
+    ``link_target[k]`` of ``node_keys``.
+    """
+
+    route: RouteSpec
+    countries: CountryIndex
+    stages: tuple[str, ...]
+    stage_totals: Any
+    stage_members: Any
+    parameters: tuple[tuple[str, str], ...]
+    base_factors: Any
+    transitions: tuple[TransitionModel, ...]
+    node_keys: tuple[str, ...]
+    link_source: Any
+    link_target: Any
+
+    @property
+    def link_keys(self) -> tuple[tuple[str, str], ...]:
+        return tuple(
+            (self.node_keys[source], self.node_keys[target])
+            for source, target in zip(self.link_source.tolist(), self.link_target.tolist())
+        )
+
+    def parameter_columns(self, hs_code: str) -> Any:
+        """Factor columns of ``hs_code``, in every transition that loads it."""
+        code = str(hs_code).strip()
+        columns = [position for position, (_, parameter_code) in enumerate(self.parameters) if parameter_code == code]
+        if not columns:
+            raise ValueError(f"HS code {code!r} is not loaded by any transition of this run.")
+        return np.asarray(columns, dtype=np.intp)
+
+    def chunk_points(self) -> int:
+        rows = max([len(transition) for transition in self.transitions] + [1])
+        return max(1, SWEEP_CELL_BUDGET // rows)
+
+    def transition_flows(
+        self,
+        transition: TransitionModel,
+        factors: Any,
+        stage_totals: Any,
+    ) -> TransitionFlows:
+        """Flows of one transition for ``factors`` (points x parameters) and ``stage_totals`` (points x stages x countries)."""
+        size = len(self.countries)
+        source = stage_totals[:, transition.source_stage]
+        target = stage_totals[:, transition.target_stage]
+        source_members = self.stage_members[transition.source_stage]
+        target_members = self.stage_members[transition.target_stage]
+
+        factor = np.where(transition.free, factors[:, transition.parameter], transition.base_factor)
+        converted = transition.raw * factor
+        exporter_totals = _point_bincount(transition.exporter, converted, size)[:, transition.exporter]
+        available = source[:, transition.exporter]
+        capped = transition.source_producer & (exporter_totals > EPSILON)
+        ratio = np.divide(available, exporter_totals, out=np.ones_like(exporter_totals), where=capped)
+        multiplier = np.where(capped, np.minimum(1.0, ratio), 1.0)
+        final = transition.raw * (factor * multiplier)
+        value = np.where(transition.kept & (final > EPSILON), final, 0.0)
+
+        exports = _point_bincount(transition.exporter[transition.exported], value[:, transition.exported], size)
+        imports = _point_bincount(transition.importer[transition.imported], value[:, transition.imported], size)
+        remainder = _clipped(source - exports)
+        sending = source_members & (remainder > EPSILON)
+        domestic = np.where(sending & target_members, remainder, 0.0)
+        untraded = np.where(sending & ~target_members, remainder, 0.0)
+        known_input = imports + domestic
+        gap = _clipped(target - known_input)
+        surplus = _clipped(known_input - target)
+        return TransitionFlows(
+            final=final,
+            multiplier=multiplier,
+            value=value,
+            domestic=domestic,
+            untraded=untraded,
+            gap=np.where(target_members & (gap > EPSILON), gap, 0.0),
+            surplus=np.where(target_members & (surplus > EPSILON), surplus, 0.0),
+        )
+
+    def _evaluate_chunk(self, factors: Any, stage_totals: Any) -> FlowBatch:
+        points = factors.shape[0]
+        links = np.zeros((points, len(self.link_source)))
+        unknown_source = np.zeros((points, len(self.transitions)))
+        unknown_destination = np.zeros((points, len(self.transitions)))
+        for position, transition in enumerate(self.transitions):
+            flows = self.transition_flows(transition, factors, stage_totals)
+            links += _point_bincount(transition.row_link, flows.value[:, transition.kept], len(self.link_source))
+            links[:, transition.domestic_link] += flows.domestic[:, transition.domestic_countries]
+            links[:, transition.untraded_link] += flows.untraded[:, transition.untraded_countries]
+            target = stage_totals[:, transition.target_stage][:, transition.target_countries]
+            links[:, transition.output_link] += np.where(target > EPSILON, target, 0.0)
+            links[:, transition.gap_link] += flows.gap[:, transition.target_countries]
+            links[:, transition.excess_link] += flows.surplus[:, transition.target_countries]
+            unknown_source[:, position] = flows.gap.sum(axis=1)
+            unknown_destination[:, position] = flows.surplus.sum(axis=1)
+        return FlowBatch(links=links, unknown_source=unknown_source, unknown_destination=unknown_destination)
+
+    def evaluate(self, factors: Any, stage_totals: Any | None = None) -> FlowBatch:
+        """Link values and unknown totals for every point.
+
+        ``factors`` is points x parameters. ``stage_totals`` is points x stages
+        x countries, or ``None`` for the loaded production at every point.
+        Points are evaluated in chunks of at most ``SWEEP_CELL_BUDGET`` cells.
+        """
+        factors = np.atleast_2d(np.asarray(factors, dtype=float))
+        points = factors.shape[0]
+        if factors.shape[1] != len(self.parameters):
+            raise ValueError(f"Expected {len(self.parameters)} factor columns, got {factors.shape[1]}.")
+        chunk = self.chunk_points()
+        batches = []
+        for start in range(0, points, chunk):
+            stop = min(start + chunk, points)
+            totals = (
+                np.broadcast_to(self.stage_totals, (stop - start, *self.stage_totals.shape))
+                if stage_totals is None else stage_totals[start:stop]
+            )
+            batches.append(self._evaluate_chunk(factors[start:stop], totals))
+        if len(batches) == 1:
+            return batches[0]
+        return FlowBatch(
+            links=np.concatenate([batch.links for batch in batches]),
+            unknown_source=np.concatenate([batch.unknown_source for batch in batches]),
+            unknown_destination=np.concatenate([batch.unknown_destination for batch in batches]),
+        )
+
+    def node_sizes(self, links: Any) -> Any:
+        """Sankey node sizes (larger of inflow and outflow) for points x links values."""
+        size = len(self.node_keys)
+        return np.maximum(
+            _point_bincount(self.link_target, links, size),
+            _point_bincount(self.link_source, links, size),
+        )
+
+
+def _transition_model(
+    settings: Settings,
+    transition: TransitionSpec,
+    production: ProductionData,
+    chemistry_tables: ChemistryTables,
+    table: TradeTable,
+    countries: CountryIndex,
+    stages: tuple[str, ...],
+    stage_members: Any,
+    parameters: dict[tuple[str, str], int],
+    index: _LinkIndex,
+) -> TransitionModel:
+    # Work on copies of the builder-filled columns so the caller's table is untouched.
+    table = replace(
+        table,
+        manual_conversion_factor=table.manual_conversion_factor.copy(),
+        chemistry_factor_basis=table.chemistry_factor_basis.copy(),
+        chemistry_factor_detail=table.chemistry_factor_detail.copy(),
+    )
+    _apply_chemistry_weighted_factors(
+        table, transition.source_stage, transition.target_stage, settings, production, chemistry_tables
+    )
+    source_producer = _classify(
+        table, production.totals[transition.source_stage], production.totals[transition.target_stage]
+    )
+    codes = table.classification_code
+    hs_columns = np.fromiter(
+        (parameters.setdefault((transition.key, code), len(parameters)) for code in table.hs_codes),
+        dtype=np.intp,
+        count=len(table.hs_codes),
+    )
+    exporter = np.searchsorted(countries.ids, table.exporter_id)
+    importer = np.searchsorted(countries.ids, table.importer_id)
+    kept = codes != NON_SOURCE_TO_NON_TARGET
+
+    source_stage_key = f"P:{transition.source_stage}"
+    post_stage_key = f"T:{transition.key}"
+    target_stage_key = f"P:{transition.target_stage}"
+    non_target = f"{post_stage_key}:special:{transition.key}_non_target"
+    non_source = f"{source_stage_key}:special:{transition.key}_non_source"
+    unknown_source = f"{source_stage_key}:special:{transition.key}_unknown_source"
+    unknown_target = f"{target_stage_key}:special:{transition.key}_unknown_target"
+    # The graph creates every special node, linked or not.
+    for special in (non_target, non_source, unknown_source, unknown_target):
+        index.node(special)
+
+    def source_node(country_id: int) -> str:
+        return f"{source_stage_key}:country:{country_id}"
+
+    def post_node(country_id: int) -> str:
+        return f"{post_stage_key}:country:{country_id}"
+
+    def target_node(country_id: int) -> str:
+        return f"{target_stage_key}:country:{country_id}"
+
+    # One link per distinct (class, exporter, importer) of the kept rows.
+    row_keys = np.stack([codes[kept].astype(np.int64), table.exporter_id[kept], table.importer_id[kept]], axis=1)
+    distinct, row_position = np.unique(row_keys, axis=0, return_inverse=True)
+    endpoints = {
+        PRODUCER_TO_PRODUCER: lambda exporter_id, importer_id: (source_node(exporter_id), post_node(importer_id)),
+        PRODUCER_TO_NON_TARGET: lambda exporter_id, importer_id: (source_node(exporter_id), non_target),
+        NON_SOURCE_TO_PRODUCER: lambda exporter_id, importer_id: (non_source, post_node(importer_id)),
+    }
+    distinct_links = np.fromiter(
+        (index.link(*endpoints[code](exporter_id, importer_id)) for code, exporter_id, importer_id in distinct.tolist()),
+        dtype=np.int64,
+        count=len(distinct),
+    )
+
+    source_members = stage_members[stages.index(transition.source_stage)]
+    target_members = stage_members[stages.index(transition.target_stage)]
+    domestic_countries = np.flatnonzero(source_members & target_members)
+    untraded_countries = np.flatnonzero(source_members & ~target_members)
+    target_countries = np.flatnonzero(target_members)
+    domestic_link = index.country_links(source_node, post_node, countries.ids[domestic_countries])
+    untraded_link = index.country_links(source_node, lambda _: non_target, countries.ids[untraded_countries])
+    target_ids = countries.ids[target_countries]
+    gap_link = index.country_links(lambda _: unknown_source, post_node, target_ids)
+    output_link = index.country_links(post_node, target_node, target_ids)
+    excess_link = index.country_links(post_node, lambda _: unknown_target, target_ids)
+    return TransitionModel(
+        transition=transition,
+        source_stage=stages.index(transition.source_stage),
+        target_stage=stages.index(transition.target_stage),
+        raw=table.raw_quantity_tonnes,
+        base_factor=table.manual_conversion_factor,
+        parameter=hs_columns[table.hs_index] if len(table) else np.zeros(0, dtype=np.intp),
+        free=table.chemistry_factor_basis == "",
+        exporter=exporter,
+        importer=importer,
+        source_producer=source_producer,
+        exported=np.isin(codes, (PRODUCER_TO_PRODUCER, PRODUCER_TO_NON_TARGET)),
+        imported=np.isin(codes, (PRODUCER_TO_PRODUCER, NON_SOURCE_TO_PRODUCER)),
+        kept=kept,
+        row_link=distinct_links[row_position.reshape(-1)],
+        domestic_countries=domestic_countries,
+        domestic_link=domestic_link,
+        untraded_countries=untraded_countries,
+        untraded_link=untraded_link,
+        target_countries=target_countries,
+        gap_link=gap_link,
+        excess_link=excess_link,
+        output_link=output_link,
+    )
+
+
+def build_flow_model(
+    settings: Settings,
+    route: RouteSpec,
+    production: ProductionData,
+    trade_by_transition: Mapping[str, TradeTable],
+) -> FlowModel:
+    """Prepare the batched production-basis flows of one run."""
+    if not settings.use_production_data:
+        raise ValueError("Batched flow evaluation needs USE_PRODUCTION_DATA = True.")
+    empty = {transition.key: TradeTable.empty(transition.key) for transition in route.transitions}
+    tables = {key: trade_by_transition.get(key, table) for key, table in empty.items()}
+    country_ids = [country_id for mapping in production.totals.values() for country_id in mapping]
+    countries = CountryIndex.from_ids(
+        np.concatenate(
+            [np.asarray(country_ids, dtype=np.int64)]
+            + [np.union1d(table.exporter_id, table.importer_id) for table in tables.values()]
+        )
+    )
+    stages = tuple(stage.key for stage in route.production_stages)
+    stage_totals = np.zeros((len(stages), len(countries)))
+    stage_members = np.zeros((len(stages), len(countries)), dtype=bool)
+    for position, stage in enumerate(stages):
+        stage_totals[position], stage_members[position] = countries.vector(production.totals.get(stage, {}))
+
+    chemistry_tables = ChemistryTables(production)
+    parameters: dict[tuple[str, str], int] = {}
+    index = _LinkIndex()
+    transitions = tuple(
+        _transition_model(
+            settings, transition, production, chemistry_tables, tables[transition.key],
+            countries, stages, stage_members, parameters, index,
+        )
+        for transition in route.transitions
+    )
+    base_factors = np.zeros(len(parameters))
+    for (transition_key, hs_code), column in parameters.items():
+        table = tables[transition_key]
+        base_factors[column] = table.configured_conversion_factor[
+            np.flatnonzero(table.hs_index == table.hs_codes.index(hs_code))[0]
+        ]
+    links = np.asarray(list(index.links), dtype=np.int64).reshape(-1, 2)
+    return FlowModel(
+        route=route,
+        countries=countries,
+        stages=stages,
+        stage_totals=stage_totals,
+        stage_members=stage_members,
+        parameters=tuple(parameters),
+        base_factors=base_factors,
+        transitions=transitions,
+        node_keys=tuple(index.nodes),
+        link_source=links[:, 0],
+        link_target=links[:, 1],
+    )
+
+
+@dataclass(frozen=True)
+class ScenarioSweep:
+    """Node sizes and unknown totals at every point of a factor grid.
+
+    ``points[i]`` holds the ``hs_codes`` factor values of point ``i``; the
+    grid is their Cartesian product with the last HS code varying fastest.
+    ``node_sizes`` is points x ``node_keys``; ``unknown_source`` and
+    ``unknown_destination`` are points x ``transitions``.
+    """
+
+    hs_codes: tuple[str, ...]
+    points: Any
+    node_keys: tuple[str, ...]
+    node_sizes: Any
+    transitions: tuple[str, ...]
+    unknown_source: Any
+    unknown_destination: Any
+
+    def node_size(self, key: str) -> Any:
+        return self.node_sizes[:, self.node_keys.index(key)]
+
+    def frame(self) -> pd.DataFrame:
+        """One row per point: the factor values and the route's unknown totals."""
+        frame = pd.DataFrame(self.points, columns=list(self.hs_codes))
+        frame["unknown_source"] = self.unknown_source.sum(axis=1)
+        frame["unknown_destination"] = self.unknown_destination.sum(axis=1)
+        return frame
+
+
+def _grid_points(values: Sequence[Any]) -> Any:
+    if not values:
+        return np.zeros((1, 0))
+    axes = np.meshgrid(*values, indexing="ij")
+    return np.stack([axis.ravel() for axis in axes], axis=1)
+
+
+def sweep_conversion_factors(
+    settings: Settings,
+    inputs: RunInputs,
+    grid: Mapping[str, Sequence[float]],
+    model: FlowModel | None = None,
+) -> ScenarioSweep:
+    """Evaluate every combination of the ``{hs_code: factor values}`` grid in one batch.
+
+    HS codes missing from ``grid`` keep their configured factor. ``inputs``
+    comes from ``pipeline.load_run_inputs``; pass ``model`` to reuse one
+    prepared for the same inputs.
+    """
+    model = model or build_flow_model(settings, inputs.route, inputs.production, inputs.trade_by_transition)
+    hs_codes = tuple(str(code).strip() for code in grid)
+    points = _grid_points([np.asarray(values, dtype=float).ravel() for values in grid.values()])
+    factors = np.tile(model.base_factors, (len(points), 1))
+    for position, hs_code in enumerate(hs_codes):
+        factors[:, model.parameter_columns(hs_code)] = points[:, [position]]
+    batch = model.evaluate(factors)
+    return ScenarioSweep(
+        hs_codes=hs_codes,
+        points=points,
+        node_keys=model.node_keys,
+        node_sizes=model.node_sizes(batch.links),
+        transitions=tuple(transition.transition.key for transition in model.transitions),
+        unknown_source=batch.unknown_source,
+        unknown_destination=batch.unknown_destination,
+    )
@@ -1,8 +1,16 @@
 from __future__ import annotations
 
-from collections import defaultdict
-from typing import Any
+import hashlib
+import sys
+import threading
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass, fields, is_dataclass
+from typing import Any, Callable
 
+import numpy as np
+
+from audit_table import AuditTable
+from material_balance import transition_balance
 from models import (
     EPSILON,
     BuildResult,
@@ -11,11 +19,43 @@ from models import (
     ProductionData,
     ReferenceMaps,
     RouteSpec,
+    SankeyGraph,
     Settings,
     TradeRecord,
+    TransitionSpec,
+)
+from production_arrays import ProductionArrays, compact_production
+from sensitivity import NodeSensitivity, TransitionSensitivity, node_sensitivity, transition_sensitivity
+from trade_table import (
+    CAP_APPLIED,
+    CAP_NOT_BINDING,
+    IGNORED,
+    NON_SOURCE_EXPORTER,
+    NON_SOURCE_TO_NON_TARGET,
+    NON_SOURCE_TO_PRODUCER,
+    PRODUCER_TO_NON_TARGET,
+    PRODUCER_TO_PRODUCER,
+    TRADE_ONLY,
+    TradeTable,
+    as_trade_table,
+    sync_records,
 )
 
 
+SEGMENT_CACHE_MAX_BYTES = 128 * 1024 * 1024
+# The settings a production-basis segment reads; only these enter its cache
+# key, so display and output settings do not rebuild transitions. Add any
+# setting the segment code starts to read.
+SEGMENT_SETTINGS = (
+    "metal",
+    "year",
+    "cathode_view",
+    "chemistry_stage_scope",
+    "merge_lmfp_into_lfp",
+    "chemistry_conversion_factors",
+    "country_label_mode",
+    "balance_engine",
+)
 SPECIAL_COLOR = "#8b929a"
 CHEMISTRY_COLORS = {
     "NMC": "#1d4ed8",
@@ -45,6 +85,14 @@ def _slug(value: str) -> str:
 
 
 class GraphBuilder:
+    """Collects Sankey nodes by integer id and sums link values per (source, target).
+
+    ``ensure_*`` return the node id; ``nodes[id]`` is its ``NodeSpec``. The
+    link colour of every node is formatted once, when the node is created.
+    Between ``start_journal`` and ``stop_journal`` every node lookup and link
+    is recorded so ``replay`` can repeat it on a later graph.
+    """
+
     def __init__(
         self,
         reference: ReferenceMaps,
@@ -54,11 +102,28 @@ class GraphBuilder:
         self.reference = reference
         self.fallback_labels = fallback_labels
         self.country_label_mode = country_label_mode
-        self.nodes: dict[str, NodeSpec] = {}
-        self.links: list[LinkSpec] = []
+        self.nodes: list[NodeSpec] = []
+        self.link_colors: list[str] = []
+        self.link_values: dict[tuple[int, int], float] = {}
+        self.link_count = 0
+        self._node_ids: dict[tuple[Any, ...], int] = {}
+        self._lookups: list[tuple[Any, ...]] = []
+        self._journal: list[tuple[Any, ...]] | None = None
+        self._country_names: dict[int, str] = {}
 
     def country_name(self, country_id: int) -> str:
-        return self.reference.names.get(country_id, self.fallback_labels.get(country_id, f"Country {country_id}"))
+        name = self._country_names.get(country_id)
+        if name is None:
+            name = self.reference.names.get(country_id, self.fallback_labels.get(country_id, f"Country {country_id}"))
+            self._country_names[country_id] = name
+        return name
+
+    def country_names(self, country_ids: Any) -> Any:
+        """Names for a column of country ids, looked up once per distinct id."""
+        unique, inverse = np.unique(np.asarray(country_ids, dtype=np.int64), return_inverse=True)
+        names = np.empty(len(unique), dtype=object)
+        names[:] = [self.country_name(country_id) for country_id in unique.tolist()]
+        return names[inverse.reshape(-1)]
 
     def country_hover(self, country_id: int) -> str:
         name = self.country_name(country_id)
@@ -72,134 +137,218 @@ class GraphBuilder:
                 return iso3
         return self.country_name(country_id)
 
-    def ensure_country(self, stage: str, country_id: int) -> str:
-        key = f"{stage}:country:{country_id}"
-        if key not in self.nodes:
-            self.nodes[key] = NodeSpec(
-                key=key,
+    def _add_node(self, lookup: tuple[Any, ...], node: NodeSpec) -> int:
+        node_id = len(self.nodes)
+        self.nodes.append(node)
+        self.link_colors.append(_rgba(node.color))
+        self._node_ids[lookup] = node_id
+        self._lookups.append(lookup)
+        return node_id
+
+    def _resolve(self, lookup: tuple[Any, ...], node: Callable[[], NodeSpec]) -> int:
+        node_id = self._node_ids.get(lookup)
+        if node_id is None:
+            node_id = self._add_node(lookup, node())
+        if self._journal is not None:
+            self._journal.append(("node", lookup, self.nodes[node_id]))
+        return node_id
+
+    def ensure_country(self, stage: str, country_id: int) -> int:
+        return self._resolve(
+            ("country", stage, country_id),
+            lambda: NodeSpec(
+                key=f"{stage}:country:{country_id}",
                 stage=stage,
                 label=self.country_label(country_id),
                 color=self.reference.colors.get(country_id, "#7f8c8d"),
                 kind="regular",
                 hover=self.country_hover(country_id),
                 region=self.reference.regions.get(country_id, "Unknown") or "Unknown",
-            )
-        return key
-
-    def ensure_country_chemistry(self, stage: str, country_id: int, chemistry: str) -> str:
-        key = f"{stage}:chem:{country_id}:{_slug(chemistry)}"
-        if key not in self.nodes:
-            country = self.country_label(country_id)
-            self.nodes[key] = NodeSpec(
-                key=key,
+                country_id=country_id,
+            ),
+        )
+
+    def ensure_country_chemistry(self, stage: str, country_id: int, chemistry: str) -> int:
+        slug = _slug(chemistry)
+        return self._resolve(
+            ("chem", stage, country_id, slug),
+            lambda: NodeSpec(
+                key=f"{stage}:chem:{country_id}:{slug}",
                 stage=stage,
-                label=f"{country} / {chemistry}",
+                label=f"{self.country_label(country_id)} / {chemistry}",
                 color=self.reference.colors.get(country_id, "#7f8c8d"),
                 kind="regular",
                 hover=f"{self.country_hover(country_id)} / {chemistry}",
                 region=self.reference.regions.get(country_id, "Unknown") or "Unknown",
-            )
-        return key
+                country_id=country_id,
+                chemistry=chemistry,
+            ),
+        )
 
-    def ensure_global_chemistry(self, stage: str, chemistry: str) -> str:
+    def ensure_global_chemistry(self, stage: str, chemistry: str) -> int:
         normalized = str(chemistry).strip().upper()
-        key = f"{stage}:chemistry:{_slug(normalized)}"
-        if key not in self.nodes:
-            self.nodes[key] = NodeSpec(
-                key=key,
+        slug = _slug(normalized)
+        return self._resolve(
+            ("chemistry", stage, slug),
+            lambda: NodeSpec(
+                key=f"{stage}:chemistry:{slug}",
                 stage=stage,
                 label=normalized,
                 color=CHEMISTRY_COLORS.get(normalized, CHEMISTRY_COLORS["OTHER"]),
                 kind="regular",
                 hover=normalized,
                 region="Unknown",
-            )
-        return key
+                chemistry=normalized,
+            ),
+        )
 
-    def ensure_special(self, stage: str, slug: str, label: str, kind: str) -> str:
-        key = f"{stage}:special:{slug}"
-        if key not in self.nodes:
-            self.nodes[key] = NodeSpec(
-                key=key,
+    def ensure_special(self, stage: str, slug: str, label: str, kind: str) -> int:
+        return self._resolve(
+            ("special", stage, slug),
+            lambda: NodeSpec(
+                key=f"{stage}:special:{slug}",
                 stage=stage,
                 label=label,
                 color=SPECIAL_COLOR,
                 kind=kind,
                 hover=label,
                 region="Unknown",
-            )
-        return key
+            ),
+        )
 
-    def add_link(self, source: str, target: str, value: float) -> None:
+    def add_link(self, source: int, target: int, value: float) -> None:
         if value <= EPSILON:
             return
-        source_color = self.nodes[source].color if source in self.nodes else SPECIAL_COLOR
-        self.links.append(
+        self.link_count += 1
+        pair = (source, target)
+        self.link_values[pair] = self.link_values.get(pair, 0.0) + float(value)
+        if self._journal is not None:
+            self._journal.append(("link", self._lookups[source], self._lookups[target], float(value)))
+
+    def start_journal(self) -> None:
+        """Record every node lookup and link from here until ``stop_journal``."""
+        self._journal = []
+
+    def stop_journal(self) -> tuple[tuple[Any, ...], ...]:
+        journal = tuple(self._journal or ())
+        self._journal = None
+        return journal
+
+    def replay(self, journal: tuple[tuple[Any, ...], ...]) -> None:
+        """Repeat a recorded sequence of node lookups and links on this graph.
+
+        Nodes are looked up by their lookup key, so the replay reuses nodes an
+        earlier segment already created and creates the rest in the recorded
+        order, exactly as the original calls did.
+        """
+        for entry in journal:
+            if entry[0] == "node":
+                _, lookup, node = entry
+                if lookup not in self._node_ids:
+                    self._add_node(lookup, node)
+            else:
+                _, source, target, value = entry
+                self.add_link(self._node_ids[source], self._node_ids[target], value)
+
+    def node_map(self) -> dict[str, NodeSpec]:
+        return {node.key: node for node in self.nodes}
+
+    def link_specs(self) -> tuple[LinkSpec, ...]:
+        return tuple(
             LinkSpec(
-                source=source,
-                target=target,
-                value=float(value),
-                color=_rgba(source_color),
+                source=self.nodes[source].key,
+                target=self.nodes[target].key,
+                value=value,
+                color=self.link_colors[source],
             )
+            for (source, target), value in self.link_values.items()
+            if value > EPSILON
+        )
+
+    def sankey_graph(self) -> SankeyGraph:
+        pairs = [(pair, value) for pair, value in self.link_values.items() if value > EPSILON]
+        return SankeyGraph(
+            nodes=tuple(self.nodes),
+            sources=tuple(source for (source, _), _ in pairs),
+            targets=tuple(target for (_, target), _ in pairs),
+            values=tuple(value for _, value in pairs),
+            colors=tuple(self.link_colors[source] for (source, _), _ in pairs),
+            link_count=self.link_count,
         )
 
 
-def _classification(exporter: int, importer: int, source_ids: set[int], target_ids: set[int]) -> str:
-    source_producer = exporter in source_ids
-    target_producer = importer in target_ids
-    if source_producer and target_producer:
-        return "producer_to_producer"
-    if source_producer and not target_producer:
-        return "producer_to_non_target"
-    if not source_producer and target_producer:
-        return "non_source_to_producer"
-    return "non_source_to_non_target"
+def _producer_ids(totals: dict[int, float]) -> Any:
+    return np.fromiter(
+        (country_id for country_id, value in totals.items() if value > EPSILON), dtype=np.int64
+    )
+
+
+def _classify(table: TradeTable, source_totals: dict[int, float], target_totals: dict[int, float]) -> Any:
+    """Set every row's classification code and return the source-producer mask."""
+    source_producer = np.isin(table.exporter_id, _producer_ids(source_totals))
+    target_producer = np.isin(table.importer_id, _producer_ids(target_totals))
+    table.classification_code = (
+        (~source_producer).astype(np.int8) * 2 + (~target_producer).astype(np.int8)
+    )
+    return source_producer
+
+
+def _exporter_totals(exporters: Any, converted: Any) -> Any:
+    """Each row's exporter total of ``converted``, summed in row order."""
+    exporter_ids, positions = np.unique(exporters, return_inverse=True)
+    return np.bincount(positions, weights=converted, minlength=len(exporter_ids))[positions]
 
 
 def _prepare_trade_records(
-    records: list[TradeRecord],
+    records: TradeTable | list[TradeRecord],
     source_totals: dict[int, float],
     target_totals: dict[int, float],
 ) -> None:
-    source_ids = {country_id for country_id, value in source_totals.items() if value > EPSILON}
-    target_ids = {country_id for country_id, value in target_totals.items() if value > EPSILON}
-    exporter_totals: dict[int, float] = defaultdict(float)
-    for record in records:
-        record.classification = _classification(record.exporter_id, record.importer_id, source_ids, target_ids)
-        record.converted_quantity_before_scaling = (
-            record.raw_quantity_tonnes * record.manual_conversion_factor
-        )
-        exporter_totals[record.exporter_id] += record.converted_quantity_before_scaling
-
-    multipliers: dict[int, float] = {}
-    for exporter_id in source_ids:
-        converted_total = exporter_totals.get(exporter_id, 0.0)
-        available = float(source_totals.get(exporter_id, 0.0))
-        multipliers[exporter_id] = min(1.0, available / converted_total) if converted_total > EPSILON else 1.0
-
-    for record in records:
-        is_source_producer = record.exporter_id in source_ids
-        record.available_source_production = float(source_totals.get(record.exporter_id, 0.0))
-        record.exporter_total_before_scaling = float(exporter_totals.get(record.exporter_id, 0.0))
-        record.production_scaling_multiplier = multipliers.get(record.exporter_id, 1.0)
-        record.effective_conversion_factor = (
-            record.manual_conversion_factor * record.production_scaling_multiplier
-        )
-        record.final_trade_quantity_tonnes = (
-            record.raw_quantity_tonnes * record.effective_conversion_factor
-        )
-        record.included_in_sankey = (
-            record.classification != "non_source_to_non_target"
-            and record.final_trade_quantity_tonnes > EPSILON
-        )
-        if record.classification == "non_source_to_non_target":
-            record.adjustment_reason = "ignored: no upstream production and no downstream production"
-        elif not is_source_producer:
-            record.adjustment_reason = "non-source exporter; preserved without production scaling"
-        elif record.production_scaling_multiplier < 1.0 - EPSILON:
-            record.adjustment_reason = "production cap applied to exporter total"
-        else:
-            record.adjustment_reason = "manual factor retained; exporter production cap not binding"
+    table = as_trade_table(records)
+    if not len(table):
+        return
+    source_producer = _classify(table, source_totals, target_totals)
+    converted = table.raw_quantity_tonnes * table.manual_conversion_factor
+    exporter_totals = _exporter_totals(table.exporter_id, converted)
+    available = np.fromiter(
+        (float(source_totals.get(exporter_id, 0.0)) for exporter_id in table.exporter_id.tolist()),
+        dtype=float,
+        count=len(table),
+    )
+    capped = source_producer & (exporter_totals > EPSILON)
+    multipliers = np.ones(len(table))
+    multipliers[capped] = np.minimum(1.0, available[capped] / exporter_totals[capped])
+    ignored = table.classification_code == NON_SOURCE_TO_NON_TARGET
+    table.converted_quantity_before_scaling = converted
+    table.available_source_production = available
+    table.exporter_total_before_scaling = exporter_totals
+    table.production_scaling_multiplier = multipliers
+    table.effective_conversion_factor = table.manual_conversion_factor * multipliers
+    table.final_trade_quantity_tonnes = table.raw_quantity_tonnes * table.effective_conversion_factor
+    table.included_in_sankey = ~ignored & (table.final_trade_quantity_tonnes > EPSILON)
+    table.reason_code = np.select(
+        [ignored, ~source_producer, multipliers < 1.0 - EPSILON],
+        [IGNORED, NON_SOURCE_EXPORTER, CAP_APPLIED],
+        CAP_NOT_BINDING,
+    ).astype(np.int8)
+    sync_records(records, table)
+
+
+def _country_chemistry(source: dict[str, dict[int, float]], country_id: int | None) -> dict[str, float]:
+    return {
+        chemistry: float(mapping.get(country_id, 0.0))
+        for chemistry, mapping in source.items()
+        if country_id is not None and float(mapping.get(country_id, 0.0)) > EPSILON
+    }
+
+
+def _global_chemistry(source: dict[str, dict[int, float]]) -> dict[str, float]:
+    return {chemistry: sum(map(float, mapping.values())) for chemistry, mapping in source.items()}
+
+
+def _normalized_shares(values: dict[str, float]) -> dict[str, float]:
+    total = sum(values.values())
+    return {chemistry: value / total for chemistry, value in values.items() if total > EPSILON}
 
 
 def _chemistry_shares(
@@ -208,42 +357,133 @@ def _chemistry_shares(
     country_id: int | None,
 ) -> dict[str, float]:
     source = production.stage_chemistry.get(stage, {})
-    values = {
-        chemistry: float(mapping.get(country_id, 0.0))
-        for chemistry, mapping in source.items()
-        if country_id is not None and float(mapping.get(country_id, 0.0)) > EPSILON
+    values = _country_chemistry(source, country_id)
+    if sum(values.values()) <= EPSILON:
+        values = _global_chemistry(source)
+    return _normalized_shares(values)
+
+
+def _production_split(production: ProductionData, stage_name: str, country_id: int) -> tuple[float, dict[str, float]]:
+    """A country's stage production and its chemistry split, with any residual as OTHER."""
+    production_total = float(production.totals.get(stage_name, {}).get(country_id, 0.0))
+    chemistry_source = production.stage_chemistry.get(stage_name, {})
+    if not chemistry_source and stage_name == "cathode":
+        chemistry_source = production.cathode_chemistry
+    production_values = {
+        str(chemistry).strip().upper(): value
+        for chemistry, value in _country_chemistry(chemistry_source, country_id).items()
     }
-    total = sum(values.values())
-    if total <= EPSILON:
-        values = {chemistry: sum(map(float, mapping.values())) for chemistry, mapping in source.items()}
-        total = sum(values.values())
-    return {chemistry: value / total for chemistry, value in values.items() if total > EPSILON}
+    chemistry_total = sum(production_values.values())
+    tolerance = max(1e-6, abs(production_total) * 1e-8)
+    if chemistry_total > production_total + tolerance:
+        raise ValueError(
+            f"Cathode chemistry exceeds Product=Total for country id {country_id}: "
+            f"chemistry={chemistry_total}, total={production_total}"
+        )
+    residual = production_total - chemistry_total
+    if residual > tolerance:
+        production_values["OTHER"] = production_values.get("OTHER", 0.0) + residual
+    elif abs(residual) <= tolerance and chemistry_total > EPSILON:
+        scale = production_total / chemistry_total
+        production_values = {
+            chemistry: value * scale for chemistry, value in production_values.items()
+        }
+    if not production_values and production_total > EPSILON:
+        production_values["OTHER"] = production_total
+    return production_total, production_values
+
+
+class ChemistryTables:
+    """Chemistry shares and production splits for one run, computed once per (stage, country).
+
+    Each stage's global mix, the fallback for countries without their own
+    chemistry rows, is also computed only once. Every helper that splits a
+    flow by chemistry reads from the same tables.
+    """
+
+    def __init__(self, production: ProductionData) -> None:
+        self.production = production
+        self._shares: dict[tuple[str, int | None], dict[str, float]] = {}
+        self._global_shares: dict[str, dict[str, float]] = {}
+        self._splits: dict[tuple[str, int], tuple[float, dict[str, float]]] = {}
+        self._contained: dict[tuple[int, float], tuple[dict[str, float], float]] = {}
+
+    def global_shares(self, stage: str) -> dict[str, float]:
+        shares = self._global_shares.get(stage)
+        if shares is None:
+            source = self.production.stage_chemistry.get(stage, {})
+            shares = self._global_shares[stage] = _normalized_shares(_global_chemistry(source))
+        return shares
+
+    def shares(self, stage: str, country_id: int | None) -> dict[str, float]:
+        key = (stage, country_id)
+        shares = self._shares.get(key)
+        if shares is None:
+            values = _country_chemistry(self.production.stage_chemistry.get(stage, {}), country_id)
+            if sum(values.values()) <= EPSILON:
+                shares = self.global_shares(stage)
+            else:
+                shares = _normalized_shares(values)
+            self._shares[key] = shares
+        return shares
+
+    def production_split(self, stage_name: str, country_id: int) -> tuple[float, dict[str, float]]:
+        key = (stage_name, country_id)
+        split = self._splits.get(key)
+        if split is None:
+            split = self._splits[key] = _production_split(self.production, stage_name, country_id)
+        return split
+
+    def contained_weights(
+        self,
+        exporter_id: int,
+        manual_factor: float,
+        settings: Settings,
+    ) -> tuple[dict[str, float], float]:
+        """Factor-weighted cathode shares of an exporter and their total."""
+        key = (exporter_id, manual_factor)
+        entry = self._contained.get(key)
+        if entry is None:
+            weighted = {}
+            for chemistry, share in self.shares("cathode", exporter_id).items():
+                lookup = "LFP" if chemistry == "LMFP" and settings.merge_lmfp_into_lfp else chemistry
+                factor = settings.chemistry_conversion_factors.get(lookup, manual_factor)
+                weighted[chemistry] = share * factor
+            entry = self._contained[key] = (weighted, sum(weighted.values()))
+        return entry
 
 
 def _apply_chemistry_weighted_factors(
-    records: list[TradeRecord],
+    records: TradeTable | list[TradeRecord],
     transition_source: str,
     transition_target: str,
     settings: Settings,
     production: ProductionData,
+    tables: ChemistryTables | None = None,
 ) -> None:
     factors = settings.chemistry_conversion_factors
     if not factors or not ({transition_source, transition_target} & {"cathode", "battery"}):
         return
-    for record in records:
-        if transition_source == "cathode":
-            stage = "cathode"
-            country_id = record.exporter_id
-            basis = "exporter cathode chemistry share"
-        elif transition_target == "cathode":
-            stage = "cathode"
-            country_id = record.importer_id
-            basis = "importer cathode chemistry share"
-        else:
-            stage = transition_target
-            country_id = record.importer_id
-            basis = f"importer {stage} chemistry share"
-        shares = _chemistry_shares(production, stage, country_id)
+    tables = tables or ChemistryTables(production)
+    table = as_trade_table(records)
+    if transition_source == "cathode":
+        stage = "cathode"
+        country_ids = table.exporter_id
+        basis = "exporter cathode chemistry share"
+    elif transition_target == "cathode":
+        stage = "cathode"
+        country_ids = table.importer_id
+        basis = "importer cathode chemistry share"
+    else:
+        stage = transition_target
+        country_ids = table.importer_id
+        basis = f"importer {stage} chemistry share"
+    unique_ids, positions = np.unique(country_ids, return_inverse=True)
+    country_factors = np.zeros(len(unique_ids))
+    country_details = np.empty(len(unique_ids), dtype=object)
+    weighted_countries = np.zeros(len(unique_ids), dtype=bool)
+    for position, country_id in enumerate(unique_ids.tolist()):
+        shares = tables.shares(stage, country_id)
         weighted = 0.0
         used = 0.0
         for chemistry, share in shares.items():
@@ -252,42 +492,39 @@ def _apply_chemistry_weighted_factors(
                 weighted += share * factors[lookup]
                 used += share
         if used > EPSILON:
-            record.manual_conversion_factor = weighted / used
-            record.chemistry_factor_basis = basis
-            record.chemistry_factor_detail = "; ".join(
+            weighted_countries[position] = True
+            country_factors[position] = weighted / used
+            country_details[position] = "; ".join(
                 f"{chemistry}:share={share:.8g},factor={factors.get('LFP' if chemistry == 'LMFP' and chemistry not in factors else chemistry, 'NA')}"
                 for chemistry, share in sorted(shares.items())
             )
+    rows = weighted_countries[positions]
+    table.manual_conversion_factor[rows] = country_factors[positions[rows]]
+    table.chemistry_factor_basis[rows] = basis
+    table.chemistry_factor_detail[rows] = country_details[positions[rows]]
+    sync_records(records, table)
 
 
 def _prepare_trade_only_records(
-    records: list[TradeRecord],
+    records: TradeTable | list[TradeRecord],
     source_totals: dict[int, float],
     target_totals: dict[int, float],
 ) -> None:
-    source_ids = {country_id for country_id, value in source_totals.items() if value > EPSILON}
-    target_ids = {country_id for country_id, value in target_totals.items() if value > EPSILON}
-    exporter_totals: dict[int, float] = defaultdict(float)
-    for record in records:
-        record.classification = _classification(record.exporter_id, record.importer_id, source_ids, target_ids)
-        record.converted_quantity_before_scaling = (
-            record.raw_quantity_tonnes * record.manual_conversion_factor
-        )
-        exporter_totals[record.exporter_id] += record.converted_quantity_before_scaling
-    for record in records:
-        record.available_source_production = 0.0
-        record.exporter_total_before_scaling = float(exporter_totals.get(record.exporter_id, 0.0))
-        record.production_scaling_multiplier = 1.0
-        record.effective_conversion_factor = record.manual_conversion_factor
-        record.final_trade_quantity_tonnes = record.converted_quantity_before_scaling
-        record.included_in_sankey = (
-            record.classification != "non_source_to_non_target"
-            and record.final_trade_quantity_tonnes > EPSILON
-        )
-        if record.classification == "non_source_to_non_target":
-            record.adjustment_reason = "ignored: no upstream production and no downstream production"
-        else:
-            record.adjustment_reason = "trade-only mode; manual factor retained without production scaling"
+    table = as_trade_table(records)
+    if not len(table):
+        return
+    _classify(table, source_totals, target_totals)
+    converted = table.raw_quantity_tonnes * table.manual_conversion_factor
+    ignored = table.classification_code == NON_SOURCE_TO_NON_TARGET
+    table.converted_quantity_before_scaling = converted
+    table.available_source_production = np.zeros(len(table))
+    table.exporter_total_before_scaling = _exporter_totals(table.exporter_id, converted)
+    table.production_scaling_multiplier = np.ones(len(table))
+    table.effective_conversion_factor = table.manual_conversion_factor.copy()
+    table.final_trade_quantity_tonnes = converted
+    table.included_in_sankey = ~ignored & (converted > EPSILON)
+    table.reason_code = np.where(ignored, IGNORED, TRADE_ONLY).astype(np.int8)
+    sync_records(records, table)
 
 
 def _chemistry_values(
@@ -296,33 +533,11 @@ def _chemistry_values(
     target_total: float,
     feedstock_totals: dict[str, float] | None = None,
     stage_name: str = "cathode",
+    tables: ChemistryTables | None = None,
 ) -> dict[str, float]:
-    production_total = float(production.totals.get(stage_name, {}).get(country_id, 0.0))
-    chemistry_source = production.stage_chemistry.get(stage_name, {})
-    if not chemistry_source and stage_name == "cathode":
-        chemistry_source = production.cathode_chemistry
-    production_values = {
-        str(chemistry).strip().upper(): float(mapping.get(country_id, 0.0))
-        for chemistry, mapping in chemistry_source.items()
-        if float(mapping.get(country_id, 0.0)) > EPSILON
-    }
-    chemistry_total = sum(production_values.values())
-    tolerance = max(1e-6, abs(production_total) * 1e-8)
-    if chemistry_total > production_total + tolerance:
-        raise ValueError(
-            f"Cathode chemistry exceeds Product=Total for country id {country_id}: "
-            f"chemistry={chemistry_total}, total={production_total}"
-        )
-    residual = production_total - chemistry_total
-    if residual > tolerance:
-        production_values["OTHER"] = production_values.get("OTHER", 0.0) + residual
-    elif abs(residual) <= tolerance and chemistry_total > EPSILON:
-        scale = production_total / chemistry_total
-        production_values = {
-            chemistry: value * scale for chemistry, value in production_values.items()
-        }
-    if not production_values and production_total > EPSILON:
-        production_values["OTHER"] = production_total
+    production_total, production_values = (tables or ChemistryTables(production)).production_split(
+        stage_name, country_id
+    )
     if production_total <= EPSILON:
         return {"OTHER": target_total} if target_total > EPSILON else {}
     base_values = {
@@ -386,13 +601,13 @@ def _chemistry_values(
 def _add_target_output(
     graph: GraphBuilder,
     *,
-    post_key: str,
+    post_key: int,
     target_stage_key: str,
     target_stage_name: str,
     country_id: int,
     target_total: float,
     settings: Settings,
-    production: ProductionData,
+    tables: ChemistryTables,
     feedstock_totals: dict[str, float] | None = None,
 ) -> None:
     split_target = (
@@ -407,11 +622,12 @@ def _add_target_output(
         graph.add_link(post_key, target_key, target_total)
         return
     chemistry_values = _chemistry_values(
-        production,
+        tables.production,
         country_id,
         target_total,
         feedstock_totals=feedstock_totals,
         stage_name=target_stage_name,
+        tables=tables,
     )
     for chemistry, value in chemistry_values.items():
         if settings.cathode_view == "country_chemistry":
@@ -427,10 +643,10 @@ def _add_source_output(
     source_stage_key: str,
     source_stage_name: str,
     country_id: int,
-    target_key: str,
+    target_key: int,
     value: float,
     settings: Settings,
-    production: ProductionData,
+    tables: ChemistryTables,
 ) -> None:
     split_source = (
         source_stage_name == "cathode"
@@ -441,7 +657,7 @@ def _add_source_output(
         graph.add_link(graph.ensure_country(source_stage_key, country_id), target_key, value)
         return
     for chemistry, chemistry_value in _chemistry_values(
-        production, country_id, value, stage_name="cathode"
+        tables.production, country_id, value, stage_name="cathode", tables=tables
     ).items():
         if settings.cathode_view == "country_chemistry":
             source_key = graph.ensure_country_chemistry(source_stage_key, country_id, chemistry)
@@ -451,260 +667,532 @@ def _add_source_output(
 
 
 def _contained_chemistry_components(
-    record: TradeRecord,
-    production: ProductionData,
+    exporter_id: int,
+    manual_factor: float,
+    quantity: float,
+    tables: ChemistryTables,
     settings: Settings,
 ) -> dict[str, float]:
-    shares = _chemistry_shares(production, "cathode", record.exporter_id)
-    if not shares:
-        return {}
-    weighted = {}
-    for chemistry, share in shares.items():
-        lookup = "LFP" if chemistry == "LMFP" and settings.merge_lmfp_into_lfp else chemistry
-        factor = settings.chemistry_conversion_factors.get(lookup, record.manual_conversion_factor)
-        weighted[chemistry] = share * factor
-    total = sum(weighted.values())
+    weighted, total = tables.contained_weights(exporter_id, manual_factor, settings)
     return {
-        chemistry: record.final_trade_quantity_tonnes * weight / total
+        chemistry: quantity * weight / total
         for chemistry, weight in weighted.items()
         if total > EPSILON
     }
 
 
-def _conversion_row(
+def _conversion_columns(
     settings: Settings,
     route: RouteSpec,
     transition_label: str,
-    record: TradeRecord,
+    table: TradeTable,
     graph: GraphBuilder,
 ) -> dict[str, Any]:
+    source_files = np.empty(len(table), dtype=object)
+    source_files[:] = [" | ".join(files) for files in table.source_file_lists()]
     return {
         "metal": settings.metal,
         "year": settings.year,
         "route": route.key,
-        "transition": record.transition,
+        "transition": table.transition,
         "transition_label": transition_label,
         "trade_data_direction": "Import data: reporter/importer <- partner/exporter",
-        "hs_code": record.hs_code,
-        "target_product": record.target_product,
-        "chemistry_factor_basis": record.chemistry_factor_basis,
-        "chemistry_factor_detail": record.chemistry_factor_detail,
-        "importer_id": record.importer_id,
-        "importer_name": graph.country_name(record.importer_id),
-        "exporter_id": record.exporter_id,
-        "exporter_name": graph.country_name(record.exporter_id),
-        "classification": record.classification,
-        "raw_quantity_tonnes": record.raw_quantity_tonnes,
-        "manual_conversion_factor": record.manual_conversion_factor,
-        "configured_conversion_factor": record.configured_conversion_factor,
-        "converted_quantity_before_scaling": record.converted_quantity_before_scaling,
-        "available_source_production": record.available_source_production,
-        "exporter_total_before_scaling": record.exporter_total_before_scaling,
-        "production_scaling_multiplier": record.production_scaling_multiplier,
-        "effective_conversion_factor": record.effective_conversion_factor,
-        "final_trade_quantity_tonnes": record.final_trade_quantity_tonnes,
-        "included_in_sankey": record.included_in_sankey,
-        "adjustment_reason": record.adjustment_reason,
-        "source_files": " | ".join(record.source_files),
+        "hs_code": table.hs_code_values(),
+        "target_product": table.target_product_values(),
+        "chemistry_factor_basis": table.chemistry_factor_basis.copy(),
+        "chemistry_factor_detail": table.chemistry_factor_detail.copy(),
+        "importer_id": table.importer_id.copy(),
+        "importer_name": graph.country_names(table.importer_id),
+        "exporter_id": table.exporter_id.copy(),
+        "exporter_name": graph.country_names(table.exporter_id),
+        "classification": table.classification_values(),
+        "raw_quantity_tonnes": table.raw_quantity_tonnes.copy(),
+        "manual_conversion_factor": table.manual_conversion_factor.copy(),
+        "configured_conversion_factor": table.configured_conversion_factor.copy(),
+        "converted_quantity_before_scaling": table.converted_quantity_before_scaling.copy(),
+        "available_source_production": table.available_source_production.copy(),
+        "exporter_total_before_scaling": table.exporter_total_before_scaling.copy(),
+        "production_scaling_multiplier": table.production_scaling_multiplier.copy(),
+        "effective_conversion_factor": table.effective_conversion_factor.copy(),
+        "final_trade_quantity_tonnes": table.final_trade_quantity_tonnes.copy(),
+        "included_in_sankey": table.included_in_sankey.copy(),
+        "adjustment_reason": table.adjustment_reason_values(),
+        "source_files": source_files,
     }
 
 
-def _build_production_flow_graph(
+def _lookup(values: Any, keys: list[Any]) -> Any:
+    """``values.get(key, 0.0)`` for each key, as a float column."""
+    return np.fromiter((values.get(key, 0.0) for key in keys), dtype=float, count=len(keys))
+
+
+def _graph_rows(table: TradeTable) -> Any:
+    """``(classification, exporter, importer, value, manual factor, target product)`` of included rows."""
+    included = table.included_in_sankey
+    return zip(
+        table.classification_code[included].tolist(),
+        table.exporter_id[included].tolist(),
+        table.importer_id[included].tolist(),
+        table.final_trade_quantity_tonnes[included].tolist(),
+        table.manual_conversion_factor[included].tolist(),
+        table.target_product_values()[included].tolist(),
+    )
+
+
+def _production_segment(
     settings: Settings,
     route: RouteSpec,
+    transition: TransitionSpec,
     production: ProductionData,
-    reference: ReferenceMaps,
-    trade_by_transition: dict[str, list[TradeRecord]],
-) -> BuildResult:
-    graph = GraphBuilder(reference, production.labels, settings.country_label_mode)
-    conversion_rows: list[dict[str, Any]] = []
-    balance_rows: list[dict[str, Any]] = []
+    arrays: ProductionArrays,
+    chemistry_tables: ChemistryTables,
+    table: TradeTable,
+    graph: GraphBuilder,
+) -> tuple[dict[str, Any], int, dict[str, Any], TransitionSensitivity]:
+    """Add one transition to ``graph``; return its conversion columns, balance block and sensitivity."""
+    source_totals = production.totals[transition.source_stage]
+    target_totals = production.totals[transition.target_stage]
+    _apply_chemistry_weighted_factors(
+        table, transition.source_stage, transition.target_stage, settings, production, chemistry_tables
+    )
+    _prepare_trade_records(table, source_totals, target_totals)
+
+    source_stage_key = f"P:{transition.source_stage}"
+    post_stage_key = f"T:{transition.key}"
+    target_stage_key = f"P:{transition.target_stage}"
+    source_label = next(stage.label for stage in route.production_stages if stage.key == transition.source_stage)
+    target_label = next(stage.label for stage in route.production_stages if stage.key == transition.target_stage)
+
+    producer_to_non_target = graph.ensure_special(
+        post_stage_key,
+        f"{transition.key}_non_target",
+        f"{source_label} to Non-{target_label} Countries",
+        "sink_special",
+    )
+    from_non_source = graph.ensure_special(
+        source_stage_key,
+        f"{transition.key}_non_source",
+        f"From Non-{source_label} Countries",
+        "source_special",
+    )
+    unknown_source = graph.ensure_special(
+        source_stage_key,
+        f"{transition.key}_unknown_source",
+        f"Unknown {source_label} Source",
+        "source_special",
+    )
+    unknown_target = graph.ensure_special(
+        target_stage_key,
+        f"{transition.key}_unknown_target",
+        f"{source_label} to Unknown Destination",
+        "sink_special",
+    )
 
-    for transition in route.transitions:
-        source_totals = production.totals[transition.source_stage]
-        target_totals = production.totals[transition.target_stage]
-        source_ids = set(source_totals)
-        target_ids = set(target_totals)
-        records = trade_by_transition.get(transition.key, [])
-        _apply_chemistry_weighted_factors(
-            records, transition.source_stage, transition.target_stage, settings, production
-        )
-        _prepare_trade_records(records, source_totals, target_totals)
+    balance = transition_balance(settings.balance_engine, table, source_totals, target_totals)
+    feedstock_by_country: dict[int, dict[str, float]] = defaultdict(lambda: defaultdict(float))
 
-        source_stage_key = f"P:{transition.source_stage}"
-        post_stage_key = f"T:{transition.key}"
-        target_stage_key = f"P:{transition.target_stage}"
-        source_label = next(stage.label for stage in route.production_stages if stage.key == transition.source_stage)
-        target_label = next(stage.label for stage in route.production_stages if stage.key == transition.target_stage)
+    conversion = _conversion_columns(settings, route, transition.label, table, graph)
+    for classification, exporter_id, importer_id, value, manual_factor, target_product in _graph_rows(table):
+        if classification == PRODUCER_TO_PRODUCER:
+            post_key = graph.ensure_country(post_stage_key, importer_id)
+            _add_source_output(
+                graph, source_stage_key=source_stage_key,
+                source_stage_name=transition.source_stage, country_id=exporter_id,
+                target_key=post_key, value=value, settings=settings, tables=chemistry_tables,
+            )
+            if target_product:
+                feedstock_by_country[importer_id][target_product] += value
+            if transition.source_stage == "cathode":
+                for chemistry, component in _contained_chemistry_components(
+                    exporter_id, manual_factor, value, chemistry_tables, settings
+                ).items():
+                    feedstock_by_country[importer_id][chemistry] += component
+        elif classification == PRODUCER_TO_NON_TARGET:
+            _add_source_output(
+                graph, source_stage_key=source_stage_key,
+                source_stage_name=transition.source_stage, country_id=exporter_id,
+                target_key=producer_to_non_target, value=value, settings=settings, tables=chemistry_tables,
+            )
+        elif classification == NON_SOURCE_TO_PRODUCER:
+            post_key = graph.ensure_country(post_stage_key, importer_id)
+            graph.add_link(from_non_source, post_key, value)
+            if target_product:
+                feedstock_by_country[importer_id][target_product] += value
+            if transition.source_stage == "cathode":
+                for chemistry, component in _contained_chemistry_components(
+                    exporter_id, manual_factor, value, chemistry_tables, settings
+                ).items():
+                    feedstock_by_country[importer_id][chemistry] += component
+
+    for country_id in source_totals:
+        if country_id in balance.domestic:
+            remainder = balance.domestic[country_id]
+            post_key = graph.ensure_country(post_stage_key, country_id)
+            _add_source_output(
+                graph, source_stage_key=source_stage_key,
+                source_stage_name=transition.source_stage, country_id=country_id,
+                target_key=post_key, value=remainder, settings=settings, tables=chemistry_tables,
+            )
+            if transition.source_stage == "cathode":
+                for chemistry, share in chemistry_tables.shares("cathode", country_id).items():
+                    feedstock_by_country[country_id][chemistry] += remainder * share
+        elif country_id in balance.untraded:
+            _add_source_output(
+                graph, source_stage_key=source_stage_key,
+                source_stage_name=transition.source_stage, country_id=country_id,
+                target_key=producer_to_non_target, value=balance.untraded[country_id],
+                settings=settings, tables=chemistry_tables,
+            )
 
-        producer_to_non_target = graph.ensure_special(
-            post_stage_key,
-            f"{transition.key}_non_target",
-            f"{source_label} to Non-{target_label} Countries",
-            "sink_special",
-        )
-        from_non_source = graph.ensure_special(
-            source_stage_key,
-            f"{transition.key}_non_source",
-            f"From Non-{source_label} Countries",
-            "source_special",
-        )
-        unknown_source = graph.ensure_special(
-            source_stage_key,
-            f"{transition.key}_unknown_source",
-            f"Unknown {source_label} Source",
-            "source_special",
-        )
-        unknown_target = graph.ensure_special(
-            target_stage_key,
-            f"{transition.key}_unknown_target",
-            f"{source_label} to Unknown Destination",
-            "sink_special",
+    for country_id, target_total in target_totals.items():
+        post_key = graph.ensure_country(post_stage_key, country_id)
+        if country_id in balance.unknown_source:
+            graph.add_link(unknown_source, post_key, balance.unknown_source[country_id])
+        _add_target_output(
+            graph,
+            post_key=post_key,
+            target_stage_key=target_stage_key,
+            target_stage_name=transition.target_stage,
+            country_id=country_id,
+            target_total=float(target_total),
+            settings=settings,
+            tables=chemistry_tables,
+            feedstock_totals=dict(feedstock_by_country.get(country_id, {})),
         )
+        if country_id in balance.excess:
+            graph.add_link(post_key, unknown_target, balance.excess[country_id])
+
+    members = arrays.members_of(transition.source_stage) | arrays.members_of(transition.target_stage)
+    country_ids = arrays.index.ids[members].tolist()
+    source_total = arrays.totals_of(transition.source_stage)[members]
+    target_total = arrays.totals_of(transition.target_stage)[members]
+    exports = _lookup(balance.exports, country_ids)
+    domestic_value = _lookup(balance.domestic, country_ids)
+    untraded_value = _lookup(balance.untraded, country_ids)
+    imports = _lookup(balance.imports, country_ids)
+    unknown_value = _lookup(balance.unknown_source, country_ids)
+    excess_value = _lookup(balance.excess, country_ids)
+    sensitivity = transition_sensitivity(transition, table, source_totals, target_totals, balance)
+    return conversion, len(country_ids), {
+        "metal": settings.metal,
+        "year": settings.year,
+        "route": route.key,
+        "node_basis_mode": "production",
+        "transition": transition.key,
+        "transition_label": transition.label,
+        "country_id": np.asarray(country_ids, dtype=np.int64),
+        "country_name": graph.country_names(country_ids),
+        "source_stage": transition.source_stage,
+        "target_stage": transition.target_stage,
+        "source_production": source_total,
+        "target_production": target_total,
+        "trade_exports": exports,
+        "trade_imports": imports,
+        "producer_to_producer_imports": _lookup(balance.producer_imports, country_ids),
+        "from_non_source_imports": _lookup(balance.non_source_imports, country_ids),
+        "trade_exports_to_non_target": _lookup(balance.non_target_exports, country_ids),
+        "domestic_flow": domestic_value,
+        "untraded_production_to_non_target": untraded_value,
+        "unknown_source": unknown_value,
+        "excess_to_unknown_destination": excess_value,
+        "source_balance_residual": source_total - exports - domestic_value - untraded_value,
+        "post_trade_balance_residual": imports + domestic_value + unknown_value - target_total - excess_value,
+    }, sensitivity
+
+
+def _sensitivity_columns(
+    settings: Settings,
+    route: RouteSpec,
+    graph: GraphBuilder,
+    sensitivity: NodeSensitivity,
+) -> tuple[int, dict[str, Any]]:
+    """Sensitivity audit block: one row per (factor, node) whose size moves with the factor."""
+    moved = (np.abs(sensitivity.derivatives) > EPSILON) | sensitivity.kinks
+    parameter, node = np.nonzero(moved.T)
+    hovers = {spec.key: spec.hover for spec in graph.nodes}
+    labels = np.empty(len(sensitivity.node_keys), dtype=object)
+    # Chemistry views split production nodes, so their country-level keys may not be in the graph.
+    labels[:] = [
+        hovers.get(key) or (graph.country_hover(country_id) if country_id is not None else key)
+        for key, country_id in zip(sensitivity.node_keys, sensitivity.country_ids)
+    ]
+    node_keys = np.asarray(sensitivity.node_keys, dtype=object)
+    stages = np.asarray(sensitivity.stages, dtype=object)
+    country_ids = np.empty(len(sensitivity.node_keys), dtype=object)
+    country_ids[:] = list(sensitivity.country_ids)
+    transitions = np.asarray([transition for transition, _ in sensitivity.parameters], dtype=object)
+    hs_codes = np.asarray([hs_code for _, hs_code in sensitivity.parameters], dtype=object)
+    return len(node), {
+        "metal": settings.metal,
+        "year": settings.year,
+        "route": route.key,
+        "transition": transitions[parameter],
+        "hs_code": hs_codes[parameter],
+        "conversion_factor": sensitivity.factors[parameter],
+        "node_key": node_keys[node],
+        "node_label": labels[node],
+        "stage": stages[node],
+        "country_id": country_ids[node],
+        "node_size": sensitivity.sizes[node],
+        "derivative": sensitivity.derivatives[node, parameter],
+        "elasticity": sensitivity.elasticities()[node, parameter],
+        "at_kink": sensitivity.kinks[node, parameter],
+    }
 
-        export_by_country: dict[int, float] = defaultdict(float)
-        import_by_country: dict[int, float] = defaultdict(float)
-        pp_import_by_country: dict[int, float] = defaultdict(float)
-        np_import_by_country: dict[int, float] = defaultdict(float)
-        pn_export_by_country: dict[int, float] = defaultdict(float)
-        feedstock_by_country: dict[int, dict[str, float]] = defaultdict(lambda: defaultdict(float))
 
-        for record in records:
-            conversion_rows.append(
-                _conversion_row(settings, route, transition.label, record, graph)
-            )
-            if not record.included_in_sankey:
-                continue
-            value = record.final_trade_quantity_tonnes
-            if record.classification == "producer_to_producer":
-                post_key = graph.ensure_country(post_stage_key, record.importer_id)
-                _add_source_output(
-                    graph, source_stage_key=source_stage_key,
-                    source_stage_name=transition.source_stage, country_id=record.exporter_id,
-                    target_key=post_key, value=value, settings=settings, production=production,
-                )
-                export_by_country[record.exporter_id] += value
-                import_by_country[record.importer_id] += value
-                pp_import_by_country[record.importer_id] += value
-                if record.target_product:
-                    feedstock_by_country[record.importer_id][record.target_product] += value
-                if transition.source_stage == "cathode":
-                    for chemistry, component in _contained_chemistry_components(record, production, settings).items():
-                        feedstock_by_country[record.importer_id][chemistry] += component
-            elif record.classification == "producer_to_non_target":
-                _add_source_output(
-                    graph, source_stage_key=source_stage_key,
-                    source_stage_name=transition.source_stage, country_id=record.exporter_id,
-                    target_key=producer_to_non_target, value=value, settings=settings, production=production,
-                )
-                export_by_country[record.exporter_id] += value
-                pn_export_by_country[record.exporter_id] += value
-            elif record.classification == "non_source_to_producer":
-                post_key = graph.ensure_country(post_stage_key, record.importer_id)
-                graph.add_link(from_non_source, post_key, value)
-                import_by_country[record.importer_id] += value
-                np_import_by_country[record.importer_id] += value
-                if record.target_product:
-                    feedstock_by_country[record.importer_id][record.target_product] += value
-                if transition.source_stage == "cathode":
-                    for chemistry, component in _contained_chemistry_components(record, production, settings).items():
-                        feedstock_by_country[record.importer_id][chemistry] += component
-
-        domestic: dict[int, float] = defaultdict(float)
-        untraded_to_non_target: dict[int, float] = defaultdict(float)
-        for country_id, source_total in source_totals.items():
-            remainder = max(float(source_total) - export_by_country.get(country_id, 0.0), 0.0)
-            if remainder <= EPSILON:
-                continue
-            if country_id in target_ids:
-                post_key = graph.ensure_country(post_stage_key, country_id)
-                _add_source_output(
-                    graph, source_stage_key=source_stage_key,
-                    source_stage_name=transition.source_stage, country_id=country_id,
-                    target_key=post_key, value=remainder, settings=settings, production=production,
-                )
-                domestic[country_id] += remainder
-                if transition.source_stage == "cathode":
-                    for chemistry, share in _chemistry_shares(production, "cathode", country_id).items():
-                        feedstock_by_country[country_id][chemistry] += remainder * share
-            else:
-                _add_source_output(
-                    graph, source_stage_key=source_stage_key,
-                    source_stage_name=transition.source_stage, country_id=country_id,
-                    target_key=producer_to_non_target, value=remainder, settings=settings, production=production,
-                )
-                untraded_to_non_target[country_id] += remainder
+@dataclass(frozen=True)
+class ProductionSegment:
+    """What one production-basis transition adds to a build.
+
+    ``journal`` is the graph's recorded node lookups and links, ``conversion``
+    and ``balance`` the audit columns, ``sensitivity`` the factor derivatives
+    of its links, and ``trade_state`` the builder-filled trade arrays.
+    """
+
+    journal: tuple[tuple[Any, ...], ...]
+    conversion: dict[str, Any]
+    balance_count: int
+    balance: dict[str, Any]
+    sensitivity: TransitionSensitivity
+    trade_state: dict[str, Any]
+
+    @property
+    def nbytes(self) -> int:
+        return _estimated_bytes(self, set())
+
+
+def _estimated_bytes(value: Any, seen: set[int]) -> int:
+    """Memory held by ``value`` and everything it references, counting shared objects once."""
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if isinstance(value, np.ndarray):
+        if value.dtype != object:
+            return value.nbytes
+        return value.nbytes + sum(_estimated_bytes(item, seen) for item in value.ravel().tolist())
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        return size + sum(_estimated_bytes(key, seen) + _estimated_bytes(item, seen) for key, item in value.items())
+    if isinstance(value, (tuple, list)):
+        return size + sum(_estimated_bytes(item, seen) for item in value)
+    if is_dataclass(value):
+        return size + sum(_estimated_bytes(getattr(value, field.name), seen) for field in fields(value))
+    return size
+
+
+class _SegmentCache:
+    """Thread-safe LRU of production segments bounded by estimated bytes."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, tuple[ProductionSegment, int]] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> ProductionSegment | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: str, segment: ProductionSegment) -> None:
+        size = segment.nbytes
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (segment, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
 
-        unknown_source_by_country: dict[int, float] = defaultdict(float)
-        excess_by_country: dict[int, float] = defaultdict(float)
-        for country_id, target_total in target_totals.items():
-            post_key = graph.ensure_country(post_stage_key, country_id)
-            known_input = import_by_country.get(country_id, 0.0) + domestic.get(country_id, 0.0)
-            gap = max(float(target_total) - known_input, 0.0)
-            excess = max(known_input - float(target_total), 0.0)
-            if gap > EPSILON:
-                graph.add_link(unknown_source, post_key, gap)
-                unknown_source_by_country[country_id] = gap
-            _add_target_output(
-                graph,
-                post_key=post_key,
-                target_stage_key=target_stage_key,
-                target_stage_name=transition.target_stage,
-                country_id=country_id,
-                target_total=float(target_total),
-                settings=settings,
-                production=production,
-                feedstock_totals=dict(feedstock_by_country.get(country_id, {})),
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def nbytes(self) -> int:
+        with self._lock:
+            return self._bytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+_SEGMENTS = _SegmentCache(SEGMENT_CACHE_MAX_BYTES)
+
+
+def clear_segment_cache() -> None:
+    _SEGMENTS.clear()
+
+
+def _segment_context(
+    settings: Settings,
+    route: RouteSpec,
+    production: ProductionData,
+    reference: ReferenceMaps,
+) -> bytes:
+    """Digest of the run-wide inputs every production-basis segment reads.
+
+    Only the ``SEGMENT_SETTINGS`` are included. HS factors are left out too:
+    each transition's factors are part of its own trade table, so changing one
+    transition's factors changes only that transition's key.
+    """
+    scoped = tuple((name, getattr(settings, name)) for name in SEGMENT_SETTINGS)
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (scoped, route, production.labels, production.stage_chemistry, production.cathode_chemistry, reference):
+        digest.update(repr(part).encode())
+    return digest.digest()
+
+
+def _segment_key(context: bytes, transition: TransitionSpec, production: ProductionData, table: TradeTable) -> str:
+    # Cathode totals feed the contained-chemistry split of every transition.
+    stages = dict.fromkeys((transition.source_stage, transition.target_stage, "cathode"))
+    digest = hashlib.blake2b(context, digest_size=16)
+    digest.update(repr(transition).encode())
+    for stage in stages:
+        digest.update(repr((stage, production.totals.get(stage))).encode())
+    digest.update(table.input_digest().encode())
+    return digest.hexdigest()
+
+
+def _build_production_flow_graph(
+    settings: Settings,
+    route: RouteSpec,
+    production: ProductionData,
+    reference: ReferenceMaps,
+    trade_by_transition: dict[str, TradeTable],
+) -> BuildResult:
+    graph = GraphBuilder(reference, production.labels, settings.country_label_mode)
+    arrays = compact_production(production)
+    chemistry_tables = ChemistryTables(production)
+    context = _segment_context(settings, route, production, reference)
+    conversion_rows = AuditTable()
+    balance_rows = AuditTable()
+    sensitivities: list[TransitionSensitivity] = []
+
+    for transition in route.transitions:
+        table = trade_by_transition[transition.key]
+        key = _segment_key(context, transition, production, table)
+        segment = _SEGMENTS.get(key)
+        if segment is None:
+            graph.start_journal()
+            conversion, balance_count, balance, sensitivity = _production_segment(
+                settings, route, transition, production, arrays, chemistry_tables, table, graph
             )
-            if excess > EPSILON:
-                graph.add_link(post_key, unknown_target, excess)
-                excess_by_country[country_id] = excess
-
-        for country_id in sorted(source_ids | target_ids):
-            source_total = float(source_totals.get(country_id, 0.0))
-            target_total = float(target_totals.get(country_id, 0.0))
-            exports = export_by_country.get(country_id, 0.0)
-            domestic_value = domestic.get(country_id, 0.0)
-            untraded_value = untraded_to_non_target.get(country_id, 0.0)
-            imports = import_by_country.get(country_id, 0.0)
-            unknown_value = unknown_source_by_country.get(country_id, 0.0)
-            excess_value = excess_by_country.get(country_id, 0.0)
-            source_residual = source_total - exports - domestic_value - untraded_value
-            post_residual = imports + domestic_value + unknown_value - target_total - excess_value
-            balance_rows.append(
-                {
-                    "metal": settings.metal,
-                    "year": settings.year,
-                    "route": route.key,
-                    "node_basis_mode": "production",
-                    "transition": transition.key,
-                    "transition_label": transition.label,
-                    "country_id": country_id,
-                    "country_name": graph.country_name(country_id),
-                    "source_stage": transition.source_stage,
-                    "target_stage": transition.target_stage,
-                    "source_production": source_total,
-                    "target_production": target_total,
-                    "trade_exports": exports,
-                    "trade_imports": imports,
-                    "producer_to_producer_imports": pp_import_by_country.get(country_id, 0.0),
-                    "from_non_source_imports": np_import_by_country.get(country_id, 0.0),
-                    "trade_exports_to_non_target": pn_export_by_country.get(country_id, 0.0),
-                    "domestic_flow": domestic_value,
-                    "untraded_production_to_non_target": untraded_value,
-                    "unknown_source": unknown_value,
-                    "excess_to_unknown_destination": excess_value,
-                    "source_balance_residual": source_residual,
-                    "post_trade_balance_residual": post_residual,
-                }
+            segment = ProductionSegment(
+                graph.stop_journal(), conversion, balance_count, balance, sensitivity, table.computed_state()
             )
-
+            _SEGMENTS.put(key, segment)
+        else:
+            graph.replay(segment.journal)
+            table.restore_computed(segment.trade_state)
+        conversion_rows.append(len(table), segment.conversion)
+        balance_rows.append(segment.balance_count, segment.balance)
+        sensitivities.append(segment.sensitivity)
+
+    sensitivity_rows = AuditTable()
+    sensitivity_rows.append(*_sensitivity_columns(settings, route, graph, node_sensitivity(sensitivities)))
     return BuildResult(
-        nodes=graph.nodes,
-        links=tuple(graph.links),
-        conversion_rows=tuple(conversion_rows),
-        balance_rows=tuple(balance_rows),
-        stage_rows=tuple(),
+        nodes=graph.node_map(),
+        links=graph.link_specs(),
+        conversion_rows=conversion_rows,
+        balance_rows=balance_rows,
+        stage_rows=AuditTable(),
+        graph=graph.sankey_graph(),
+        sensitivity_rows=sensitivity_rows,
+    )
+
+
+@dataclass(frozen=True)
+class StageFlows:
+    """Trade-only chain flows as countries x stages matrices; non-member cells are 0.0."""
+
+    domestic: Any
+    unknown_source: Any
+    unknown_destination: Any
+    intrinsic_source: Any
+    terminal_absorption: Any
+    node_size: Any
+    material_residual: Any
+
+
+def _sweep_stage_flows(members: Any, incoming: Any, outgoing: Any) -> StageFlows:
+    """Carry deficits and surpluses along each country's runs of consecutive member stages.
+
+    A forward pass accumulates each run's export deficit and its running
+    maximum, a backward pass hands the maximum at the end of the run back to
+    its first stage as the boundary input, and a second forward pass pushes
+    material down the run. Each pass is one vectorized step per stage and
+    does the same float operations, in the same order, as walking every
+    country's run on its own.
+    """
+    count, stage_count = members.shape
+    previous = np.zeros_like(members)
+    previous[:, 1:] = members[:, :-1]
+    following = np.zeros_like(members)
+    following[:, :-1] = members[:, 1:]
+    starts = members & ~previous
+    ends = members & ~following
+
+    maximum = np.zeros((count, stage_count))
+    cumulative = np.zeros(count)
+    running_maximum = np.zeros(count)
+    for stage in range(stage_count):
+        cumulative = np.where(starts[:, stage], 0.0, cumulative) + (outgoing[:, stage] - incoming[:, stage])
+        running_maximum = np.where(starts[:, stage], 0.0, running_maximum)
+        running_maximum = np.where(cumulative > running_maximum, cumulative, running_maximum)
+        maximum[:, stage] = running_maximum
+
+    boundary_input = np.zeros((count, stage_count))
+    carried = np.zeros(count)
+    for stage in reversed(range(stage_count)):
+        at_end = np.where(maximum[:, stage] > 0.0, maximum[:, stage], 0.0)
+        carried = np.where(ends[:, stage], at_end, carried)
+        boundary_input[:, stage] = carried
+
+    domestic = np.zeros((count, stage_count))
+    boundary_output = np.zeros((count, stage_count))
+    node_size = np.zeros((count, stage_count))
+    material_residual = np.zeros((count, stage_count))
+    running = np.zeros(count)
+    for stage in range(stage_count):
+        running = np.where(starts[:, stage], boundary_input[:, stage], running)
+        inputs = incoming[:, stage] + running
+        surplus = inputs - outgoing[:, stage]
+        kept = np.where(surplus > 0.0, surplus, 0.0)
+        outputs = outgoing[:, stage] + kept
+        member = members[:, stage]
+        domestic[:, stage] = np.where(member & ~ends[:, stage], kept, 0.0)
+        boundary_output[:, stage] = np.where(ends[:, stage], kept, 0.0)
+        node_size[:, stage] = np.where(member, np.where(outputs > inputs, outputs, inputs), 0.0)
+        material_residual[:, stage] = np.where(member, inputs - outputs, 0.0)
+        running = kept
+
+    boundary_input = np.where(starts, boundary_input, 0.0)
+    intrinsic_source = np.zeros((count, stage_count))
+    intrinsic_source[:, 0] = boundary_input[:, 0]
+    unknown_source = boundary_input.copy()
+    unknown_source[:, 0] = 0.0
+    terminal_absorption = np.zeros((count, stage_count))
+    terminal_absorption[:, -1] = boundary_output[:, -1]
+    unknown_destination = boundary_output.copy()
+    unknown_destination[:, -1] = 0.0
+    return StageFlows(
+        domestic=domestic,
+        unknown_source=unknown_source,
+        unknown_destination=unknown_destination,
+        intrinsic_source=intrinsic_source,
+        terminal_absorption=terminal_absorption,
+        node_size=node_size,
+        material_residual=material_residual,
     )
 
 
@@ -713,102 +1201,55 @@ def _build_trade_only_flow_graph(
     route: RouteSpec,
     production: ProductionData,
     reference: ReferenceMaps,
-    trade_by_transition: dict[str, list[TradeRecord]],
+    trade_by_transition: dict[str, TradeTable],
 ) -> BuildResult:
     graph = GraphBuilder(reference, production.labels, settings.country_label_mode)
     stage_specs = list(route.production_stages)
-    stage_index = {stage.key: index for index, stage in enumerate(stage_specs)}
-    memberships = [set(production.totals[stage.key]) for stage in stage_specs]
-    incoming_trade: dict[tuple[int, int], float] = defaultdict(float)
-    outgoing_trade: dict[tuple[int, int], float] = defaultdict(float)
-    conversion_rows: list[dict[str, Any]] = []
-
-    pp_imports: dict[tuple[int, int], float] = defaultdict(float)
-    np_imports: dict[tuple[int, int], float] = defaultdict(float)
-    pn_exports: dict[tuple[int, int], float] = defaultdict(float)
+    arrays = compact_production(production)
+    chemistry_tables = ChemistryTables(production)
+    stage_positions = [arrays.stage_position(stage.key) for stage in stage_specs]
+    in_chain = arrays.stage_members[stage_positions].any(axis=0)
+    country_ids = arrays.index.ids[in_chain]
+    members = arrays.stage_members[stage_positions][:, in_chain].T
+    stage_count = len(stage_specs)
+    transition_count = len(route.transitions)
+    incoming_trade = np.zeros((len(country_ids), stage_count))
+    outgoing_trade = np.zeros((len(country_ids), stage_count))
+    pp_imports = np.zeros((len(country_ids), transition_count))
+    np_imports = np.zeros((len(country_ids), transition_count))
+    pn_exports = np.zeros((len(country_ids), transition_count))
+    conversion_rows = AuditTable()
 
     for transition_index, transition in enumerate(route.transitions):
-        records = trade_by_transition.get(transition.key, [])
+        table = trade_by_transition[transition.key]
         _apply_chemistry_weighted_factors(
-            records, transition.source_stage, transition.target_stage, settings, production
+            table, transition.source_stage, transition.target_stage, settings, production, chemistry_tables
         )
         _prepare_trade_only_records(
-            records,
+            table,
             production.totals[transition.source_stage],
             production.totals[transition.target_stage],
         )
-        for record in records:
-            conversion_rows.append(
-                _conversion_row(settings, route, transition.label, record, graph)
+        conversion_rows.append(len(table), _conversion_columns(settings, route, transition.label, table, graph))
+        # Exporters and importers of these classes are stage producers, so
+        # every one of them has a row in ``country_ids``.
+        included = table.included_in_sankey
+        code = table.classification_code
+        for totals, column, mask, ids in (
+            (outgoing_trade, transition_index, (code == PRODUCER_TO_PRODUCER) | (code == PRODUCER_TO_NON_TARGET), table.exporter_id),
+            (incoming_trade, transition_index + 1, (code == PRODUCER_TO_PRODUCER) | (code == NON_SOURCE_TO_PRODUCER), table.importer_id),
+            (pp_imports, transition_index, code == PRODUCER_TO_PRODUCER, table.importer_id),
+            (np_imports, transition_index, code == NON_SOURCE_TO_PRODUCER, table.importer_id),
+            (pn_exports, transition_index, code == PRODUCER_TO_NON_TARGET, table.exporter_id),
+        ):
+            rows = included & mask
+            totals[:, column] = np.bincount(
+                np.searchsorted(country_ids, ids[rows]),
+                weights=table.final_trade_quantity_tonnes[rows],
+                minlength=len(country_ids),
             )
-            if not record.included_in_sankey:
-                continue
-            value = record.final_trade_quantity_tonnes
-            if record.classification in {"producer_to_producer", "producer_to_non_target"}:
-                outgoing_trade[(transition_index, record.exporter_id)] += value
-            if record.classification in {"producer_to_producer", "non_source_to_producer"}:
-                incoming_trade[(transition_index + 1, record.importer_id)] += value
-            if record.classification == "producer_to_producer":
-                pp_imports[(transition_index, record.importer_id)] += value
-            elif record.classification == "non_source_to_producer":
-                np_imports[(transition_index, record.importer_id)] += value
-            elif record.classification == "producer_to_non_target":
-                pn_exports[(transition_index, record.exporter_id)] += value
-
-    domestic: dict[tuple[int, int], float] = defaultdict(float)
-    unknown_source: dict[tuple[int, int], float] = defaultdict(float)
-    unknown_destination: dict[tuple[int, int], float] = defaultdict(float)
-    intrinsic_source: dict[tuple[int, int], float] = defaultdict(float)
-    terminal_absorption: dict[tuple[int, int], float] = defaultdict(float)
-    node_size: dict[tuple[int, int], float] = defaultdict(float)
-    material_residual: dict[tuple[int, int], float] = defaultdict(float)
-
-    all_country_ids = sorted(set().union(*memberships))
-    for country_id in all_country_ids:
-        index = 0
-        while index < len(stage_specs):
-            if country_id not in memberships[index]:
-                index += 1
-                continue
-            start = index
-            while index + 1 < len(stage_specs) and country_id in memberships[index + 1]:
-                index += 1
-            end = index
-
-            cumulative_deficit = 0.0
-            maximum_deficit = 0.0
-            for stage_pos in range(start, end + 1):
-                cumulative_deficit += (
-                    outgoing_trade.get((stage_pos, country_id), 0.0)
-                    - incoming_trade.get((stage_pos, country_id), 0.0)
-                )
-                maximum_deficit = max(maximum_deficit, cumulative_deficit)
-            boundary_input = max(0.0, maximum_deficit)
-            if start == 0:
-                intrinsic_source[(start, country_id)] = boundary_input
-            else:
-                unknown_source[(start, country_id)] = boundary_input
-
-            running_input = boundary_input
-            for stage_pos in range(start, end + 1):
-                trade_in = incoming_trade.get((stage_pos, country_id), 0.0)
-                trade_out = outgoing_trade.get((stage_pos, country_id), 0.0)
-                input_total = trade_in + running_input
-                if stage_pos < end:
-                    downstream_domestic = max(0.0, input_total - trade_out)
-                    domestic[(stage_pos, country_id)] = downstream_domestic
-                    output_total = trade_out + downstream_domestic
-                    running_input = downstream_domestic
-                else:
-                    boundary_output = max(0.0, input_total - trade_out)
-                    if end == len(stage_specs) - 1:
-                        terminal_absorption[(end, country_id)] = boundary_output
-                    else:
-                        unknown_destination[(end, country_id)] = boundary_output
-                    output_total = trade_out + boundary_output
-                node_size[(stage_pos, country_id)] = max(input_total, output_total)
-                material_residual[(stage_pos, country_id)] = input_total - output_total
-            index += 1
+
+    flows = _sweep_stage_flows(members, incoming_trade, outgoing_trade)
 
     post_incoming: dict[tuple[int, int], float] = defaultdict(float)
     post_feedstocks: dict[tuple[int, int], dict[str, float]] = defaultdict(lambda: defaultdict(float))
@@ -842,73 +1283,78 @@ def _build_trade_only_flow_graph(
             "sink_special",
         )
 
-        for record in trade_by_transition.get(transition.key, []):
-            if not record.included_in_sankey:
-                continue
-            value = record.final_trade_quantity_tonnes
-            if record.classification == "producer_to_producer":
-                post_key = graph.ensure_country(post_stage_key, record.importer_id)
+        for classification, exporter_id, importer_id, value, manual_factor, target_product in _graph_rows(
+            trade_by_transition[transition.key]
+        ):
+            if classification == PRODUCER_TO_PRODUCER:
+                post_key = graph.ensure_country(post_stage_key, importer_id)
                 _add_source_output(
                     graph, source_stage_key=source_stage_key,
-                    source_stage_name=transition.source_stage, country_id=record.exporter_id,
-                    target_key=post_key, value=value, settings=settings, production=production,
+                    source_stage_name=transition.source_stage, country_id=exporter_id,
+                    target_key=post_key, value=value, settings=settings, tables=chemistry_tables,
                 )
-                post_incoming[(transition_index, record.importer_id)] += value
-                if record.target_product:
-                    post_feedstocks[(transition_index, record.importer_id)][record.target_product] += value
+                post_incoming[(transition_index, importer_id)] += value
+                if target_product:
+                    post_feedstocks[(transition_index, importer_id)][target_product] += value
                 if transition.source_stage == "cathode":
-                    for chemistry, component in _contained_chemistry_components(record, production, settings).items():
-                        post_feedstocks[(transition_index, record.importer_id)][chemistry] += component
-            elif record.classification == "producer_to_non_target":
+                    for chemistry, component in _contained_chemistry_components(
+                        exporter_id, manual_factor, value, chemistry_tables, settings
+                    ).items():
+                        post_feedstocks[(transition_index, importer_id)][chemistry] += component
+            elif classification == PRODUCER_TO_NON_TARGET:
                 _add_source_output(
                     graph, source_stage_key=source_stage_key,
-                    source_stage_name=transition.source_stage, country_id=record.exporter_id,
-                    target_key=non_target_key, value=value, settings=settings, production=production,
+                    source_stage_name=transition.source_stage, country_id=exporter_id,
+                    target_key=non_target_key, value=value, settings=settings, tables=chemistry_tables,
                 )
-            elif record.classification == "non_source_to_producer":
-                post_key = graph.ensure_country(post_stage_key, record.importer_id)
+            elif classification == NON_SOURCE_TO_PRODUCER:
+                post_key = graph.ensure_country(post_stage_key, importer_id)
                 graph.add_link(non_source_key, post_key, value)
-                post_incoming[(transition_index, record.importer_id)] += value
-                if record.target_product:
-                    post_feedstocks[(transition_index, record.importer_id)][record.target_product] += value
+                post_incoming[(transition_index, importer_id)] += value
+                if target_product:
+                    post_feedstocks[(transition_index, importer_id)][target_product] += value
                 if transition.source_stage == "cathode":
-                    for chemistry, component in _contained_chemistry_components(record, production, settings).items():
-                        post_feedstocks[(transition_index, record.importer_id)][chemistry] += component
-
-        for country_id in memberships[transition_index] & memberships[transition_index + 1]:
-            value = domestic.get((transition_index, country_id), 0.0)
-            if value <= EPSILON:
-                continue
+                    for chemistry, component in _contained_chemistry_components(
+                        exporter_id, manual_factor, value, chemistry_tables, settings
+                    ).items():
+                        post_feedstocks[(transition_index, importer_id)][chemistry] += component
+
+        source_members = members[:, transition_index]
+        target_members = members[:, transition_index + 1]
+        carried = source_members & target_members & (flows.domestic[:, transition_index] > EPSILON)
+        for country_id, value in zip(
+            country_ids[carried].tolist(), flows.domestic[carried, transition_index].tolist()
+        ):
             post_key = graph.ensure_country(post_stage_key, country_id)
             _add_source_output(
                 graph, source_stage_key=source_stage_key,
                 source_stage_name=transition.source_stage, country_id=country_id,
-                target_key=post_key, value=value, settings=settings, production=production,
+                target_key=post_key, value=value, settings=settings, tables=chemistry_tables,
             )
             post_incoming[(transition_index, country_id)] += value
             if transition.source_stage == "cathode":
-                for chemistry, share in _chemistry_shares(production, "cathode", country_id).items():
+                for chemistry, share in chemistry_tables.shares("cathode", country_id).items():
                     post_feedstocks[(transition_index, country_id)][chemistry] += value * share
 
-        for country_id in memberships[transition_index + 1]:
-            value = unknown_source.get((transition_index + 1, country_id), 0.0)
-            if value <= EPSILON:
-                continue
+        deficit = target_members & (flows.unknown_source[:, transition_index + 1] > EPSILON)
+        for country_id, value in zip(
+            country_ids[deficit].tolist(), flows.unknown_source[deficit, transition_index + 1].tolist()
+        ):
             post_key = graph.ensure_country(post_stage_key, country_id)
             graph.add_link(unknown_source_key, post_key, value)
             post_incoming[(transition_index, country_id)] += value
 
-        for country_id in memberships[transition_index]:
-            value = unknown_destination.get((transition_index, country_id), 0.0)
-            if value <= EPSILON:
-                continue
+        surplus = source_members & (flows.unknown_destination[:, transition_index] > EPSILON)
+        for country_id, value in zip(
+            country_ids[surplus].tolist(), flows.unknown_destination[surplus, transition_index].tolist()
+        ):
             _add_source_output(
                 graph, source_stage_key=source_stage_key,
                 source_stage_name=transition.source_stage, country_id=country_id,
-                target_key=unknown_destination_key, value=value, settings=settings, production=production,
+                target_key=unknown_destination_key, value=value, settings=settings, tables=chemistry_tables,
             )
 
-        for country_id in memberships[transition_index + 1]:
+        for country_id in country_ids[target_members].tolist():
             value = post_incoming.get((transition_index, country_id), 0.0)
             if value <= EPSILON:
                 continue
@@ -921,90 +1367,79 @@ def _build_trade_only_flow_graph(
                 country_id=country_id,
                 target_total=value,
                 settings=settings,
-                production=production,
+                tables=chemistry_tables,
                 feedstock_totals=dict(post_feedstocks.get((transition_index, country_id), {})),
             )
 
-    stage_rows: list[dict[str, Any]] = []
+    stage_rows = AuditTable()
     for stage_pos, stage in enumerate(stage_specs):
-        for country_id in sorted(memberships[stage_pos]):
-            trade_in = incoming_trade.get((stage_pos, country_id), 0.0)
-            trade_out = outgoing_trade.get((stage_pos, country_id), 0.0)
-            domestic_in = domestic.get((stage_pos - 1, country_id), 0.0) if stage_pos > 0 else 0.0
-            domestic_out = domestic.get((stage_pos, country_id), 0.0) if stage_pos < len(stage_specs) - 1 else 0.0
-            unknown_in = unknown_source.get((stage_pos, country_id), 0.0)
-            unknown_out = unknown_destination.get((stage_pos, country_id), 0.0)
-            intrinsic = intrinsic_source.get((stage_pos, country_id), 0.0)
-            terminal = terminal_absorption.get((stage_pos, country_id), 0.0)
-            stage_rows.append(
-                {
-                    "metal": settings.metal,
-                    "year": settings.year,
-                    "route": route.key,
-                    "node_basis_mode": "trade_only",
-                    "country_id": country_id,
-                    "country_name": graph.country_name(country_id),
-                    "production_stage": stage.key,
-                    "is_in_stage_list": True,
-                    "trade_import": trade_in,
-                    "trade_export": trade_out,
-                    "domestic_from_upstream": domestic_in,
-                    "domestic_to_downstream": domestic_out,
-                    "unknown_source": unknown_in,
-                    "unknown_destination": unknown_out,
-                    "intrinsic_chain_source": intrinsic,
-                    "terminal_chain_absorption": terminal,
-                    "node_size": node_size.get((stage_pos, country_id), 0.0),
-                    "material_balance_residual": material_residual.get((stage_pos, country_id), 0.0),
-                }
-            )
+        rows = members[:, stage_pos]
+        upstream = flows.domestic[rows, stage_pos - 1] if stage_pos > 0 else 0.0
+        downstream = flows.domestic[rows, stage_pos] if stage_pos < stage_count - 1 else 0.0
+        stage_rows.append(
+            int(np.count_nonzero(rows)),
+            {
+                "metal": settings.metal,
+                "year": settings.year,
+                "route": route.key,
+                "node_basis_mode": "trade_only",
+                "country_id": country_ids[rows],
+                "country_name": graph.country_names(country_ids[rows]),
+                "production_stage": stage.key,
+                "is_in_stage_list": True,
+                "trade_import": incoming_trade[rows, stage_pos],
+                "trade_export": outgoing_trade[rows, stage_pos],
+                "domestic_from_upstream": upstream,
+                "domestic_to_downstream": downstream,
+                "unknown_source": flows.unknown_source[rows, stage_pos],
+                "unknown_destination": flows.unknown_destination[rows, stage_pos],
+                "intrinsic_chain_source": flows.intrinsic_source[rows, stage_pos],
+                "terminal_chain_absorption": flows.terminal_absorption[rows, stage_pos],
+                "node_size": flows.node_size[rows, stage_pos],
+                "material_balance_residual": flows.material_residual[rows, stage_pos],
+            },
+        )
 
-    stage_row_map = {
-        (stage_index[row["production_stage"]], int(row["country_id"])): row
-        for row in stage_rows
-    }
-    balance_rows: list[dict[str, Any]] = []
+    balance_rows = AuditTable()
     for transition_index, transition in enumerate(route.transitions):
-        source_ids = memberships[transition_index]
-        target_ids = memberships[transition_index + 1]
-        for country_id in sorted(source_ids | target_ids):
-            source_row = stage_row_map.get((transition_index, country_id), {})
-            target_row = stage_row_map.get((transition_index + 1, country_id), {})
-            post_value = post_incoming.get((transition_index, country_id), 0.0)
-            balance_rows.append(
-                {
-                    "metal": settings.metal,
-                    "year": settings.year,
-                    "route": route.key,
-                    "node_basis_mode": "trade_only",
-                    "transition": transition.key,
-                    "transition_label": transition.label,
-                    "country_id": country_id,
-                    "country_name": graph.country_name(country_id),
-                    "source_stage": transition.source_stage,
-                    "target_stage": transition.target_stage,
-                    "source_production": source_row.get("node_size", 0.0),
-                    "target_production": target_row.get("node_size", 0.0),
-                    "trade_exports": outgoing_trade.get((transition_index, country_id), 0.0),
-                    "trade_imports": incoming_trade.get((transition_index + 1, country_id), 0.0),
-                    "producer_to_producer_imports": pp_imports.get((transition_index, country_id), 0.0),
-                    "from_non_source_imports": np_imports.get((transition_index, country_id), 0.0),
-                    "trade_exports_to_non_target": pn_exports.get((transition_index, country_id), 0.0),
-                    "domestic_flow": domestic.get((transition_index, country_id), 0.0),
-                    "untraded_production_to_non_target": 0.0,
-                    "unknown_source": unknown_source.get((transition_index + 1, country_id), 0.0),
-                    "excess_to_unknown_destination": unknown_destination.get((transition_index, country_id), 0.0),
-                    "source_balance_residual": source_row.get("material_balance_residual", 0.0),
-                    "post_trade_balance_residual": post_value - post_value,
-                }
-            )
+        rows = members[:, transition_index] | members[:, transition_index + 1]
+        post_value = _lookup(post_incoming, [(transition_index, country_id) for country_id in country_ids[rows].tolist()])
+        balance_rows.append(
+            int(np.count_nonzero(rows)),
+            {
+                "metal": settings.metal,
+                "year": settings.year,
+                "route": route.key,
+                "node_basis_mode": "trade_only",
+                "transition": transition.key,
+                "transition_label": transition.label,
+                "country_id": country_ids[rows],
+                "country_name": graph.country_names(country_ids[rows]),
+                "source_stage": transition.source_stage,
+                "target_stage": transition.target_stage,
+                "source_production": flows.node_size[rows, transition_index],
+                "target_production": flows.node_size[rows, transition_index + 1],
+                "trade_exports": outgoing_trade[rows, transition_index],
+                "trade_imports": incoming_trade[rows, transition_index + 1],
+                "producer_to_producer_imports": pp_imports[rows, transition_index],
+                "from_non_source_imports": np_imports[rows, transition_index],
+                "trade_exports_to_non_target": pn_exports[rows, transition_index],
+                "domestic_flow": flows.domestic[rows, transition_index],
+                "untraded_production_to_non_target": 0.0,
+                "unknown_source": flows.unknown_source[rows, transition_index + 1],
+                "excess_to_unknown_destination": flows.unknown_destination[rows, transition_index],
+                "source_balance_residual": flows.material_residual[rows, transition_index],
+                "post_trade_balance_residual": post_value - post_value,
+            },
+        )
 
     return BuildResult(
-        nodes=graph.nodes,
-        links=tuple(graph.links),
-        conversion_rows=tuple(conversion_rows),
-        balance_rows=tuple(balance_rows),
-        stage_rows=tuple(stage_rows),
+        nodes=graph.node_map(),
+        links=graph.link_specs(),
+        conversion_rows=conversion_rows,
+        balance_rows=balance_rows,
+        stage_rows=stage_rows,
+        graph=graph.sankey_graph(),
     )
 
 
@@ -1013,20 +1448,20 @@ def build_flow_graph(
     route: RouteSpec,
     production: ProductionData,
     reference: ReferenceMaps,
-    trade_by_transition: dict[str, list[TradeRecord]],
+    trade_by_transition: dict[str, TradeTable | list[TradeRecord]],
 ) -> BuildResult:
-    if settings.use_production_data:
-        return _build_production_flow_graph(
-            settings,
-            route,
-            production,
-            reference,
-            trade_by_transition,
-        )
-    return _build_trade_only_flow_graph(
-        settings,
-        route,
-        production,
-        reference,
-        trade_by_transition,
-    )
+    """Build the Sankey graph and audit rows for one run.
+
+    Each transition's trade may be a ``TradeTable`` or a list of
+    ``TradeRecord`` objects; lists are converted for the build and receive
+    the computed fields afterwards.
+    """
+    tables = {
+        transition.key: as_trade_table(trade_by_transition.get(transition.key, []), transition.key)
+        for transition in route.transitions
+    }
+    builder = _build_production_flow_graph if settings.use_production_data else _build_trade_only_flow_graph
+    result = builder(settings, route, production, reference, tables)
+    for transition_key, table in tables.items():
+        sync_records(trade_by_transition.get(transition_key, table), table)
+    return result
@@ -1,14 +1,30 @@
 from __future__ import annotations
 
 import math
+import threading
 from colorsys import hls_to_rgb
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from pathlib import Path
-from typing import Any
+from typing import Any, Collection
 
+import numpy as np
 import pandas as pd
 
-from models import EPSILON, ProductionData, ReferenceMaps, RouteSpec, Settings, TradeRecord
+from models import (
+    EPSILON,
+    BilateralFlows,
+    ProductionData,
+    ReferenceMaps,
+    ReferenceTable,
+    RouteSpec,
+    Settings,
+    TradePanel,
+    TradeRecord,
+)
+from production_cache import ParsedWorkbook, load_workbook
+from trade_index import TradeFileIndex, load_file_index
+from trade_store import aggregate_bilateral, country_dictionary, open_trade_year, read_bilateral_rows
+from trade_table import TradeTable
 
 
 METAL_PREFIXES = {"Li": "lithium", "Co": "cobalt", "Ni": "nickel", "Mn": "manganese"}
@@ -22,6 +38,8 @@ REGION_COLORS = {
     "Antarctica": "#000000",
     "Unknown": "#7f8c8d",
 }
+# Upper bound for the process-wide cache of pre-factor bilateral flows.
+TRADE_CACHE_MAX_BYTES = 256 * 1024 * 1024
 
 
 def normalize_metal(value: str) -> str:
@@ -41,6 +59,14 @@ def normalize_metal(value: str) -> str:
         raise ValueError(f"Unsupported metal {value!r}. Choose Li, Co, Ni, or Mn.") from exc
 
 
+def _positive_totals(values: pd.Series) -> dict[int, float]:
+    """Map an id-indexed sum to {country id: value}, keeping values above EPSILON."""
+    amounts = values.to_numpy(dtype=float)
+    keep = amounts > EPSILON
+    ids = values.index.to_numpy()[keep].astype(np.int64)
+    return dict(zip(ids.tolist(), amounts[keep].tolist()))
+
+
 def _normalize_color(value: Any) -> str | None:
     if value is None or pd.isna(value):
         return None
@@ -64,9 +90,13 @@ def _hsl_to_hex(hue: float, saturation: float, lightness: float) -> str:
     return "#%02x%02x%02x" % (int(red * 255), int(green * 255), int(blue * 255))
 
 
-def load_reference(path: Path, required_ids: set[int] | None = None) -> ReferenceMaps:
-    if not path.exists():
-        raise FileNotFoundError(f"Reference workbook does not exist: {path}")
+def _column_values(frame: pd.DataFrame, column: Any) -> list[Any]:
+    if column is None or column not in frame.columns:
+        return [None] * len(frame)
+    return frame[column].tolist()
+
+
+def parse_reference_table(path: Path) -> ReferenceTable:
     frame = pd.read_excel(path)
     if "id" not in frame.columns:
         raise ValueError(f"Reference workbook is missing the id column: {path}")
@@ -76,20 +106,70 @@ def load_reference(path: Path, required_ids: set[int] | None = None) -> Referenc
     iso3: dict[int, str] = {}
     colors: dict[int, str] = {}
     regions: dict[int, str] = {}
-    for _, row in frame.iterrows():
+    entries: list[tuple[int, Any, Any]] = []
+    for raw_id, name, iso3_code, region, raw_color in zip(
+        frame["id"].tolist(),
+        _column_values(frame, name_column),
+        _column_values(frame, iso3_column),
+        _column_values(frame, "region"),
+        _column_values(frame, "color"),
+    ):
         try:
-            country_id = int(row["id"])
+            country_id = int(raw_id)
         except (TypeError, ValueError):
             continue
-        names[country_id] = _clean_text(row.get(name_column), str(country_id))
-        iso3[country_id] = _clean_text(row.get(iso3_column), "") if iso3_column else ""
-        region = _clean_text(row.get("region"), "Unknown")
-        regions[country_id] = region
-        color = _normalize_color(row.get("color"))
+        entries.append((country_id, name, iso3_code))
+        names[country_id] = _clean_text(name, str(country_id))
+        iso3[country_id] = _clean_text(iso3_code, "") if iso3_column else ""
+        regions[country_id] = _clean_text(region, "Unknown")
+        color = _normalize_color(raw_color)
         if color:
             colors[country_id] = color
+    return ReferenceTable(
+        maps=ReferenceMaps(names=names, iso3=iso3, colors=colors, regions=regions),
+        entries=tuple(entries),
+    )
+
+
+_REFERENCE_TABLES: dict[Path, tuple[int, int, ReferenceTable]] = {}
+_REFERENCE_LOCK = threading.Lock()
 
-    missing = sorted(set(required_ids or ()) - set(colors))
+
+def load_reference_table(path: Path) -> ReferenceTable:
+    """Return the parsed reference workbook, reparsing it only when its mtime or size changes."""
+    path = Path(path)
+    if not path.exists():
+        raise FileNotFoundError(f"Reference workbook does not exist: {path}")
+    key = path.resolve()
+    stat = key.stat()
+    with _REFERENCE_LOCK:
+        known = _REFERENCE_TABLES.get(key)
+    if known is not None and known[:2] == (stat.st_mtime_ns, stat.st_size):
+        return known[2]
+    table = parse_reference_table(key)
+    with _REFERENCE_LOCK:
+        _REFERENCE_TABLES[key] = (stat.st_mtime_ns, stat.st_size, table)
+    return table
+
+
+def clear_reference_cache() -> None:
+    with _REFERENCE_LOCK:
+        _REFERENCE_TABLES.clear()
+
+
+def load_reference(path: Path, required_ids: set[int] | None = None) -> ReferenceMaps:
+    """Reference maps for one run: the cached workbook table plus colours for ``required_ids``.
+
+    Required countries without a workbook colour get a generated colour and
+    placeholder name, ISO3 and region in a per-run overlay; the cached table
+    is never modified.
+    """
+    base = load_reference_table(path).maps
+    required = set(required_ids or ())
+    missing = sorted(required - set(base.colors))
+    if not missing:
+        return base
+    colors = dict(base.colors)
     used = {color.upper() for color in colors.values()}
     for index, country_id in enumerate(missing):
         hue = (index * 0.618033988749895) % 1.0
@@ -101,12 +181,15 @@ def load_reference(path: Path, required_ids: set[int] | None = None) -> Referenc
             candidate = _hsl_to_hex(hue, saturation, lightness)
         colors[country_id] = candidate
         used.add(candidate.upper())
-    for country_id in set(required_ids or ()):
-        names.setdefault(country_id, f"Country {country_id}")
-        iso3.setdefault(country_id, "")
-        regions.setdefault(country_id, "Unknown")
-        colors.setdefault(country_id, REGION_COLORS["Unknown"])
-    return ReferenceMaps(names=names, iso3=iso3, colors=colors, regions=regions)
+    unnamed = [country_id for country_id in required if country_id not in base.names]
+    if not unnamed:
+        return ReferenceMaps(names=base.names, iso3=base.iso3, colors=colors, regions=base.regions)
+    return ReferenceMaps(
+        names={**base.names, **{country_id: f"Country {country_id}" for country_id in unnamed}},
+        iso3={**base.iso3, **{country_id: "" for country_id in unnamed}},
+        regions={**base.regions, **{country_id: "Unknown" for country_id in unnamed}},
+        colors=colors,
+    )
 
 
 def _year_column(frame: pd.DataFrame, year: int) -> Any:
@@ -133,18 +216,28 @@ def _stage_totals(frame: pd.DataFrame, year_column: Any, path: Path) -> pd.DataF
     return selected
 
 
-def _normalize_production_frame(frame: pd.DataFrame) -> pd.DataFrame:
-    aliases = {}
-    if "Desc" not in frame.columns and "reporterDesc" in frame.columns:
-        aliases["reporterDesc"] = "Desc"
-    if "Product" not in frame.columns and "product" in frame.columns:
-        aliases["product"] = "Product"
-    if "status" not in frame.columns and "Status" in frame.columns:
-        aliases["Status"] = "status"
-    return frame.rename(columns=aliases)
+class _WorkbookSession:
+    """Workbooks opened by one ``load_production`` call, each resolved once.
+
+    Several route stages usually read ``<metal>_<stage>`` sheets from the same
+    consolidated workbook. The session hashes and opens each distinct path a
+    single time; a cache miss parses all of its sheets in one ``read_excel``
+    call, and every stage then takes its frames from the same parsed workbook.
+    """
+
+    def __init__(self) -> None:
+        self._workbooks: dict[Path, ParsedWorkbook] = {}
+
+    def open(self, path: Path, persist: bool = False) -> ParsedWorkbook:
+        workbook = self._workbooks.get(path)
+        if workbook is None:
+            workbook = load_workbook(path, persist=persist)
+            self._workbooks[path] = workbook
+        return workbook
 
 
 def _read_legacy_production_workbook(
+    session: _WorkbookSession,
     path: Path,
     requested_sheets: tuple[str, ...] | None,
     settings: Settings,
@@ -153,28 +246,28 @@ def _read_legacy_production_workbook(
     production_source: str,
 ) -> dict[str, pd.DataFrame]:
     """Read the former one-workbook-per-stage schema."""
-    with pd.ExcelFile(path) as excel:
-        available = excel.sheet_names
-        if not available:
-            raise ValueError(f"Production workbook has no worksheets: {path}")
-        if requested_sheets is None:
-            selected_names = available
-        else:
-            by_normalized = {name.strip().casefold(): name for name in available}
-            missing = [name for name in requested_sheets if name.strip().casefold() not in by_normalized]
-            if missing:
-                raise ValueError(
-                    "Missing production sheet(s): "
-                    f"source={production_source}, metal={settings.metal}, "
-                    f"route={route.key}, stage={stage_key}, file={path}, "
-                    f"requested={missing}, available={available}"
-                )
-            selected_names = [by_normalized[name.strip().casefold()] for name in requested_sheets]
-        frames = pd.read_excel(excel, sheet_name=selected_names)
-    return {name: _normalize_production_frame(frame) for name, frame in frames.items()}
+    workbook = session.open(path, persist=production_source not in settings.production_upload_sources)
+    available = workbook.sheet_names
+    if not available:
+        raise ValueError(f"Production workbook has no worksheets: {path}")
+    if requested_sheets is None:
+        selected_names = available
+    else:
+        by_normalized = {name.strip().casefold(): name for name in available}
+        missing = [name for name in requested_sheets if name.strip().casefold() not in by_normalized]
+        if missing:
+            raise ValueError(
+                "Missing production sheet(s): "
+                f"source={production_source}, metal={settings.metal}, "
+                f"route={route.key}, stage={stage_key}, file={path}, "
+                f"requested={missing}, available={available}"
+            )
+        selected_names = [by_normalized[name.strip().casefold()] for name in requested_sheets]
+    return {name: workbook.frame(name, settings.year) for name in selected_names}
 
 
 def _read_consolidated_production_stage(
+    session: _WorkbookSession,
     path: Path,
     stage_sheet: str,
     requested_statuses: tuple[str, ...] | None,
@@ -184,18 +277,18 @@ def _read_consolidated_production_stage(
     production_source: str,
 ) -> dict[str, pd.DataFrame]:
     """Read one metal/stage sheet and split it into the requested status rows."""
-    with pd.ExcelFile(path) as excel:
-        available_sheets = excel.sheet_names
-        by_normalized_sheet = {name.strip().casefold(): name for name in available_sheets}
-        actual_sheet = by_normalized_sheet.get(stage_sheet.casefold())
-        if actual_sheet is None:
-            raise FileNotFoundError(
-                "Missing production-stage sheet: "
-                f"source={production_source}, metal={settings.metal}, route={route.key}, "
-                f"stage={stage_key}, workbook={path}, expected_sheet={stage_sheet}, "
-                f"available={available_sheets}"
-            )
-        frame = _normalize_production_frame(pd.read_excel(excel, sheet_name=actual_sheet))
+    workbook = session.open(path, persist=production_source not in settings.production_upload_sources)
+    available_sheets = workbook.sheet_names
+    by_normalized_sheet = {name.strip().casefold(): name for name in available_sheets}
+    actual_sheet = by_normalized_sheet.get(stage_sheet.casefold())
+    if actual_sheet is None:
+        raise FileNotFoundError(
+            "Missing production-stage sheet: "
+            f"source={production_source}, metal={settings.metal}, route={route.key}, "
+            f"stage={stage_key}, workbook={path}, expected_sheet={stage_sheet}, "
+            f"available={available_sheets}"
+        )
+    frame = workbook.frame(actual_sheet, settings.year)
 
     if "status" not in frame.columns:
         raise ValueError(
@@ -241,6 +334,7 @@ def load_production(settings: Settings, route: RouteSpec) -> ProductionData:
     stage_chemistry: dict[str, dict[str, dict[int, float]]] = {}
     ignored_rows: list[dict[str, Any]] = []
     sheet_summary_rows: list[dict[str, Any]] = []
+    session = _WorkbookSession()
 
     for stage in route.production_stages:
         if stage.key not in source_by_stage:
@@ -267,6 +361,7 @@ def load_production(settings: Settings, route: RouteSpec) -> ProductionData:
         if source_path.is_file():
             path = source_path
             sheet_frames = _read_consolidated_production_stage(
+                session,
                 path,
                 stage_sheet,
                 requested_statuses,
@@ -284,6 +379,7 @@ def load_production(settings: Settings, route: RouteSpec) -> ProductionData:
                     f"stage={stage.key}, path={path}"
                 )
             sheet_frames = _read_legacy_production_workbook(
+                session,
                 path,
                 requested_statuses,
                 settings,
@@ -306,18 +402,24 @@ def load_production(settings: Settings, route: RouteSpec) -> ProductionData:
                 )
             year_column = _year_column(frame, settings.year)
             numeric_ids = pd.to_numeric(frame["id"], errors="coerce")
-            for _, row in frame.loc[numeric_ids.isna()].iterrows():
-                ignored_rows.append(
-                    {
-                        "stage": stage.key,
-                        "file": str(path),
-                        "sheet": sheet_name,
-                        "description": str(row.get("Desc") or "").strip(),
-                        "reason": "missing id; ignored by user instruction",
-                    }
-                )
-            for _, row in frame.loc[numeric_ids.notna(), ["id", "Desc"]].drop_duplicates().iterrows():
-                labels.setdefault(int(row["id"]), _clean_text(row["Desc"], str(int(row["id"]))))
+            ignored_rows.extend(
+                {
+                    "stage": stage.key,
+                    "file": str(path),
+                    "sheet": sheet_name,
+                    "description": str(description or "").strip(),
+                    "reason": "missing id; ignored by user instruction",
+                }
+                for description in frame.loc[numeric_ids.isna(), "Desc"].tolist()
+            )
+            # The first description of each id wins, across sheets and stages.
+            first_rows = frame.loc[numeric_ids.notna(), ["Desc"]].assign(id=numeric_ids)
+            first_rows = first_rows.drop_duplicates(subset="id")
+            for country_id, description in zip(
+                first_rows["id"].to_numpy().astype(np.int64).tolist(), first_rows["Desc"].tolist()
+            ):
+                if country_id not in labels:
+                    labels[country_id] = _clean_text(description, str(country_id))
 
             selected = _stage_totals(frame, year_column, path)
             selected = selected.rename(columns={year_column: "_production_value"})
@@ -340,12 +442,8 @@ def load_production(settings: Settings, route: RouteSpec) -> ProductionData:
             chemistry_parts.append(detail)
 
         combined = pd.concat(selected_parts, ignore_index=True, sort=False)
-        grouped = combined.dropna(subset=["id"]).groupby("id", as_index=False)["_production_value"].sum()
-        totals[stage.key] = {
-            int(row["id"]): float(row["_production_value"])
-            for _, row in grouped.iterrows()
-            if float(row["_production_value"]) > EPSILON
-        }
+        grouped = combined.dropna(subset=["id"]).groupby("id")["_production_value"].sum()
+        totals[stage.key] = _positive_totals(grouped)
 
         if stage.key in {"cathode", "battery"}:
             detail = pd.concat(chemistry_parts, ignore_index=True, sort=False)
@@ -367,13 +465,9 @@ def load_production(settings: Settings, route: RouteSpec) -> ProductionData:
             stage_products: dict[str, dict[int, float]] = {}
             if settings.merge_lmfp_into_lfp:
                 detail.loc[detail["Product"].str.upper().eq("LMFP"), "Product"] = "LFP"
-            for product_name, product_frame in detail.groupby("Product"):
-                product_grouped = product_frame.groupby("id", as_index=False)["_production_value"].sum()
-                product_values = {
-                    int(row["id"]): float(row["_production_value"])
-                    for _, row in product_grouped.iterrows()
-                    if float(row["_production_value"]) > EPSILON
-                }
+            product_totals = detail.groupby(["Product", "id"])["_production_value"].sum()
+            for product_name, product_grouped in product_totals.groupby(level="Product"):
+                product_values = _positive_totals(product_grouped.droplevel("Product"))
                 stage_products[str(product_name).strip().upper()] = product_values
                 if stage.key == "cathode":
                     chemistry[str(product_name).strip().upper()] = product_values
@@ -389,51 +483,140 @@ def load_production(settings: Settings, route: RouteSpec) -> ProductionData:
     )
 
 
-def _quantity_to_tonnes(frame: pd.DataFrame) -> pd.Series:
-    tonnes = pd.Series(float("nan"), index=frame.index, dtype=float)
-    has_quantity_schema = False
-    if "qtyUnitAbbr" in frame.columns and "qty" in frame.columns:
-        has_quantity_schema = True
-        quantity = pd.to_numeric(frame["qty"], errors="coerce")
-        unit = frame["qtyUnitAbbr"].fillna("").astype(str).str.strip().str.lower()
-        tonnes.loc[unit.eq("kg")] = quantity.loc[unit.eq("kg")] / 1000.0
-        tonnes.loc[unit.isin({"t", "ton", "tonne", "tonnes"})] = quantity.loc[
-            unit.isin({"t", "ton", "tonne", "tonnes"})
-        ]
-
-    # UN Comtrade exports in this data series use both netWgt and netWeight.
-    # Apply the fallback row by row: a file can mix rows reported in kg with
-    # rows whose qty unit is N/A but whose net weight is still available.
-    for weight_column in ("netWgt", "netWeight"):
-        if weight_column not in frame.columns:
-            continue
-        has_quantity_schema = True
-        fallback = pd.to_numeric(frame[weight_column], errors="coerce") / 1000.0
-        tonnes = tonnes.fillna(fallback)
-
-    if tonnes.notna().any():
-        return tonnes.fillna(0.0)
-    if has_quantity_schema:
-        # A few reporter/HS files contain the expected Comtrade quantity
-        # columns but no reported values. They contribute zero trade rather
-        # than invalidating every other reporter in the scenario.
-        return pd.Series(0.0, index=frame.index, dtype=float)
-    raise ValueError(
-        "Raw trade file is missing usable qty/qtyUnitAbbr and netWgt/netWeight columns."
+def _raw_bilateral_rows(index: TradeFileIndex, hs_code: str, max_workers: int) -> dict[str, Any]:
+    paths = index.paths(hs_code)
+    if not paths:
+        pattern = f"*_{hs_code}_M_{index.year}_partners.csv"
+        raise FileNotFoundError(
+            f"No import-by-partner files found for year={index.year}, HS={hs_code}: "
+            f"{index.year_root / pattern}"
+        )
+    by_name: dict[str, list[Path]] = defaultdict(list)
+    for path in paths:
+        by_name[path.name].append(path)
+    duplicates = {name: values for name, values in by_name.items() if len(values) > 1}
+    if duplicates:
+        example_name, example_paths = next(iter(duplicates.items()))
+        raise ValueError(
+            f"Duplicate raw trade files would double-count importer data for HS {hs_code}: "
+            f"{example_name} -> {', '.join(str(path) for path in example_paths)}"
+        )
+    return read_bilateral_rows(index.year_root, paths, max_workers)
+
+
+def _raw_bilateral_flows(index: TradeFileIndex, hs_code: str, max_workers: int) -> BilateralFlows:
+    rows = _raw_bilateral_rows(index, hs_code, max_workers)
+    grouped = aggregate_bilateral(rows)
+    files = [str(index.year_root / name) for name in rows["files"].tolist()]
+    countries = country_dictionary(grouped["exporter_id"], grouped["importer_id"])
+    return BilateralFlows(
+        countries=countries,
+        exporter_index=np.searchsorted(countries, grouped["exporter_id"]),
+        importer_index=np.searchsorted(countries, grouped["importer_id"]),
+        tonnes=grouped["tonnes"],
+        source_files=tuple(
+            (files[file_ids[0]],)
+            if len(file_ids) == 1
+            else tuple(sorted({files[file_id] for file_id in file_ids}))
+            for file_ids in grouped["file_ids"]
+        ),
     )
 
 
-def load_trade_records(settings: Settings, transition_key: str) -> list[TradeRecord]:
-    hs_mapping = settings.post_trade_hs.get(transition_key, {})
-    if not hs_mapping:
-        return []
-    year_root = settings.trade_root / f"UNComtrade_{settings.year}_Import_ByPartner"
-    if not year_root.exists():
-        raise FileNotFoundError(f"Raw import folder does not exist: {year_root}")
-    aggregated: dict[tuple[str, int, int], dict[str, Any]] = defaultdict(
-        lambda: {"quantity": 0.0, "files": []}
+def _mapped_flows(index: TradeFileIndex, hs_code: str, matrix: dict[str, np.ndarray]) -> BilateralFlows:
+    files = [str(index.year_root / name) for name in index.relative_paths(hs_code)]
+    source_ids = matrix["source_ids"].tolist()
+    source_files = []
+    start = 0
+    for end in matrix["source_end"].tolist():
+        file_ids = source_ids[start:end]
+        source_files.append(
+            (files[file_ids[0]],)
+            if len(file_ids) == 1
+            else tuple(sorted({files[file_id] for file_id in file_ids}))
+        )
+        start = end
+    return BilateralFlows(
+        countries=matrix["countries"],
+        exporter_index=matrix["exporter_index"],
+        importer_index=matrix["importer_index"],
+        tonnes=matrix["tonnes"],
+        source_files=tuple(source_files),
+        mapped=True,
     )
-    for raw_hs_code, raw_factor in hs_mapping.items():
+
+
+class _FlowCache:
+    """Thread-safe LRU of pre-factor bilateral flows bounded by estimated bytes."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[tuple[str, int, str], tuple[dict[str, int], BilateralFlows]] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple[str, int, str], signature: dict[str, int]) -> BilateralFlows | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != signature:
+                # The year folder changed after this entry was loaded.
+                self._bytes -= entry[1].nbytes
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: tuple[str, int, str], signature: dict[str, int], flows: BilateralFlows) -> None:
+        if flows.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1].nbytes
+            self._entries[key] = (signature, flows)
+            self._bytes += flows.nbytes
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+_FLOW_CACHE = _FlowCache(TRADE_CACHE_MAX_BYTES)
+
+
+def clear_trade_cache() -> None:
+    _FLOW_CACHE.clear()
+
+
+def load_bilateral_flows(index: TradeFileIndex, hs_code: str, max_workers: int = 1) -> BilateralFlows:
+    """Return raw bilateral tonnes for one HS code, served from the process-wide LRU.
+
+    Entries hold pre-factor quantities, so changing a conversion factor never
+    invalidates them; they are dropped when the year folder's file index changes.
+    """
+    key = (str(index.year_root), index.year, hs_code)
+    flows = _FLOW_CACHE.get(key, index.signature)
+    if flows is not None:
+        return flows
+    compiled = open_trade_year(index)
+    matrix = compiled.matrix(hs_code) if compiled is not None else None
+    if matrix is None:
+        flows = _raw_bilateral_flows(index, hs_code, max_workers)
+    else:
+        flows = _mapped_flows(index, hs_code, matrix)
+    _FLOW_CACHE.put(key, index.signature, flows)
+    return flows
+
+
+def _hs_factors(settings: Settings, transition_key: str) -> dict[str, float]:
+    factors: dict[str, float] = {}
+    for raw_hs_code, raw_factor in settings.post_trade_hs.get(transition_key, {}).items():
         hs_code = str(raw_hs_code).strip()
         if not hs_code:
             raise ValueError(f"Blank HS code in {transition_key}.")
@@ -443,66 +626,102 @@ def load_trade_records(settings: Settings, transition_key: str) -> list[TradeRec
             raise ValueError(f"Invalid conversion factor for HS {hs_code}: {raw_factor!r}") from exc
         if not math.isfinite(factor) or factor < 0:
             raise ValueError(f"Conversion factor for HS {hs_code} must be finite and non-negative.")
-        pattern = f"*_{hs_code}_M_{settings.year}_partners.csv"
-        paths = sorted(year_root.rglob(pattern))
-        if not paths:
-            raise FileNotFoundError(
-                f"No import-by-partner files found for year={settings.year}, HS={hs_code}: "
-                f"{year_root / pattern}"
-            )
-        by_name: dict[str, list[Path]] = defaultdict(list)
-        for path in paths:
-            by_name[path.name].append(path)
-        duplicates = {name: values for name, values in by_name.items() if len(values) > 1}
-        if duplicates:
-            example_name, example_paths = next(iter(duplicates.items()))
-            raise ValueError(
-                f"Duplicate raw trade files would double-count importer data for HS {hs_code}: "
-                f"{example_name} -> {', '.join(str(path) for path in example_paths)}"
-            )
-        for path in paths:
-            try:
-                importer_id = int(path.name.split("_", 1)[0])
-            except ValueError:
-                continue
-            if importer_id == 0:
-                continue
-            frame = pd.read_csv(
-                path,
-                usecols=lambda column: column
-                in {"partnerCode", "qtyUnitAbbr", "qty", "netWgt", "netWeight"},
-            )
-            if "partnerCode" not in frame.columns:
-                continue
-            partners = pd.to_numeric(frame["partnerCode"], errors="coerce")
-            tonnes = _quantity_to_tonnes(frame)
-            for exporter, quantity in zip(partners.tolist(), tonnes.tolist()):
-                if pd.isna(exporter):
-                    continue
-                exporter_id = int(exporter)
-                quantity_value = float(quantity)
-                # partnerCode=0 is the World aggregate and must not be mixed with bilateral rows.
-                if exporter_id == 0 or quantity_value <= EPSILON:
-                    continue
-                key = (hs_code, exporter_id, importer_id)
-                aggregated[key]["quantity"] += quantity_value
-                aggregated[key]["files"].append(str(path))
-        for (loaded_hs, exporter_id, importer_id), values in list(aggregated.items()):
-            if loaded_hs != hs_code:
-                continue
-            values["factor"] = factor
-
-    return [
-        TradeRecord(
-            transition=transition_key,
+        factors[hs_code] = factor
+    return factors
+
+
+def load_trade_flows(settings: Settings, transition_key: str) -> dict[str, BilateralFlows]:
+    """Pre-factor bilateral matrices for every HS code of one transition.
+
+    Array-level counterpart of ``load_trade_records``: compiled years return
+    memory-mapped columns without building one ``TradeRecord`` per pair.
+    """
+    factors = _hs_factors(settings, transition_key)
+    if not factors:
+        return {}
+    index = load_file_index(settings.trade_root, settings.year)
+    return {
+        hs_code: load_bilateral_flows(index, hs_code, settings.trade_read_workers)
+        for hs_code in factors
+    }
+
+
+def load_trade_panel(
+    settings: Settings,
+    transition_key: str,
+    years: list[int],
+) -> dict[str, TradePanel]:
+    """Pre-factor bilateral tonnes of one transition's HS codes for several years.
+
+    Each year goes through its own file index and the shared flow cache, so a
+    panel costs one read of every (year, HS) partition and later single-year
+    runs reuse the same entries.
+    """
+    factors = _hs_factors(settings, transition_key)
+    ordered_years = tuple(dict.fromkeys(int(year) for year in years))
+    if not factors or not ordered_years:
+        return {}
+    indexes = [load_file_index(settings.trade_root, year) for year in ordered_years]
+    panels: dict[str, TradePanel] = {}
+    for hs_code in factors:
+        flows = [load_bilateral_flows(index, hs_code, settings.trade_read_workers) for index in indexes]
+        panels[hs_code] = TradePanel(
             hs_code=hs_code,
-            importer_id=importer_id,
-            exporter_id=exporter_id,
-            raw_quantity_tonnes=float(values["quantity"]),
-            manual_conversion_factor=float(values["factor"]),
-            configured_conversion_factor=float(values["factor"]),
-            target_product=settings.post_trade_products.get(transition_key, {}).get(hs_code, ""),
-            source_files=sorted(set(values["files"])),
+            years=ordered_years,
+            year=np.repeat(np.array(ordered_years, dtype=np.int64), [len(item.tonnes) for item in flows]),
+            exporter_ids=np.concatenate([item.exporter_ids for item in flows]).astype(np.int64),
+            importer_ids=np.concatenate([item.importer_ids for item in flows]).astype(np.int64),
+            tonnes=np.concatenate([item.tonnes for item in flows]).astype(np.float64),
         )
-        for (hs_code, exporter_id, importer_id), values in sorted(aggregated.items())
-    ]
+    return panels
+
+
+def configured_hs_codes(settings: Settings, transition_key: str) -> list[str]:
+    """Validated HS codes configured for one transition, in configuration order."""
+    return list(_hs_factors(settings, transition_key))
+
+
+def load_trade_table(
+    settings: Settings,
+    transition_key: str,
+    hs_codes: Collection[str] | None = None,
+) -> TradeTable:
+    """Trade rows for one transition as a ``TradeTable``, optionally limited to ``hs_codes``.
+
+    Every configured factor is validated, but files are only read for the HS
+    codes that are kept. Rows are grouped by HS code in sorted order.
+    """
+    factors = _hs_factors(settings, transition_key)
+    if hs_codes is not None:
+        factors = {hs_code: factor for hs_code, factor in factors.items() if hs_code in hs_codes}
+    if not factors:
+        return TradeTable.empty(transition_key)
+    index = load_file_index(settings.trade_root, settings.year)
+    products = settings.post_trade_products.get(transition_key, {})
+    flows_by_hs = {
+        hs_code: load_bilateral_flows(index, hs_code, settings.trade_read_workers)
+        for hs_code in factors
+    }
+    ordered = sorted(flows_by_hs)
+    sizes = [len(flows_by_hs[hs_code].tonnes) for hs_code in ordered]
+    factor_column = np.repeat(np.array([factors[hs_code] for hs_code in ordered], dtype=float), sizes)
+    return TradeTable.from_columns(
+        transition_key,
+        hs_codes=[hs_code for hs_code, size in zip(ordered, sizes) for _ in range(size)],
+        target_products=[products.get(hs_code, "") for hs_code, size in zip(ordered, sizes) for _ in range(size)],
+        importer_id=np.concatenate([flows_by_hs[hs_code].importer_ids for hs_code in ordered]),
+        exporter_id=np.concatenate([flows_by_hs[hs_code].exporter_ids for hs_code in ordered]),
+        raw_quantity_tonnes=np.concatenate([flows_by_hs[hs_code].tonnes for hs_code in ordered]),
+        manual_conversion_factor=factor_column,
+        configured_conversion_factor=factor_column,
+        source_files=[files for hs_code in ordered for files in flows_by_hs[hs_code].source_files],
+    )
+
+
+def load_trade_records(
+    settings: Settings,
+    transition_key: str,
+    hs_codes: Collection[str] | None = None,
+) -> list[TradeRecord]:
+    """``load_trade_table`` materialized as one ``TradeRecord`` per row."""
+    return load_trade_table(settings, transition_key, hs_codes).records()
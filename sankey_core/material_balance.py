@@ -0,0 +1,239 @@
+"""Per-country material balance of one production-basis transition.
+
+Two engines compute the same ``TransitionBalance``:
+
+* ``scalar`` walks the included trade rows and the production totals country
+  by country, accumulating into dictionaries;
+* ``sparse`` builds the transition's included trade as exporter x importer
+  matrices in COO form over every country the transition touches, with
+  domestic flows as the diagonal, and gets exports, imports, gaps and excesses
+  as matrix-vector products over all countries at once.
+
+Both engines add values in the same order, so they return identical numbers.
+``Settings.balance_engine`` selects one for the production-basis builder.
+"""
+from __future__ import annotations
+
+from collections import defaultdict
+from collections.abc import Mapping
+from dataclasses import dataclass
+from typing import Any
+
+import numpy as np
+
+from models import EPSILON
+from production_arrays import CountryIndex, CountryVector
+from trade_table import (
+    NON_SOURCE_TO_PRODUCER,
+    PRODUCER_TO_NON_TARGET,
+    PRODUCER_TO_PRODUCER,
+    TradeTable,
+)
+
+
+BALANCE_ENGINES = ("scalar", "sparse")
+
+
+@dataclass(frozen=True)
+class TransitionBalance:
+    """``{country_id: tonnes}`` aggregates of one transition.
+
+    ``domestic`` and ``untraded`` hold the source remainder of producers with
+    and without a target-stage row; ``unknown_source`` and ``excess`` hold the
+    target gaps and surpluses. Those four only contain countries whose value
+    exceeds ``EPSILON``.
+    """
+
+    exports: Mapping[int, float]
+    imports: Mapping[int, float]
+    producer_imports: Mapping[int, float]
+    non_source_imports: Mapping[int, float]
+    non_target_exports: Mapping[int, float]
+    domestic: Mapping[int, float]
+    untraded: Mapping[int, float]
+    unknown_source: Mapping[int, float]
+    excess: Mapping[int, float]
+
+
+def _included_rows(table: TradeTable) -> tuple[Any, Any, Any, Any]:
+    included = table.included_in_sankey
+    return (
+        table.classification_code[included],
+        table.exporter_id[included],
+        table.importer_id[included],
+        table.final_trade_quantity_tonnes[included],
+    )
+
+
+def scalar_balance(
+    table: TradeTable,
+    source_totals: Mapping[int, float],
+    target_totals: Mapping[int, float],
+) -> TransitionBalance:
+    exports: dict[int, float] = defaultdict(float)
+    imports: dict[int, float] = defaultdict(float)
+    producer_imports: dict[int, float] = defaultdict(float)
+    non_source_imports: dict[int, float] = defaultdict(float)
+    non_target_exports: dict[int, float] = defaultdict(float)
+    codes, exporters, importers, values = _included_rows(table)
+    for code, exporter_id, importer_id, value in zip(
+        codes.tolist(), exporters.tolist(), importers.tolist(), values.tolist()
+    ):
+        if code == PRODUCER_TO_PRODUCER:
+            exports[exporter_id] += value
+            imports[importer_id] += value
+            producer_imports[importer_id] += value
+        elif code == PRODUCER_TO_NON_TARGET:
+            exports[exporter_id] += value
+            non_target_exports[exporter_id] += value
+        elif code == NON_SOURCE_TO_PRODUCER:
+            imports[importer_id] += value
+            non_source_imports[importer_id] += value
+
+    domestic: dict[int, float] = {}
+    untraded: dict[int, float] = {}
+    for country_id, source_total in source_totals.items():
+        remainder = max(float(source_total) - exports.get(country_id, 0.0), 0.0)
+        if remainder <= EPSILON:
+            continue
+        if country_id in target_totals:
+            domestic[country_id] = remainder
+        else:
+            untraded[country_id] = remainder
+
+    unknown_source: dict[int, float] = {}
+    excess: dict[int, float] = {}
+    for country_id, target_total in target_totals.items():
+        known_input = imports.get(country_id, 0.0) + domestic.get(country_id, 0.0)
+        gap = max(float(target_total) - known_input, 0.0)
+        surplus = max(known_input - float(target_total), 0.0)
+        if gap > EPSILON:
+            unknown_source[country_id] = gap
+        if surplus > EPSILON:
+            excess[country_id] = surplus
+    return TransitionBalance(
+        exports=exports,
+        imports=imports,
+        producer_imports=producer_imports,
+        non_source_imports=non_source_imports,
+        non_target_exports=non_target_exports,
+        domestic=domestic,
+        untraded=untraded,
+        unknown_source=unknown_source,
+        excess=excess,
+    )
+
+
+@dataclass(frozen=True)
+class CountryMatrix:
+    """Sparse square matrix over a ``CountryIndex`` in COO form.
+
+    Entries keep the order they were given in, and products add them in that
+    order.
+    """
+
+    rows: Any
+    columns: Any
+    values: Any
+    size: int
+
+    @classmethod
+    def from_ids(cls, index: CountryIndex, row_ids: Any, column_ids: Any, values: Any) -> "CountryMatrix":
+        return cls(
+            rows=np.searchsorted(index.ids, row_ids),
+            columns=np.searchsorted(index.ids, column_ids),
+            values=np.asarray(values, dtype=float),
+            size=len(index),
+        )
+
+    def dot(self, vector: Any) -> Any:
+        """``M @ vector``."""
+        return np.bincount(self.rows, weights=self.values * vector[self.columns], minlength=self.size)
+
+    def transpose_dot(self, vector: Any) -> Any:
+        """``M.T @ vector``."""
+        return np.bincount(self.columns, weights=self.values * vector[self.rows], minlength=self.size)
+
+    def entry_rows(self) -> Any:
+        """Rows with at least one stored entry."""
+        return np.bincount(self.rows, minlength=self.size) > 0
+
+    def entry_columns(self) -> Any:
+        return np.bincount(self.columns, minlength=self.size) > 0
+
+
+def _clipped(values: Any) -> Any:
+    """``max(value, 0.0)`` element by element, keeping its handling of -0.0 and NaN."""
+    return np.where(0.0 > values, 0.0, values)
+
+
+def sparse_balance(
+    table: TradeTable,
+    source_totals: Mapping[int, float],
+    target_totals: Mapping[int, float],
+) -> TransitionBalance:
+    codes, exporters, importers, values = _included_rows(table)
+    index = CountryIndex.from_ids(
+        np.concatenate(
+            [
+                np.fromiter(source_totals, dtype=np.int64, count=len(source_totals)),
+                np.fromiter(target_totals, dtype=np.int64, count=len(target_totals)),
+                exporters,
+                importers,
+            ]
+        )
+    )
+    ones = np.ones(len(index))
+
+    def matrix(mask: Any) -> CountryMatrix:
+        return CountryMatrix.from_ids(index, exporters[mask], importers[mask], values[mask])
+
+    producer = codes == PRODUCER_TO_PRODUCER
+    non_target = codes == PRODUCER_TO_NON_TARGET
+    non_source = codes == NON_SOURCE_TO_PRODUCER
+    exported = matrix(producer | non_target)
+    imported = matrix(producer | non_source)
+    producer_trade = matrix(producer)
+    non_target_trade = matrix(non_target)
+    non_source_trade = matrix(non_source)
+    exports = exported.dot(ones)
+    imports = imported.transpose_dot(ones)
+
+    source, source_members = index.vector(source_totals)
+    target, target_members = index.vector(target_totals)
+    remainder = _clipped(source - exports)
+    sending = source_members & (remainder > EPSILON)
+    domestic_members = sending & target_members
+    # The diagonal of domestic flows: remainder that stays in the country.
+    domestic = np.where(domestic_members, remainder, 0.0)
+    known_input = imports + domestic
+    gap = _clipped(target - known_input)
+    surplus = _clipped(known_input - target)
+
+    def view(vector: Any, mask: Any) -> CountryVector:
+        return CountryVector(index, vector, mask)
+
+    return TransitionBalance(
+        exports=view(exports, exported.entry_rows()),
+        imports=view(imports, imported.entry_columns()),
+        producer_imports=view(producer_trade.transpose_dot(ones), producer_trade.entry_columns()),
+        non_source_imports=view(non_source_trade.transpose_dot(ones), non_source_trade.entry_columns()),
+        non_target_exports=view(non_target_trade.dot(ones), non_target_trade.entry_rows()),
+        domestic=view(domestic, domestic_members),
+        untraded=view(remainder, sending & ~target_members),
+        unknown_source=view(gap, target_members & (gap > EPSILON)),
+        excess=view(surplus, target_members & (surplus > EPSILON)),
+    )
+
+
+def transition_balance(
+    engine: str,
+    table: TradeTable,
+    source_totals: Mapping[int, float],
+    target_totals: Mapping[int, float],
+) -> TransitionBalance:
+    if engine == "sparse":
+        return sparse_balance(table, source_totals, target_totals)
+    if engine == "scalar":
+        return scalar_balance(table, source_totals, target_totals)
+    raise ValueError(f"Unknown balance engine: {engine!r}. Expected one of {BALANCE_ENGINES}.")
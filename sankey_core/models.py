@@ -2,7 +2,11 @@ from __future__ import annotations
 
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from audit_table import AuditTable
+    from trade_table import TradeTable
 
 
 EPSILON = 1e-9
@@ -45,6 +49,19 @@ class ReferenceMaps:
     regions: dict[int, str]
 
 
+@dataclass(frozen=True)
+class ReferenceTable:
+    """The parsed reference workbook, before any per-run colour allocation.
+
+    ``maps`` holds the names, ISO3 codes, regions and workbook colours of
+    every row with an integer id. ``entries`` keeps each such row's
+    ``(id, name, iso3)`` cells as read, in workbook order.
+    """
+
+    maps: ReferenceMaps
+    entries: tuple[tuple[int, Any, Any], ...]
+
+
 @dataclass(frozen=True)
 class ProductionData:
     totals: dict[str, dict[int, float]]
@@ -55,6 +72,58 @@ class ProductionData:
     sheet_summary_rows: tuple[dict[str, Any], ...] = ()
 
 
+@dataclass(frozen=True)
+class BilateralFlows:
+    """Raw, pre-factor bilateral tonnes for one year and HS code.
+
+    A sparse exporter x importer matrix in COO form: ``exporter_index`` and
+    ``importer_index`` are positions in the sorted ``countries`` dictionary.
+    Rows are sorted by exporter then importer. ``source_files`` holds the
+    sorted raw partner files behind each row. ``mapped`` arrays are views of
+    the compiled store and live in the shared page cache.
+    """
+
+    countries: Any
+    exporter_index: Any
+    importer_index: Any
+    tonnes: Any
+    source_files: tuple[tuple[str, ...], ...]
+    mapped: bool = False
+
+    @property
+    def exporter_ids(self) -> Any:
+        return self.countries[self.exporter_index]
+
+    @property
+    def importer_ids(self) -> Any:
+        return self.countries[self.importer_index]
+
+    @property
+    def nbytes(self) -> int:
+        distinct = {path for paths in self.source_files for path in paths}
+        private = 0 if self.mapped else int(
+            self.countries.nbytes + self.exporter_index.nbytes + self.importer_index.nbytes + self.tonnes.nbytes
+        )
+        return private + 64 * len(self.source_files) + sum(len(path) + 49 for path in distinct)
+
+
+@dataclass(frozen=True)
+class TradePanel:
+    """Raw bilateral tonnes for one HS code across several years, in long form.
+
+    ``year``, ``exporter_ids``, ``importer_ids`` and ``tonnes`` are aligned
+    arrays; rows are grouped by year in ``years`` order and sorted by exporter
+    then importer within each year.
+    """
+
+    hs_code: str
+    years: tuple[int, ...]
+    year: Any
+    exporter_ids: Any
+    importer_ids: Any
+    tonnes: Any
+
+
 @dataclass
 class TradeRecord:
     transition: str
@@ -88,6 +157,8 @@ class NodeSpec:
     kind: str
     hover: str
     region: str
+    country_id: int | None = None
+    chemistry: str | None = None
 
 
 @dataclass(frozen=True)
@@ -98,13 +169,44 @@ class LinkSpec:
     color: str
 
 
+@dataclass(frozen=True)
+class SankeyGraph:
+    """Nodes by integer id and links already summed per (source, target) id pair.
+
+    ``nodes[i]`` describes node ``i``. ``sources``, ``targets``, ``values``
+    and ``colors`` are aligned per link in first-added order. ``link_count``
+    is the number of links added before they were summed.
+    """
+
+    nodes: tuple[NodeSpec, ...]
+    sources: tuple[int, ...]
+    targets: tuple[int, ...]
+    values: tuple[float, ...]
+    colors: tuple[str, ...]
+    link_count: int
+
+
 @dataclass(frozen=True)
 class BuildResult:
     nodes: dict[str, NodeSpec]
     links: tuple[LinkSpec, ...]
-    conversion_rows: tuple[dict[str, Any], ...]
-    balance_rows: tuple[dict[str, Any], ...]
-    stage_rows: tuple[dict[str, Any], ...]
+    conversion_rows: AuditTable
+    balance_rows: AuditTable
+    stage_rows: AuditTable
+    graph: SankeyGraph | None = None
+    # Production-basis runs only; see sensitivity.py.
+    sensitivity_rows: AuditTable | None = None
+
+
+@dataclass(frozen=True)
+class RunInputs:
+    """What one run loads before building: route, production, trade and reference."""
+
+    route: RouteSpec
+    stages: tuple[DisplayStage, ...]
+    production: ProductionData
+    trade_by_transition: dict[str, TradeTable]
+    reference: ReferenceMaps
 
 
 @dataclass(frozen=True)
@@ -140,8 +242,22 @@ class Settings:
     production_sources_by_stage: dict[str, str] = field(default_factory=dict)
     production_roots: dict[str, Path] = field(default_factory=dict)
     production_all_status_sources: frozenset[str] = frozenset()
+    # Sources whose workbooks are per-session uploads; their parsed form is
+    # kept in memory only instead of being pickled beside the workbook.
+    production_upload_sources: frozenset[str] = frozenset()
     output_basename: str | None = None
     country_label_mode: str = "full"
     flow_transparency_threshold: float = 0.0
     node_transparency_threshold: float = 0.0
     preserved_country_ids: frozenset[int] = frozenset()
+    # Partner CSV files parsed concurrently when no compiled partition exists.
+    trade_read_workers: int = 1
+    # "scalar" or "sparse"; see material_balance.py. Both give identical results.
+    balance_engine: str = "scalar"
+    # Monte Carlo uncertainty bands; see uncertainty.py. Zero draws turns them off.
+    monte_carlo_draws: int = 0
+    monte_carlo_seed: int = 0
+    factor_distributions: dict[str, tuple[Any, ...]] = field(default_factory=dict)
+    production_distributions: dict[str, tuple[Any, ...]] = field(default_factory=dict)
+    uncertainty_percentiles: tuple[float, ...] = (5.0, 50.0, 95.0)
+    uncertainty_hover: bool = False
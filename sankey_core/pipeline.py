@@ -8,13 +8,23 @@ from pathlib import Path
 from types import ModuleType
 from typing import Any
 
+import numpy as np
 import pandas as pd
 
+from audit_table import AuditTable
 from flow_builder import build_flow_graph
-from loaders import load_production, load_reference, load_trade_records, normalize_metal
-from models import Settings
+from loaders import (
+    configured_hs_codes,
+    load_production,
+    load_reference,
+    load_trade_table,
+    normalize_metal,
+)
+from material_balance import BALANCE_ENGINES
+from models import RouteSpec, RunInputs, Settings
 from renderer import make_figure
 from routes import display_stages, route_for, route_from_options
+from uncertainty import monte_carlo_bands, parse_distribution
 
 
 CATHODE_VIEW_ALIASES = {
@@ -103,6 +113,23 @@ STAGE_COLUMNS = [
     "material_balance_residual",
 ]
 
+SENSITIVITY_COLUMNS = [
+    "metal",
+    "year",
+    "route",
+    "transition",
+    "hs_code",
+    "conversion_factor",
+    "node_key",
+    "node_label",
+    "stage",
+    "country_id",
+    "node_size",
+    "derivative",
+    "elasticity",
+    "at_kink",
+]
+
 PRODUCTION_SHEET_COLUMNS = [
     "production_source",
     "metal",
@@ -302,6 +329,35 @@ def settings_from_module(module: ModuleType) -> Settings:
             "PRODUCTION_ALL_STATUS_SOURCES contains unknown source(s): "
             f"{unknown_all_status_sources}"
         )
+    upload_sources = frozenset(
+        str(source).strip().lower() for source in getattr(module, "PRODUCTION_UPLOAD_SOURCES", ())
+    )
+    configured_codes = {hs for mapping in post_trade_hs.values() for hs in mapping}
+    factor_distributions = {
+        str(hs).strip(): parse_distribution(spec, f"FACTOR_DISTRIBUTIONS[{hs!r}]")
+        for hs, spec in dict(getattr(module, "FACTOR_DISTRIBUTIONS", {})).items()
+    }
+    unknown_distribution_codes = sorted(set(factor_distributions) - configured_codes)
+    if unknown_distribution_codes:
+        raise ValueError(
+            f"FACTOR_DISTRIBUTIONS contains HS codes absent from POST_TRADE_HS: {unknown_distribution_codes}"
+        )
+    production_distributions = {
+        str(stage).strip().lower(): parse_distribution(spec, f"PRODUCTION_DISTRIBUTIONS[{stage!r}]")
+        for stage, spec in dict(getattr(module, "PRODUCTION_DISTRIBUTIONS", {})).items()
+    }
+    route_stages = {stage.key for stage in route_spec.production_stages}
+    unknown_distribution_stages = sorted(set(production_distributions) - route_stages)
+    if unknown_distribution_stages:
+        raise ValueError(
+            f"PRODUCTION_DISTRIBUTIONS contains stages outside route={route}: {unknown_distribution_stages}"
+        )
+    try:
+        uncertainty_percentiles = tuple(
+            sorted({float(value) for value in getattr(module, "MONTE_CARLO_PERCENTILES", (5, 50, 95))})
+        )
+    except (TypeError, ValueError) as exc:
+        raise ValueError("MONTE_CARLO_PERCENTILES must contain numbers between 0 and 100.") from exc
     settings = Settings(
         metal=metal,
         year=int(_setting(module, "YEAR")),
@@ -335,6 +391,7 @@ def settings_from_module(module: ModuleType) -> Settings:
         production_sources_by_stage=active_sources,
         production_roots=production_roots,
         production_all_status_sources=all_status_sources,
+        production_upload_sources=upload_sources,
         output_basename=(
             re.sub(r"[^A-Za-z0-9_.-]+", "_", str(getattr(module, "OUTPUT_BASENAME", "")).strip()).strip("_.-")
             or None
@@ -343,6 +400,14 @@ def settings_from_module(module: ModuleType) -> Settings:
         flow_transparency_threshold=float(getattr(module, "FLOW_TRANSPARENCY_THRESHOLD", 0.0)),
         node_transparency_threshold=float(getattr(module, "NODE_TRANSPARENCY_THRESHOLD", 0.0)),
         preserved_country_ids=preserved_country_ids,
+        trade_read_workers=int(getattr(module, "TRADE_READ_WORKERS", 1)),
+        balance_engine=str(getattr(module, "BALANCE_ENGINE", "scalar")).strip().lower(),
+        monte_carlo_draws=int(getattr(module, "MONTE_CARLO_DRAWS", 0)),
+        monte_carlo_seed=int(getattr(module, "MONTE_CARLO_SEED", 0)),
+        factor_distributions=factor_distributions,
+        production_distributions=production_distributions,
+        uncertainty_percentiles=uncertainty_percentiles,
+        uncertainty_hover=_as_bool(getattr(module, "MONTE_CARLO_HOVER", False), "MONTE_CARLO_HOVER"),
     )
     if settings.year < 1900 or settings.year > 2200:
         raise ValueError(f"YEAR is outside the supported range: {settings.year}")
@@ -352,6 +417,18 @@ def settings_from_module(module: ModuleType) -> Settings:
         raise ValueError("IMAGE_WIDTH and IMAGE_SCALE must be greater than zero.")
     if settings.label_font_size <= 0:
         raise ValueError("LABEL_FONT_SIZE must be greater than zero.")
+    if settings.trade_read_workers < 1:
+        raise ValueError("TRADE_READ_WORKERS must be at least 1.")
+    if settings.balance_engine not in BALANCE_ENGINES:
+        raise ValueError(f"BALANCE_ENGINE must be one of {', '.join(BALANCE_ENGINES)}.")
+    if settings.monte_carlo_draws < 0:
+        raise ValueError("MONTE_CARLO_DRAWS must be zero or greater.")
+    if settings.monte_carlo_draws and not settings.use_production_data:
+        raise ValueError("MONTE_CARLO_DRAWS needs USE_PRODUCTION_DATA = True.")
+    if not settings.uncertainty_percentiles or not all(
+        0.0 <= value <= 100.0 for value in settings.uncertainty_percentiles
+    ):
+        raise ValueError("MONTE_CARLO_PERCENTILES must contain numbers between 0 and 100.")
     if (
         not math.isfinite(settings.flow_transparency_threshold)
         or not math.isfinite(settings.node_transparency_threshold)
@@ -374,26 +451,30 @@ def _output_paths(output_image: Path) -> dict[str, Path]:
         "balance": stem.parent / f"{stem.name}_balance_audit.csv",
         "ignored": stem.parent / f"{stem.name}_ignored_production_rows.csv",
         "stage": stem.parent / f"{stem.name}_stage_material_flow.csv",
+        "sensitivity": stem.parent / f"{stem.name}_factor_sensitivity.csv",
         "production_sheets": stem.parent / f"{stem.name}_production_sheet_summary.csv",
+        "uncertainty": stem.parent / f"{stem.name}_uncertainty_bands.csv",
         "manifest": stem.parent / f"{stem.name}_manifest.json",
     }
 
 
-def _write_csv(rows: tuple[dict[str, Any], ...], columns: list[str], path: Path) -> None:
-    frame = pd.DataFrame(list(rows), columns=columns)
+def _write_csv(rows: AuditTable | tuple[dict[str, Any], ...], columns: list[str], path: Path) -> None:
+    if isinstance(rows, AuditTable):
+        frame = rows.to_frame(columns)
+    else:
+        frame = pd.DataFrame(list(rows), columns=columns)
     frame.to_csv(path, index=False, encoding="utf-8-sig")
 
 
-def _verify_balance(
-    rows: tuple[dict[str, Any], ...],
-    stage_rows: tuple[dict[str, Any], ...],
-) -> dict[str, float]:
-    max_source = max((abs(float(row["source_balance_residual"])) for row in rows), default=0.0)
-    max_post = max((abs(float(row["post_trade_balance_residual"])) for row in rows), default=0.0)
-    max_stage = max(
-        (abs(float(row["material_balance_residual"])) for row in stage_rows),
-        default=0.0,
-    )
+def _max_residual(rows: AuditTable, column: str) -> float:
+    values = np.abs(np.asarray(rows.column(column), dtype=float))
+    return float(values.max()) if len(values) else 0.0
+
+
+def _verify_balance(rows: AuditTable, stage_rows: AuditTable) -> dict[str, float]:
+    max_source = _max_residual(rows, "source_balance_residual")
+    max_post = _max_residual(rows, "post_trade_balance_residual")
+    max_stage = _max_residual(stage_rows, "material_balance_residual")
     tolerance = 1e-6
     if max_source > tolerance or max_post > tolerance or max_stage > tolerance:
         raise ValueError(
@@ -407,42 +488,61 @@ def _verify_balance(
     }
 
 
-def run_pipeline(settings: Settings) -> dict[str, str]:
+def _owned_hs_codes(settings: Settings, route: RouteSpec) -> dict[str, set[str]]:
+    """Assign each configured HS code to the one transition that keeps its records.
+
+    With ``downstream`` ownership the last transition listing an HS code wins,
+    with ``upstream`` the first. Records depend only on the HS code and year,
+    so resolving ownership on the configured sets matches filtering loaded
+    records while reading every shared HS code once.
+    """
+    ordered = list(route.transitions)
+    ownership_order = reversed(ordered) if settings.shared_hs_trade_owner == "downstream" else ordered
+    claimed: set[str] = set()
+    owned: dict[str, set[str]] = {}
+    for transition in ownership_order:
+        owned[transition.key] = set(configured_hs_codes(settings, transition.key)) - claimed
+        claimed.update(owned[transition.key])
+    return {transition.key: owned[transition.key] for transition in ordered}
+
+
+def load_run_inputs(settings: Settings) -> RunInputs:
+    """Resolve the route and load production, trade tables and reference maps for ``settings``."""
     route = route_from_options(
         settings.merge_processing_refining, settings.show_pcam, settings.show_battery
     ) if settings.route.startswith(("full", "merged")) else route_for(settings.route)
-    stages = display_stages(route)
     production = load_production(settings, route)
     trade_by_transition = {
-        transition.key: load_trade_records(settings, transition.key)
-        for transition in route.transitions
+        transition_key: load_trade_table(settings, transition_key, hs_codes)
+        for transition_key, hs_codes in _owned_hs_codes(settings, route).items()
     }
-    ordered = list(route.transitions)
-    claimed: set[str] = set()
-    ownership_order = reversed(ordered) if settings.shared_hs_trade_owner == "downstream" else ordered
-    for transition in ownership_order:
-        kept = []
-        for record in trade_by_transition[transition.key]:
-            if record.hs_code in claimed:
-                continue
-            kept.append(record)
-        claimed.update(record.hs_code for record in kept)
-        trade_by_transition[transition.key] = kept
     required_ids = {
         country_id
         for mapping in production.totals.values()
         for country_id in mapping
     }
-    for records in trade_by_transition.values():
-        for record in records:
-            required_ids.add(record.importer_id)
-            required_ids.add(record.exporter_id)
-    reference = load_reference(settings.reference_file, required_ids)
-    result = build_flow_graph(settings, route, production, reference, trade_by_transition)
+    for table in trade_by_transition.values():
+        required_ids.update(np.union1d(table.importer_id, table.exporter_id).tolist())
+    return RunInputs(
+        route=route,
+        stages=display_stages(route),
+        production=production,
+        trade_by_transition=trade_by_transition,
+        reference=load_reference(settings.reference_file, required_ids),
+    )
+
+
+def run_pipeline(settings: Settings) -> dict[str, str]:
+    inputs = load_run_inputs(settings)
+    route = inputs.route
+    stages = inputs.stages
+    production = inputs.production
+    trade_by_transition = inputs.trade_by_transition
+    result = build_flow_graph(settings, route, production, inputs.reference, trade_by_transition)
     balance_check = _verify_balance(result.balance_rows, result.stage_rows)
+    bands = monte_carlo_bands(settings, inputs) if settings.monte_carlo_draws else None
     figure = make_figure(
-        nodes=result.nodes,
-        links=result.links,
+        graph=result.graph,
         stages=stages,
         metal=settings.metal,
         route=route.key,
@@ -453,6 +553,7 @@ def run_pipeline(settings: Settings) -> dict[str, str]:
         flow_transparency_threshold=settings.flow_transparency_threshold,
         node_transparency_threshold=settings.node_transparency_threshold,
         preserved_country_ids=settings.preserved_country_ids,
+        node_annotations=bands.hover_annotations() if bands is not None and settings.uncertainty_hover else None,
     )
 
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
@@ -468,6 +569,10 @@ def run_pipeline(settings: Settings) -> dict[str, str]:
     run_directory.mkdir(parents=True, exist_ok=False)
     output_image = run_directory / f"{basename}.png"
     paths = _output_paths(output_image)
+    if bands is None:
+        del paths["uncertainty"]
+    if result.sensitivity_rows is None:
+        del paths["sensitivity"]
     try:
         figure.write_image(
             str(output_image),
@@ -497,12 +602,17 @@ def run_pipeline(settings: Settings) -> dict[str, str]:
     _write_csv(result.conversion_rows, CONVERSION_COLUMNS, paths["conversion"])
     _write_csv(result.balance_rows, BALANCE_COLUMNS, paths["balance"])
     _write_csv(result.stage_rows, STAGE_COLUMNS, paths["stage"])
+    if result.sensitivity_rows is not None:
+        _write_csv(result.sensitivity_rows, SENSITIVITY_COLUMNS, paths["sensitivity"])
     _write_csv(production.sheet_summary_rows, PRODUCTION_SHEET_COLUMNS, paths["production_sheets"])
     ignored_frame = pd.DataFrame(
         list(production.ignored_rows),
         columns=["stage", "file", "sheet", "description", "reason"],
     )
     ignored_frame.to_csv(paths["ignored"], index=False, encoding="utf-8-sig")
+    if bands is not None:
+        labels = {node.key: node.hover for node in result.graph.nodes}
+        bands.frame(settings, route.key, labels).to_csv(paths["uncertainty"], index=False, encoding="utf-8-sig")
     manifest = {
         "metal": settings.metal,
         "year": settings.year,
@@ -552,14 +662,24 @@ def run_pipeline(settings: Settings) -> dict[str, str]:
         "post_trade_products": settings.post_trade_products,
         "display_stages": [{"key": stage.key, "label": stage.label} for stage in stages],
         "trade_record_counts": {
-            transition: len(records) for transition, records in trade_by_transition.items()
+            transition: len(table) for transition, table in trade_by_transition.items()
         },
         "ignored_production_rows": len(production.ignored_rows),
         "nodes": len(result.nodes),
-        "links_before_render_aggregation": len(result.links),
+        "links_before_render_aggregation": result.graph.link_count,
         "conversion_rows": len(result.conversion_rows),
         "balance_rows": len(result.balance_rows),
         "stage_material_flow_rows": len(result.stage_rows),
+        "factor_sensitivity_rows": (
+            len(result.sensitivity_rows) if result.sensitivity_rows is not None else None
+        ),
+        "monte_carlo": {
+            "draws": settings.monte_carlo_draws,
+            "seed": settings.monte_carlo_seed,
+            "factor_distributions": settings.factor_distributions,
+            "production_distributions": settings.production_distributions,
+            "percentiles": list(settings.uncertainty_percentiles),
+        } if bands is not None else None,
         "label_font_size": settings.label_font_size,
         "image_background": "#FFFFFF",
         "balance_verification": balance_check,
@@ -0,0 +1,184 @@
+"""Array-backed form of ``ProductionData`` for the flow builders.
+
+``compact_production`` maps every country id that appears in the production
+totals or chemistry tables to a dense position once per run. Each stage's
+totals and each chemistry's values become one float vector over those
+positions, and "country has a row for this stage" becomes a boolean mask, so
+the builders can work on whole stages with NumPy instead of per-country dict
+lookups.
+
+The dict-shaped accessors (``totals``, ``stage_chemistry``,
+``cathode_chemistry``) return read-only ``{country_id: value}`` views with the
+same keys and values as the source dictionaries, so code written against
+``ProductionData`` keeps working while the builders move over piece by piece.
+Views iterate in ascending country id.
+"""
+from __future__ import annotations
+
+from collections.abc import Iterator, Mapping
+from dataclasses import dataclass
+from typing import Any
+
+import numpy as np
+
+from models import ProductionData
+
+
+@dataclass(frozen=True)
+class CountryIndex:
+    """Sorted country ids and their dense positions."""
+
+    ids: Any
+    positions: dict[int, int]
+
+    @classmethod
+    def from_ids(cls, country_ids: Any) -> "CountryIndex":
+        ids = np.unique(np.asarray(list(country_ids), dtype=np.int64))
+        return cls(ids=ids, positions={int(country_id): position for position, country_id in enumerate(ids.tolist())})
+
+    def __len__(self) -> int:
+        return int(len(self.ids))
+
+    def position(self, country_id: int) -> int | None:
+        return self.positions.get(int(country_id))
+
+    def vector(self, mapping: Mapping[int, float]) -> tuple[Any, Any]:
+        """Dense ``(values, mask)`` for a ``{country_id: value}`` mapping."""
+        values = np.zeros(len(self), dtype=float)
+        mask = np.zeros(len(self), dtype=bool)
+        if mapping:
+            positions = np.fromiter((self.positions[int(key)] for key in mapping), dtype=np.intp, count=len(mapping))
+            values[positions] = np.fromiter((float(value) for value in mapping.values()), dtype=float, count=len(mapping))
+            mask[positions] = True
+        return values, mask
+
+
+class CountryVector(Mapping):
+    """Read-only ``{country_id: value}`` view of one dense vector."""
+
+    def __init__(self, index: CountryIndex, values: Any, mask: Any) -> None:
+        self.index = index
+        self.data = values
+        self.mask = mask
+        self._ids: list[int] | None = None
+
+    def _keys(self) -> list[int]:
+        if self._ids is None:
+            self._ids = self.index.ids[self.mask].tolist()
+        return self._ids
+
+    def __getitem__(self, country_id: int) -> float:
+        position = self.index.positions.get(country_id) if isinstance(country_id, (int, np.integer)) else None
+        if position is None or not self.mask[position]:
+            raise KeyError(country_id)
+        return float(self.data[position])
+
+    def __contains__(self, country_id: object) -> bool:
+        position = self.index.positions.get(country_id) if isinstance(country_id, (int, np.integer)) else None
+        return position is not None and bool(self.mask[position])
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._keys())
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self.mask))
+
+
+def _chemistry_vectors(
+    index: CountryIndex,
+    tables: Mapping[str, Mapping[int, float]],
+) -> dict[str, tuple[Any, Any]]:
+    return {chemistry: index.vector(mapping) for chemistry, mapping in tables.items()}
+
+
+@dataclass(frozen=True)
+class ProductionArrays:
+    """Stage totals and chemistry tables as vectors over one ``CountryIndex``.
+
+    ``stage_totals[i]`` and ``stage_members[i]`` are the totals and membership
+    mask for ``stages[i]``. ``chemistry_values[stage][chemistry]`` is a
+    ``(values, mask)`` pair; ``cathode_values`` holds the legacy
+    ``cathode_chemistry`` table the same way.
+    """
+
+    index: CountryIndex
+    stages: tuple[str, ...]
+    stage_totals: Any
+    stage_members: Any
+    chemistry_values: dict[str, dict[str, tuple[Any, Any]]]
+    cathode_values: dict[str, tuple[Any, Any]]
+    labels: dict[int, str]
+    ignored_rows: tuple[dict[str, Any], ...] = ()
+    sheet_summary_rows: tuple[dict[str, Any], ...] = ()
+
+    def stage_position(self, stage: str) -> int:
+        try:
+            return self.stages.index(stage)
+        except ValueError:
+            raise KeyError(stage) from None
+
+    def totals_of(self, stage: str) -> Any:
+        return self.stage_totals[self.stage_position(stage)]
+
+    def members_of(self, stage: str) -> Any:
+        return self.stage_members[self.stage_position(stage)]
+
+    def member_ids(self, stage: str) -> set[int]:
+        return set(self.index.ids[self.members_of(stage)].tolist())
+
+    @property
+    def totals(self) -> dict[str, CountryVector]:
+        return {
+            stage: CountryVector(self.index, self.stage_totals[position], self.stage_members[position])
+            for position, stage in enumerate(self.stages)
+        }
+
+    @property
+    def stage_chemistry(self) -> dict[str, dict[str, CountryVector]]:
+        return {
+            stage: {
+                chemistry: CountryVector(self.index, values, mask)
+                for chemistry, (values, mask) in tables.items()
+            }
+            for stage, tables in self.chemistry_values.items()
+        }
+
+    @property
+    def cathode_chemistry(self) -> dict[str, CountryVector]:
+        return {
+            chemistry: CountryVector(self.index, values, mask)
+            for chemistry, (values, mask) in self.cathode_values.items()
+        }
+
+
+def compact_production(production: ProductionData) -> ProductionArrays:
+    """Build the array-backed form of one run's production data."""
+    country_ids: set[int] = set()
+    for mapping in production.totals.values():
+        country_ids.update(mapping)
+    for tables in production.stage_chemistry.values():
+        for mapping in tables.values():
+            country_ids.update(mapping)
+    for mapping in production.cathode_chemistry.values():
+        country_ids.update(mapping)
+    index = CountryIndex.from_ids(country_ids)
+
+    stages = tuple(production.totals)
+    stage_totals = np.zeros((len(stages), len(index)), dtype=float)
+    stage_members = np.zeros((len(stages), len(index)), dtype=bool)
+    for position, stage in enumerate(stages):
+        stage_totals[position], stage_members[position] = index.vector(production.totals[stage])
+    return ProductionArrays(
+        index=index,
+        stages=stages,
+        stage_totals=stage_totals,
+        stage_members=stage_members,
+        chemistry_values={
+            stage: _chemistry_vectors(index, tables)
+            for stage, tables in production.stage_chemistry.items()
+        },
+        cathode_values=_chemistry_vectors(index, production.cathode_chemistry),
+        labels=production.labels,
+        ignored_rows=production.ignored_rows,
+        sheet_summary_rows=production.sheet_summary_rows,
+    )
@@ -0,0 +1,301 @@
+"""Parsed-workbook cache for production sources.
+
+Every production workbook (bundled USGS and Ma 2026 files, SCInsight and
+Benchmark uploads, and legacy one-workbook-per-stage folders) is parsed once
+into a normalized long form:
+
+* ``rows``: one record per worksheet row with ``sheet``, ``row``, ``metal``,
+  ``stage``, ``status``, ``id``, ``desc`` and ``product``;
+* ``values``: one record per row and year column with ``sheet``, ``row``,
+  ``year`` and ``value``.
+
+Joined on (sheet, row) they form the (metal, stage, status, id, desc, product,
+year, value) table. Parsed workbooks are kept in memory, keyed by the
+SHA-256 of the file contents, so re-uploading identical bytes does not parse
+the workbook again. With ``persist``, the parsed form is also pickled to
+``_parsed/<sha256>.pkl`` beside the workbook, so restarting a worker does not
+parse it again. ``load_production`` persists the configured production roots
+except upload-backed sources, which are only cached in memory; the web
+inventory persists the bundled sources. Both read workbooks through
+``load_workbook``, and
+``forget_workbook`` drops a workbook's cache entries when it is removed.
+"""
+from __future__ import annotations
+
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import pandas as pd
+
+
+CACHE_DIRECTORY = "_parsed"
+CACHE_FORMAT = 1
+MEMORY_ENTRIES = 16
+DIGEST_ENTRIES = 64
+SHEET_PATTERN = re.compile(
+    r"^(lithium|cobalt|nickel|manganese)_(mining|processing|refining|pro_ref|pcam|cathode|battery)$",
+    re.IGNORECASE,
+)
+ROW_COLUMNS = ["sheet", "row", "metal", "stage", "status", "id", "desc", "product"]
+VALUE_COLUMNS = ["sheet", "row", "year", "value"]
+
+_WORKBOOKS: OrderedDict[str, "ParsedWorkbook"] = OrderedDict()
+_DIGESTS: OrderedDict[Path, tuple[int, int, str]] = OrderedDict()
+_LOCK = threading.Lock()
+
+
+@dataclass(frozen=True)
+class ParsedSheet:
+    name: str
+    columns: tuple[Any, ...]
+    row_count: int
+    statuses: tuple[str, ...]
+
+
+@dataclass(frozen=True)
+class ParsedWorkbook:
+    digest: str
+    sheets: dict[str, ParsedSheet]
+    rows: pd.DataFrame
+    values: pd.DataFrame
+
+    @property
+    def sheet_names(self) -> list[str]:
+        return list(self.sheets)
+
+    def frame(self, sheet_name: str, year: int | None = None) -> pd.DataFrame:
+        """Rebuild one sheet as ``load_production`` reads it.
+
+        The frame has the normalized ``id``, ``Desc``, ``Product`` and
+        ``status`` columns that the sheet provides, plus the column for
+        ``year`` when the sheet has one.
+        """
+        sheet = self.sheets[sheet_name]
+        columns = set(_normalized_names(sheet.columns))
+        rows = self.rows.loc[self.rows["sheet"].eq(sheet_name)]
+        frame = pd.DataFrame(index=pd.RangeIndex(sheet.row_count))
+        for name, source in (("id", "id"), ("Desc", "desc"), ("Product", "product"), ("status", "status")):
+            if name in columns:
+                frame[name] = rows[source].to_numpy()
+        year_label = _year_label(sheet.columns, year) if year is not None else None
+        if year_label is not None:
+            values = self.values.loc[
+                self.values["sheet"].eq(sheet_name) & self.values["year"].eq(int(year))
+            ]
+            frame[year_label] = values["value"].to_numpy()
+        return frame
+
+
+def _normalized_names(columns: tuple[Any, ...]) -> list[Any]:
+    """Column names after the aliases ``load_production`` has always accepted."""
+    present = set(columns)
+    aliases = {}
+    if "Desc" not in present and "reporterDesc" in present:
+        aliases["reporterDesc"] = "Desc"
+    if "Product" not in present and "product" in present:
+        aliases["product"] = "Product"
+    if "status" not in present and "Status" in present:
+        aliases["Status"] = "status"
+    return [aliases.get(column, column) for column in columns]
+
+
+def _year_label(columns: tuple[Any, ...], year: int) -> Any:
+    for column in columns:
+        try:
+            if int(column) == int(year):
+                return column
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def _year_columns(columns: tuple[Any, ...]) -> dict[int, Any]:
+    years: dict[int, Any] = {}
+    for column in columns:
+        try:
+            year = int(column)
+        except (TypeError, ValueError):
+            continue
+        years.setdefault(year, column)
+    return years
+
+
+def _metal_stage(path: Path, sheet_name: str) -> tuple[str, str]:
+    match = SHEET_PATTERN.fullmatch(sheet_name.strip()) or SHEET_PATTERN.fullmatch(path.stem.strip())
+    if match is None:
+        return "", ""
+    return match.group(1).casefold(), match.group(2).casefold()
+
+
+def _inventory_statuses(frame: pd.DataFrame) -> tuple[str, ...]:
+    status_column = next(
+        (column for column in frame.columns if str(column).strip().casefold() == "status"),
+        None,
+    )
+    if status_column is None:
+        return ()
+    return tuple(
+        sorted(
+            {str(value).strip() for value in frame[status_column].dropna() if str(value).strip()},
+            key=str.casefold,
+        )
+    )
+
+
+def _row_values(frame: pd.DataFrame, name: str, numeric: bool = False) -> Any:
+    if name not in frame.columns:
+        return float("nan")
+    if numeric:
+        return pd.to_numeric(frame[name], errors="coerce").to_numpy()
+    return frame[name].to_numpy(dtype=object)
+
+
+def parse_workbook(path: Path, digest: str) -> ParsedWorkbook:
+    """Parse every worksheet of one workbook into the normalized long form."""
+    with pd.ExcelFile(path) as excel:
+        frames = pd.read_excel(excel, sheet_name=excel.sheet_names)
+    sheets: dict[str, ParsedSheet] = {}
+    row_parts: list[pd.DataFrame] = []
+    value_parts: list[pd.DataFrame] = []
+    for sheet_name, frame in frames.items():
+        columns = tuple(frame.columns)
+        sheets[sheet_name] = ParsedSheet(
+            name=sheet_name,
+            columns=columns,
+            row_count=int(len(frame)),
+            statuses=_inventory_statuses(frame),
+        )
+        normalized = frame.set_axis(_normalized_names(columns), axis=1)
+        metal, stage = _metal_stage(Path(path), sheet_name)
+        row_numbers = range(len(frame))
+        row_parts.append(
+            pd.DataFrame(
+                {
+                    "sheet": sheet_name,
+                    "row": row_numbers,
+                    "metal": metal,
+                    "stage": stage,
+                    "status": _row_values(normalized, "status"),
+                    "id": _row_values(normalized, "id", numeric=True),
+                    "desc": _row_values(normalized, "Desc"),
+                    "product": _row_values(normalized, "Product"),
+                },
+                columns=ROW_COLUMNS,
+            )
+        )
+        for year, label in _year_columns(columns).items():
+            value_parts.append(
+                pd.DataFrame(
+                    {
+                        "sheet": sheet_name,
+                        "row": row_numbers,
+                        "year": year,
+                        "value": pd.to_numeric(frame[label], errors="coerce").to_numpy(dtype=float),
+                    },
+                    columns=VALUE_COLUMNS,
+                )
+            )
+    rows = pd.concat(row_parts, ignore_index=True) if row_parts else pd.DataFrame(columns=ROW_COLUMNS)
+    values = pd.concat(value_parts, ignore_index=True) if value_parts else pd.DataFrame(columns=VALUE_COLUMNS)
+    return ParsedWorkbook(digest=digest, sheets=sheets, rows=rows, values=values)
+
+
+def content_digest(path: Path) -> str:
+    """SHA-256 of a workbook, recomputed only when its size or mtime changes."""
+    path = Path(path)
+    stat = path.stat()
+    with _LOCK:
+        known = _DIGESTS.get(path)
+        if known is not None and known[:2] == (stat.st_mtime_ns, stat.st_size):
+            _DIGESTS.move_to_end(path)
+            return known[2]
+    digest = hashlib.sha256(path.read_bytes()).hexdigest()
+    with _LOCK:
+        _DIGESTS[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        _DIGESTS.move_to_end(path)
+        while len(_DIGESTS) > DIGEST_ENTRIES:
+            _DIGESTS.popitem(last=False)
+    return digest
+
+
+def _read_persisted(cache_path: Path, digest: str) -> ParsedWorkbook | None:
+    try:
+        payload = pd.read_pickle(cache_path)
+    except Exception:
+        # A missing, truncated, or incompatible cache file is simply reparsed.
+        return None
+    if not isinstance(payload, dict) or payload.get("format") != CACHE_FORMAT:
+        return None
+    workbook = payload.get("workbook")
+    if not isinstance(workbook, ParsedWorkbook) or workbook.digest != digest:
+        return None
+    return workbook
+
+
+def _persist(cache_path: Path, workbook: ParsedWorkbook) -> None:
+    try:
+        cache_path.parent.mkdir(exist_ok=True)
+        temporary = cache_path.with_name(f".{cache_path.name}.tmp")
+        pd.to_pickle({"format": CACHE_FORMAT, "workbook": workbook}, temporary)
+        temporary.replace(cache_path)
+    except OSError:
+        # A read-only data folder still gets the in-memory cache.
+        pass
+
+
+def load_workbook(path: Path, persist: bool = False) -> ParsedWorkbook:
+    """Return the parsed form of a production workbook, parsing it at most once.
+
+    With ``persist``, the parse is also read from and written to ``_parsed``
+    beside the workbook.
+    """
+    path = Path(path)
+    digest = content_digest(path)
+    with _LOCK:
+        workbook = _WORKBOOKS.get(digest)
+        if workbook is not None:
+            _WORKBOOKS.move_to_end(digest)
+            return workbook
+    cache_path = path.parent / CACHE_DIRECTORY / f"{digest}.pkl"
+    workbook = _read_persisted(cache_path, digest) if persist else None
+    if workbook is None:
+        workbook = parse_workbook(path, digest)
+        if persist:
+            _persist(cache_path, workbook)
+    with _LOCK:
+        _WORKBOOKS[digest] = workbook
+        while len(_WORKBOOKS) > MEMORY_ENTRIES:
+            _WORKBOOKS.popitem(last=False)
+    return workbook
+
+
+def forget_workbook(path: Path) -> None:
+    """Drop ``path``'s digest and the pickle persisted for it, before it is deleted.
+
+    The parsed workbook stays in the in-memory LRU, which other paths with the
+    same contents may still share.
+    """
+    path = Path(path)
+    digest = content_digest(path) if path.is_file() else None
+    with _LOCK:
+        _DIGESTS.pop(path, None)
+    if digest is None:
+        return
+    cache_directory = path.parent / CACHE_DIRECTORY
+    (cache_directory / f"{digest}.pkl").unlink(missing_ok=True)
+    try:
+        cache_directory.rmdir()
+    except OSError:
+        # Missing, or still holding pickles of other workbooks.
+        pass
+
+
+def clear_workbook_cache() -> None:
+    with _LOCK:
+        _WORKBOOKS.clear()
+        _DIGESTS.clear()
@@ -1,11 +1,12 @@
 from __future__ import annotations
 
 from collections import defaultdict
+from dataclasses import replace
 from typing import Iterable
 
 import plotly.graph_objects as go
 
-from models import EPSILON, DisplayStage, LinkSpec, NodeSpec
+from models import EPSILON, DisplayStage, LinkSpec, NodeSpec, SankeyGraph
 
 
 REGION_ORDER = ["Africa", "Asia", "Europe", "North America", "South America", "Oceania", "Antarctica", "Unknown"]
@@ -31,34 +32,6 @@ def _safe_token(value: str) -> str:
     return "".join(character if character.isalnum() else "-" for character in str(value))
 
 
-def _aggregate_links(links: Iterable[LinkSpec]) -> list[LinkSpec]:
-    grouped: dict[tuple[str, str, str], float] = defaultdict(float)
-    for link in links:
-        if link.value > EPSILON:
-            grouped[(link.source, link.target, link.color)] += float(link.value)
-    return [
-        LinkSpec(source=source, target=target, value=value, color=color)
-        for (source, target, color), value in grouped.items()
-        if value > EPSILON
-    ]
-
-
-def _prune(nodes: dict[str, NodeSpec], links: list[LinkSpec]) -> tuple[dict[str, NodeSpec], list[LinkSpec]]:
-    connected = {link.source for link in links} | {link.target for link in links}
-    visible_nodes = {key: node for key, node in nodes.items() if key in connected}
-    visible_links = [link for link in links if link.source in visible_nodes and link.target in visible_nodes]
-    return visible_nodes, visible_links
-
-
-def _node_values(nodes: dict[str, NodeSpec], links: list[LinkSpec]) -> dict[str, float]:
-    incoming: dict[str, float] = defaultdict(float)
-    outgoing: dict[str, float] = defaultdict(float)
-    for link in links:
-        outgoing[link.source] += link.value
-        incoming[link.target] += link.value
-    return {key: max(incoming.get(key, 0.0), outgoing.get(key, 0.0)) for key in nodes}
-
-
 def _node_country_id(key: str) -> int | None:
     parts = str(key).split(":")
     for marker in ("country", "chem"):
@@ -74,9 +47,43 @@ def _node_country_id(key: str) -> int | None:
     return None
 
 
-def _is_preserved_country_node(key: str, preserved_country_ids: frozenset[int]) -> bool:
-    country_id = _node_country_id(key)
-    return country_id is not None and country_id in preserved_country_ids
+def _graph_from_specs(nodes: dict[str, NodeSpec], links: Iterable[LinkSpec]) -> SankeyGraph:
+    """Index string-keyed nodes and sum their links per (source, target, colour).
+
+    Nodes without a ``country_id`` get the one encoded in their key.
+    """
+    specs = [
+        node if node.country_id is not None else replace(node, country_id=_node_country_id(key))
+        for key, node in nodes.items()
+    ]
+    node_ids = {key: node_id for node_id, key in enumerate(nodes)}
+    grouped: dict[tuple[int, int, str], float] = defaultdict(float)
+    link_count = 0
+    for link in links:
+        link_count += 1
+        if link.value > EPSILON and link.source in node_ids and link.target in node_ids:
+            grouped[(node_ids[link.source], node_ids[link.target], link.color)] += float(link.value)
+    summed = [(key, value) for key, value in grouped.items() if value > EPSILON]
+    return SankeyGraph(
+        nodes=tuple(specs),
+        sources=tuple(source for (source, _, _), _ in summed),
+        targets=tuple(target for (_, target, _), _ in summed),
+        values=tuple(value for _, value in summed),
+        colors=tuple(color for (_, _, color), _ in summed),
+        link_count=link_count,
+    )
+
+
+def _node_values(graph: SankeyGraph) -> dict[int, float]:
+    incoming: dict[int, float] = defaultdict(float)
+    outgoing: dict[int, float] = defaultdict(float)
+    for source, target, value in zip(graph.sources, graph.targets, graph.values):
+        outgoing[source] += value
+        incoming[target] += value
+    return {
+        node_id: max(incoming.get(node_id, 0.0), outgoing.get(node_id, 0.0))
+        for node_id in sorted(set(incoming) | set(outgoing))
+    }
 
 
 def _region_rank(region: str) -> tuple[int, str]:
@@ -88,11 +95,11 @@ def _region_rank(region: str) -> tuple[int, str]:
 
 def _stage_order(
     stage: str,
-    keys: list[str],
-    nodes: dict[str, NodeSpec],
-    values: dict[str, float],
+    keys: list[int],
+    nodes: tuple[NodeSpec, ...],
+    values: dict[int, float],
     sort_mode: str,
-) -> list[str]:
+) -> list[int]:
     source_special = [key for key in keys if nodes[key].kind == "source_special"]
     regular = [key for key in keys if nodes[key].kind == "regular"]
     sink_special = [key for key in keys if nodes[key].kind == "sink_special"]
@@ -111,8 +118,9 @@ def _stage_order(
 
 def make_figure(
     *,
-    nodes: dict[str, NodeSpec],
-    links: Iterable[LinkSpec],
+    nodes: dict[str, NodeSpec] | None = None,
+    links: Iterable[LinkSpec] = (),
+    graph: SankeyGraph | None = None,
     stages: tuple[DisplayStage, ...],
     metal: str,
     route: str,
@@ -123,7 +131,9 @@ def make_figure(
     flow_transparency_threshold: float = 0.0,
     node_transparency_threshold: float = 0.0,
     preserved_country_ids: frozenset[int] = frozenset(),
+    node_annotations: dict[str, str] | None = None,
 ) -> go.Figure:
+    """Lay out and style the Sankey; ``node_annotations`` adds ``{node key: text}`` lines to node hovers."""
     if reference_quantity <= 0:
         raise ValueError("REFERENCE_QUANTITY must be greater than zero.")
     if theme not in {"dark", "light"}:
@@ -134,10 +144,12 @@ def make_figure(
         raise ValueError("LABEL_FONT_SIZE must be greater than zero.")
     if flow_transparency_threshold < 0 or node_transparency_threshold < 0:
         raise ValueError("Transparency thresholds must be non-negative.")
-    aggregated = _aggregate_links(links)
-    visible_nodes, visible_links = _prune(nodes, aggregated)
-    if not visible_links:
+    if graph is None:
+        graph = _graph_from_specs(nodes or {}, links)
+    if not graph.values:
         raise ValueError("No Sankey links were generated for the selected configuration.")
+    nodes = graph.nodes
+    annotations = node_annotations or {}
 
     stage_keys = [stage.key for stage in stages]
     if len(stage_keys) == 1:
@@ -147,17 +159,18 @@ def make_figure(
             stage: 0.06 + index * (0.84 / (len(stage_keys) - 1))
             for index, stage in enumerate(stage_keys)
         }
-    values = _node_values(visible_nodes, visible_links)
-    grouped: dict[str, list[str]] = defaultdict(list)
-    for key, node in visible_nodes.items():
-        grouped[node.stage].append(key)
+    # Nodes without links are pruned: only linked node ids have a value.
+    values = _node_values(graph)
+    grouped: dict[str, list[int]] = defaultdict(list)
+    for node_id in values:
+        grouped[nodes[node_id].stage].append(node_id)
     ordered_by_stage = {
-        stage: _stage_order(stage, grouped.get(stage, []), visible_nodes, values, sort_mode)
+        stage: _stage_order(stage, grouped.get(stage, []), nodes, values, sort_mode)
         for stage in stage_keys
     }
 
     px_per_unit = REFERENCE_NODE_HEIGHT_PX / max(reference_quantity, 1.0)
-    node_heights: dict[str, float] = {}
+    node_heights: dict[int, float] = {}
     stage_heights: dict[str, float] = {}
     for stage in stage_keys:
         total_height = 0.0
@@ -173,7 +186,7 @@ def make_figure(
     figure_height = int(max(MIN_STAGE_HEIGHT_PX, content_height + TOP_BAND_PX + BOTTOM_BAND_PX))
     plot_height = float(figure_height - TOP_BAND_PX - BOTTOM_BAND_PX)
 
-    ordered_keys: list[str] = []
+    ordered_keys: list[int] = []
     x_positions: list[float] = []
     y_positions: list[float] = []
     for stage in stage_keys:
@@ -186,22 +199,22 @@ def make_figure(
             current_y += node_heights[key] + GAP_PX
 
     key_to_index = {key: index for index, key in enumerate(ordered_keys)}
+    preserved_nodes = {
+        node_id for node_id in values if nodes[node_id].country_id in preserved_country_ids
+    }
     hidden_node_keys = {
         key
         for key in ordered_keys
-        if visible_nodes[key].kind == "regular"
+        if nodes[key].kind == "regular"
         and values.get(key, 0.0) < node_transparency_threshold
-        and not _is_preserved_country_node(key, preserved_country_ids)
+        and key not in preserved_nodes
     }
 
-    def link_color(link: LinkSpec) -> str:
-        preserved = (
-            _is_preserved_country_node(link.source, preserved_country_ids)
-            or _is_preserved_country_node(link.target, preserved_country_ids)
-        )
-        if link.value < flow_transparency_threshold and not preserved:
+    def link_color(source: int, target: int, value: float, color: str) -> str:
+        preserved = source in preserved_nodes or target in preserved_nodes
+        if value < flow_transparency_threshold and not preserved:
             return TRANSPARENT_COLOR
-        return link.color
+        return color
     plot_domain_top = TOP_BAND_PX / figure_height
     plot_domain_bottom = 1.0 - (BOTTOM_BAND_PX / figure_height)
     reference_bottom_px = TOP_BAND_PX + content_height
@@ -215,29 +228,33 @@ def make_figure(
 
     figure = go.Figure(
         go.Sankey(
-            ids=[_safe_token(key) for key in ordered_keys],
+            ids=[_safe_token(nodes[key].key) for key in ordered_keys],
             uid=_safe_token(f"{metal}-{route}"),
             arrangement="fixed",
             domain={"x": [0.0, 1.0], "y": [plot_domain_top, plot_domain_bottom]},
             node={
-                "label": ["" if key in hidden_node_keys else visible_nodes[key].label for key in ordered_keys],
+                "label": ["" if key in hidden_node_keys else nodes[key].label for key in ordered_keys],
                 "x": x_positions,
                 "y": y_positions,
                 "pad": PLOTLY_NODE_PAD_PX,
                 "thickness": 20,
                 "line": {"color": "rgba(0,0,0,0)", "width": 0},
-                "color": [TRANSPARENT_COLOR if key in hidden_node_keys else visible_nodes[key].color for key in ordered_keys],
+                "color": [TRANSPARENT_COLOR if key in hidden_node_keys else nodes[key].color for key in ordered_keys],
                 "customdata": [
-                    f"{visible_nodes[key].hover}<br>{values.get(key, 0.0):,.0f} t"
+                    f"{nodes[key].hover}<br>{values.get(key, 0.0):,.0f} t"
+                    + (f"<br>{annotations[nodes[key].key]}" if nodes[key].key in annotations else "")
                     for key in ordered_keys
                 ],
                 "hovertemplate": "%{customdata}<extra></extra>",
             },
             link={
-                "source": [key_to_index[link.source] for link in visible_links],
-                "target": [key_to_index[link.target] for link in visible_links],
-                "value": [link.value for link in visible_links],
-                "color": [link_color(link) for link in visible_links],
+                "source": [key_to_index[source] for source in graph.sources],
+                "target": [key_to_index[target] for target in graph.targets],
+                "value": list(graph.values),
+                "color": [
+                    link_color(*link)
+                    for link in zip(graph.sources, graph.targets, graph.values, graph.colors)
+                ],
             },
         )
     )
@@ -0,0 +1,349 @@
+"""Analytic sensitivity of production-basis node sizes to the HS conversion factors.
+
+Every quantity ``_prepare_trade_records`` and the material balance produce is
+piecewise linear in the factors, so the derivatives follow from the same
+arrays the builder has just filled:
+
+* a row's converted quantity is ``raw * factor``, so it moves by ``raw`` per
+  unit of its own HS factor (rows weighted by ``CHEMISTRY_CONVERSION_FACTORS``
+  do not move with any HS factor);
+* a capped exporter's rows are ``raw * factor * available / total``; where the
+  cap binds, a factor moves a row by ``multiplier * d(converted)`` less the
+  row's share ``final / total`` of the exporter total's change, and where it
+  does not bind the row moves like its converted quantity;
+* domestic remainders, unknown-source gaps and unknown-destination surpluses
+  are ``max(x, 0)`` of linear quantities, and node sizes the larger of inflow
+  and outflow.
+
+At a kink (an exporter total exactly at its available production, a
+remainder, gap or surplus exactly at zero, or equal inflow and outflow) the
+derivatives for a rising and a falling factor can differ. Both are carried
+through to the nodes; the reported derivative is the one for a rising factor,
+and a node is flagged ``at_kink`` only where the two differ. Nodes are
+reported at country level, with the keys of ``NODE_VIEW = "country"``.
+"""
+from __future__ import annotations
+
+from collections.abc import Mapping, Sequence
+from dataclasses import dataclass
+from typing import Any
+
+import numpy as np
+
+from material_balance import TransitionBalance
+from models import EPSILON, TransitionSpec
+from production_arrays import CountryIndex
+from trade_table import (
+    NON_SOURCE_TO_PRODUCER,
+    PRODUCER_TO_NON_TARGET,
+    PRODUCER_TO_PRODUCER,
+    TradeTable,
+)
+
+
+# Relative tolerance for "exporter total equals available production".
+CAP_KINK_TOLERANCE = 1e-9
+
+
+@dataclass(frozen=True)
+class TransitionSensitivity:
+    """Country-level links of one transition with their factor derivatives.
+
+    ``derivatives[k, j]`` and ``falling[k, j]`` are the changes of link ``k``
+    per unit of ``hs_codes[j]``'s factor as the factor rises and falls; they
+    differ only at kinks. ``nodes`` maps each node key to its stage key and
+    country id (``None`` for special nodes).
+    """
+
+    transition: str
+    hs_codes: tuple[str, ...]
+    factors: Any
+    nodes: dict[str, tuple[str, int | None]]
+    sources: tuple[str, ...]
+    targets: tuple[str, ...]
+    values: Any
+    derivatives: Any
+    falling: Any
+
+
+def _column_sums(positions: Any, matrix: Any, size: int) -> Any:
+    """Per-position sums of each column of ``matrix``."""
+    sums = np.zeros((size, matrix.shape[1]))
+    for column in range(matrix.shape[1]):
+        sums[:, column] = np.bincount(positions, weights=matrix[:, column], minlength=size)
+    return sums
+
+
+def _clipped_change(value: Any, derivative: Any, rising: bool) -> Any:
+    """One-sided derivative of ``max(value, 0)`` for a rising or falling factor."""
+    at_zero = np.maximum(derivative, 0.0) if rising else np.minimum(derivative, 0.0)
+    return np.where(value > EPSILON, derivative, np.where(np.abs(value) <= EPSILON, at_zero, 0.0))
+
+
+def _row_derivatives(table: TradeTable) -> tuple[Any, Any, Any, Any]:
+    """``d final / d factor`` per row and HS code for a rising and a falling factor.
+
+    Also returns, for each side, the rows whose exporter cap binds.
+    """
+    count = len(table)
+    raw = table.raw_quantity_tonnes
+    free = np.flatnonzero(table.chemistry_factor_basis == "")
+    converted = np.zeros((count, len(table.hs_codes)))
+    converted[free, table.hs_index[free]] = raw[free]
+    _, exporter_group = np.unique(table.exporter_id, return_inverse=True)
+    exporter_group = exporter_group.reshape(-1)
+    exporter_change = _column_sums(exporter_group, converted, int(exporter_group.max(initial=-1)) + 1)[exporter_group]
+
+    totals = table.exporter_total_before_scaling
+    available = table.available_source_production
+    multiplier = table.production_scaling_multiplier
+    source_producer = np.isin(table.classification_code, (PRODUCER_TO_PRODUCER, PRODUCER_TO_NON_TARGET))
+    capped = source_producer & (totals > EPSILON)
+    cap_kink = capped & np.isclose(available, totals, rtol=CAP_KINK_TOLERANCE, atol=EPSILON)
+    # At the kink the cap binds for a rising factor and not for a falling one.
+    rising_binding = capped & ((multiplier < 1.0) | cap_kink)
+    falling_binding = capped & (multiplier < 1.0) & ~cap_kink
+    share = table.final_trade_quantity_tonnes / np.where(capped, totals, 1.0)
+    bound = multiplier[:, None] * converted - share[:, None] * exporter_change
+    included = table.included_in_sankey
+    rising = np.where(rising_binding[:, None], bound, converted)
+    falling = np.where(falling_binding[:, None], bound, converted)
+    rising[~included] = 0.0
+    falling[~included] = 0.0
+    return rising, falling, rising_binding, falling_binding
+
+
+def transition_sensitivity(
+    transition: TransitionSpec,
+    table: TradeTable,
+    source_totals: Mapping[int, float],
+    target_totals: Mapping[int, float],
+    balance: TransitionBalance,
+) -> TransitionSensitivity:
+    """Link values and derivatives of one prepared production-basis transition."""
+    hs_count = len(table.hs_codes)
+    rising_rows, falling_rows, rising_binding, falling_binding = _row_derivatives(table)
+    codes = table.classification_code
+    included = table.included_in_sankey
+    index = CountryIndex.from_ids(
+        np.concatenate(
+            [
+                np.fromiter(source_totals, dtype=np.int64, count=len(source_totals)),
+                np.fromiter(target_totals, dtype=np.int64, count=len(target_totals)),
+                table.exporter_id,
+                table.importer_id,
+            ]
+        )
+    )
+    size = len(index)
+    exporter = np.searchsorted(index.ids, table.exporter_id)
+    importer = np.searchsorted(index.ids, table.importer_id)
+    exported = included & np.isin(codes, (PRODUCER_TO_PRODUCER, PRODUCER_TO_NON_TARGET))
+    imported = included & np.isin(codes, (PRODUCER_TO_PRODUCER, NON_SOURCE_TO_PRODUCER))
+
+    source, source_members = index.vector(source_totals)
+    target, target_members = index.vector(target_totals)
+    exports, _ = index.vector(balance.exports)
+    imports, _ = index.vector(balance.imports)
+    domestic, _ = index.vector(balance.domestic)
+    untraded, _ = index.vector(balance.untraded)
+    gap, _ = index.vector(balance.unknown_source)
+    surplus, _ = index.vector(balance.excess)
+    known_input = imports + domestic
+
+    def balance_changes(row_derivatives: Any, binding: Any, rising: bool) -> dict[str, Any]:
+        export_change = _column_sums(exporter[exported], row_derivatives[exported], size)
+        # A binding exporter ships exactly its production, so its total does not
+        # move; the summed row derivatives would only leave rounding noise.
+        export_change[exporter[exported & binding]] = 0.0
+        import_change = _column_sums(importer[imported], row_derivatives[imported], size)
+        remainder = _clipped_change((source - exports)[:, None], -export_change, rising)
+        remainder = np.where(source_members[:, None], remainder, 0.0)
+        known_change = import_change + np.where(target_members[:, None], remainder, 0.0)
+        return {
+            "rows": row_derivatives,
+            "remainder": remainder,
+            "gap": _clipped_change((target - known_input)[:, None], -known_change, rising),
+            "surplus": _clipped_change((known_input - target)[:, None], known_change, rising),
+        }
+
+    changes = (
+        balance_changes(rising_rows, rising_binding, True),
+        balance_changes(falling_rows, falling_binding, False),
+    )
+
+    source_stage = f"P:{transition.source_stage}"
+    post_stage = f"T:{transition.key}"
+    target_stage = f"P:{transition.target_stage}"
+    nodes: dict[str, tuple[str, int | None]] = {}
+
+    def country(stage: str, country_id: int) -> str:
+        key = f"{stage}:country:{country_id}"
+        nodes.setdefault(key, (stage, country_id))
+        return key
+
+    def special(stage: str, slug: str) -> str:
+        key = f"{stage}:special:{transition.key}_{slug}"
+        nodes.setdefault(key, (stage, None))
+        return key
+
+    non_target = special(post_stage, "non_target")
+    non_source = special(source_stage, "non_source")
+    unknown_source = special(source_stage, "unknown_source")
+    unknown_target = special(target_stage, "unknown_target")
+
+    sources: list[str] = []
+    targets: list[str] = []
+    values: list[Any] = []
+    derivatives: list[Any] = []
+    falling: list[Any] = []
+
+    def add(source_keys: list[str], target_keys: list[str], value: Any, change: Any) -> None:
+        """Append links; ``change(side)`` gives their derivatives from one side's ``changes``."""
+        sources.extend(source_keys)
+        targets.extend(target_keys)
+        values.append(np.asarray(value, dtype=float).reshape(len(source_keys)))
+        for side, block in zip(changes, (derivatives, falling)):
+            block.append(np.asarray(change(side), dtype=float).reshape(len(source_keys), hs_count))
+
+    kept = included & np.isin(codes, (PRODUCER_TO_PRODUCER, PRODUCER_TO_NON_TARGET, NON_SOURCE_TO_PRODUCER))
+    row_keys = np.stack([codes[kept].astype(np.int64), table.exporter_id[kept], table.importer_id[kept]], axis=1)
+    distinct, link = np.unique(row_keys, axis=0, return_inverse=True)
+    link = link.reshape(-1)
+    endpoints = [
+        (country(source_stage, exporter_id), country(post_stage, importer_id)) if code == PRODUCER_TO_PRODUCER
+        else (country(source_stage, exporter_id), non_target) if code == PRODUCER_TO_NON_TARGET
+        else (non_source, country(post_stage, importer_id))
+        for code, exporter_id, importer_id in distinct.tolist()
+    ]
+    add(
+        [source_key for source_key, _ in endpoints],
+        [target_key for _, target_key in endpoints],
+        np.bincount(link, weights=table.final_trade_quantity_tonnes[kept], minlength=len(distinct)),
+        lambda side: _column_sums(link, side["rows"][kept], len(distinct)),
+    )
+
+    ids = index.ids.tolist()
+    domestic_positions = np.flatnonzero(source_members & target_members)
+    untraded_positions = np.flatnonzero(source_members & ~target_members)
+    target_positions = np.flatnonzero(target_members)
+    add(
+        [country(source_stage, ids[position]) for position in domestic_positions],
+        [country(post_stage, ids[position]) for position in domestic_positions],
+        domestic[domestic_positions],
+        lambda side: side["remainder"][domestic_positions],
+    )
+    add(
+        [country(source_stage, ids[position]) for position in untraded_positions],
+        [non_target] * len(untraded_positions),
+        untraded[untraded_positions],
+        lambda side: side["remainder"][untraded_positions],
+    )
+    post_keys = [country(post_stage, ids[position]) for position in target_positions]
+    add(
+        [unknown_source] * len(target_positions),
+        post_keys,
+        gap[target_positions],
+        lambda side: side["gap"][target_positions],
+    )
+    add(
+        post_keys,
+        [country(target_stage, ids[position]) for position in target_positions],
+        np.where(target[target_positions] > EPSILON, target[target_positions], 0.0),
+        lambda side: np.zeros((len(target_positions), hs_count)),
+    )
+    add(
+        post_keys,
+        [unknown_target] * len(target_positions),
+        surplus[target_positions],
+        lambda side: side["surplus"][target_positions],
+    )
+
+    factors = np.zeros(hs_count)
+    if len(table):
+        factors[table.hs_index] = table.configured_conversion_factor
+    return TransitionSensitivity(
+        transition=transition.key,
+        hs_codes=table.hs_codes,
+        factors=factors,
+        nodes=nodes,
+        sources=tuple(sources),
+        targets=tuple(targets),
+        values=np.concatenate(values),
+        derivatives=np.concatenate(derivatives),
+        falling=np.concatenate(falling),
+    )
+
+
+@dataclass(frozen=True)
+class NodeSensitivity:
+    """Node sizes and their derivatives for every (transition, HS code) factor.
+
+    ``derivatives`` (for a rising factor) and ``kinks`` (where a falling
+    factor's derivative differs) are nodes x parameters.
+    """
+
+    node_keys: tuple[str, ...]
+    stages: tuple[str, ...]
+    country_ids: tuple[int | None, ...]
+    sizes: Any
+    parameters: tuple[tuple[str, str], ...]
+    factors: Any
+    derivatives: Any
+    kinks: Any
+
+    def elasticities(self) -> Any:
+        """``d size / d factor * factor / size``; NaN for empty nodes."""
+        sizes = self.sizes[:, None]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(sizes > EPSILON, self.derivatives * self.factors[None, :] / sizes, np.nan)
+
+
+def node_sensitivity(transitions: Sequence[TransitionSensitivity]) -> NodeSensitivity:
+    """Combine the transitions' link derivatives into node-size derivatives."""
+    nodes: dict[str, tuple[str, int | None]] = {}
+    for transition in transitions:
+        for key, meta in transition.nodes.items():
+            nodes.setdefault(key, meta)
+    positions = {key: position for position, key in enumerate(nodes)}
+    parameters = tuple((transition.transition, code) for transition in transitions for code in transition.hs_codes)
+    inflow = np.zeros(len(nodes))
+    outflow = np.zeros(len(nodes))
+    # [rising, falling] x nodes x parameters.
+    inflow_change = np.zeros((2, len(nodes), len(parameters)))
+    outflow_change = np.zeros((2, len(nodes), len(parameters)))
+    offset = 0
+    for transition in transitions:
+        columns = slice(offset, offset + len(transition.hs_codes))
+        offset = columns.stop
+        source = np.fromiter((positions[key] for key in transition.sources), dtype=np.intp, count=len(transition.sources))
+        target = np.fromiter((positions[key] for key in transition.targets), dtype=np.intp, count=len(transition.targets))
+        np.add.at(outflow, source, transition.values)
+        np.add.at(inflow, target, transition.values)
+        for side, links in enumerate((transition.derivatives, transition.falling)):
+            np.add.at(outflow_change[side][:, columns], source, links)
+            np.add.at(inflow_change[side][:, columns], target, links)
+
+    sizes = np.maximum(inflow, outflow)
+    tolerance = (CAP_KINK_TOLERANCE * np.maximum(sizes, 1.0))[:, None]
+    difference = (inflow - outflow)[:, None]
+    # At a tie the size follows the faster-growing side upwards and the
+    # faster-shrinking side downwards.
+    rising, falling = (
+        np.where(
+            difference > tolerance,
+            inflow_change[side],
+            np.where(difference < -tolerance, outflow_change[side], pick(inflow_change[side], outflow_change[side])),
+        )
+        for side, pick in enumerate((np.maximum, np.minimum))
+    )
+    return NodeSensitivity(
+        node_keys=tuple(nodes),
+        stages=tuple(stage for stage, _ in nodes.values()),
+        country_ids=tuple(country_id for _, country_id in nodes.values()),
+        sizes=sizes,
+        parameters=parameters,
+        factors=np.concatenate([transition.factors for transition in transitions] + [np.zeros(0)]),
+        derivatives=rising,
+        kinks=~np.isclose(rising, falling, rtol=CAP_KINK_TOLERANCE, atol=EPSILON),
+    )
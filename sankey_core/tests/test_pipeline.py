@@ -1,10 +1,12 @@
 from __future__ import annotations
 
+import os
 import sys
 import tempfile
 import unittest
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
 
@@ -12,14 +14,35 @@ PACKAGE_ROOT = Path(__file__).resolve().parents[1]
 if str(PACKAGE_ROOT) not in sys.path:
     sys.path.insert(0, str(PACKAGE_ROOT))
 
+from audit_table import AuditTable  # noqa: E402
+from factor_sweep import build_flow_model, sweep_conversion_factors  # noqa: E402
 from flow_builder import (  # noqa: E402
+    ChemistryTables,
     GraphBuilder,
     _apply_chemistry_weighted_factors,
+    _chemistry_shares,
     _chemistry_values,
     _prepare_trade_records,
+    _SEGMENTS,
+    _SegmentCache,
+    _sweep_stage_flows,
     build_flow_graph,
+    clear_segment_cache,
 )
-from loaders import load_production, load_trade_records, normalize_metal  # noqa: E402
+from loaders import (  # noqa: E402
+    _WorkbookSession,
+    clear_reference_cache,
+    clear_trade_cache,
+    load_bilateral_flows,
+    load_production,
+    load_reference,
+    load_reference_table,
+    load_trade_flows,
+    load_trade_panel,
+    load_trade_records,
+    normalize_metal,
+)
+from material_balance import scalar_balance, sparse_balance  # noqa: E402
 from models import (  # noqa: E402
     LinkSpec,
     NodeSpec,
@@ -27,13 +50,27 @@ from models import (  # noqa: E402
     ProductionStage,
     ReferenceMaps,
     RouteSpec,
+    RunInputs,
     Settings,
     TradeRecord,
     TransitionSpec,
 )
 from renderer import make_figure  # noqa: E402
 from routes import ROUTES, display_stages, route_for, route_from_options  # noqa: E402
-from pipeline import _production_source_tag  # noqa: E402
+from pipeline import (  # noqa: E402
+    BALANCE_COLUMNS,
+    SENSITIVITY_COLUMNS,
+    STAGE_COLUMNS,
+    _owned_hs_codes,
+    _production_source_tag,
+    _verify_balance,
+)
+from production_arrays import compact_production  # noqa: E402
+from production_cache import clear_workbook_cache, forget_workbook, load_workbook  # noqa: E402
+from trade_index import load_file_index  # noqa: E402
+from trade_store import compile_trade_year, open_trade_year, read_partner_file  # noqa: E402
+from trade_table import TradeTable  # noqa: E402
+from uncertainty import monte_carlo_bands, parse_distribution  # noqa: E402
 
 
 def settings(**overrides) -> Settings:
@@ -181,6 +218,22 @@ class TradeLoaderTests(unittest.TestCase):
         quantities = {record.exporter_id: record.raw_quantity_tonnes for record in records}
         self.assertEqual(quantities, {200: 2.5, 300: 4.0})
 
+    def test_partner_reader_handles_bom_quoting_and_unused_columns(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir) / "100_260400_M_2024_partners.csv"
+            path.write_text(
+                "\ufefftypeCode,partnerCode,cmdDesc,qtyUnitAbbr,qty,netWgt\n"
+                'C,200,"Ores, concentrates",Kg ,2500,9\n'
+                "C,,blank partner,kg,1000,\n"
+                "\n"
+                "C,300,no unit,N/A,,4000\n",
+                encoding="utf-8",
+            )
+            partners, tonnes = read_partner_file(path)
+        self.assertEqual(partners[[0, 2]].tolist(), [200.0, 300.0])
+        self.assertTrue(np.isnan(partners[1]))
+        self.assertEqual(tonnes.tolist(), [2.5, 1.0, 4.0])
+
     def test_empty_quantity_values_contribute_zero_without_stopping_run(self) -> None:
         with tempfile.TemporaryDirectory() as temp_dir:
             root = Path(temp_dir)
@@ -202,6 +255,147 @@ class TradeLoaderTests(unittest.TestCase):
             )
         self.assertEqual(records, [])
 
+    def test_compiled_store_matches_raw_files_until_tree_changes(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            year_root = root / "UNComtrade_2024_Import_ByPartner"
+            for importer, rows in ((100, "0,kg,9,9\n200,kg,2500,2500\n200,kg,500,500\n"), (300, "200,N/A,,4000\n")):
+                reporter = year_root / f"reporter_{importer}"
+                reporter.mkdir(parents=True)
+                (reporter / f"{importer}_260400_M_2024_partners.csv").write_text(
+                    "partnerCode,qtyUnitAbbr,qty,netWgt\n" + rows, encoding="utf-8"
+                )
+            configured = settings(trade_root=root, post_trade_hs={"post_trade_1": {"260400": 0.5}})
+            raw = load_trade_records(configured, "post_trade_1")
+            manifest = compile_trade_year(root, 2024)
+            self.assertEqual(manifest["hs_codes"], {"260400": 3})
+            self.assertIsNotNone(open_trade_year(load_file_index(root, 2024)))
+            clear_trade_cache()
+            self.assertEqual(load_trade_records(configured, "post_trade_1"), raw)
+            flows = load_trade_flows(configured, "post_trade_1")["260400"]
+            self.assertTrue(flows.mapped)
+            self.assertIsInstance(flows.tonnes, np.memmap)
+            self.assertEqual(flows.countries.tolist(), [100, 200, 300])
+            self.assertEqual(flows.exporter_ids.tolist(), [200, 200])
+            self.assertEqual(flows.importer_ids.tolist(), [100, 300])
+            self.assertEqual(
+                {(record.importer_id, record.raw_quantity_tonnes) for record in raw},
+                {(100, 3.0), (300, 4.0)},
+            )
+
+            late = year_root / "reporter_400"
+            late.mkdir()
+            (late / "400_260400_M_2024_partners.csv").write_text(
+                "partnerCode,qtyUnitAbbr,qty,netWgt\n200,kg,1000,1000\n", encoding="utf-8"
+            )
+            self.assertIsNone(open_trade_year(load_file_index(root, 2024)))
+            records = load_trade_records(configured, "post_trade_1")
+        self.assertEqual(len(records), 3)
+
+    def test_worker_pool_keeps_record_order_and_provenance(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            for importer in (100, 300, 500, 700):
+                reporter = root / "UNComtrade_2024_Import_ByPartner" / f"reporter_{importer}"
+                reporter.mkdir(parents=True)
+                (reporter / f"{importer}_260400_M_2024_partners.csv").write_text(
+                    "partnerCode,qtyUnitAbbr,qty,netWgt\n"
+                    f"200,kg,{importer * 10},0\n400,kg,{importer},0\n",
+                    encoding="utf-8",
+                )
+            hs = {"post_trade_1": {"260400": 0.5}}
+            sequential = load_trade_records(settings(trade_root=root, post_trade_hs=hs), "post_trade_1")
+            clear_trade_cache()
+            pooled = load_trade_records(
+                settings(trade_root=root, post_trade_hs=hs, trade_read_workers=3), "post_trade_1"
+            )
+        self.assertEqual(len(sequential), 8)
+        self.assertEqual(pooled, sequential)
+
+    def test_flow_cache_serves_factor_changes_and_drops_stale_years(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            reporter = root / "UNComtrade_2024_Import_ByPartner" / "reporter_100"
+            reporter.mkdir(parents=True)
+            (reporter / "100_260400_M_2024_partners.csv").write_text(
+                "partnerCode,qtyUnitAbbr,qty\n200,t,8\n", encoding="utf-8"
+            )
+            first = load_trade_records(
+                settings(trade_root=root, post_trade_hs={"post_trade_1": {"260400": 0.5}}), "post_trade_1"
+            )
+            cached = load_bilateral_flows(load_file_index(root, 2024), "260400")
+            flipped = load_trade_records(
+                settings(trade_root=root, post_trade_hs={"post_trade_1": {"260400": 0.25}}), "post_trade_1"
+            )
+            self.assertIs(load_bilateral_flows(load_file_index(root, 2024), "260400"), cached)
+
+            second = root / "UNComtrade_2024_Import_ByPartner" / "reporter_300"
+            second.mkdir()
+            (second / "300_260400_M_2024_partners.csv").write_text(
+                "partnerCode,qtyUnitAbbr,qty\n200,t,1\n", encoding="utf-8"
+            )
+            refreshed = load_trade_records(
+                settings(trade_root=root, post_trade_hs={"post_trade_1": {"260400": 0.25}}), "post_trade_1"
+            )
+        self.assertEqual(first[0].raw_quantity_tonnes, 8.0)
+        self.assertEqual(flipped[0].raw_quantity_tonnes, 8.0)
+        self.assertEqual(flipped[0].configured_conversion_factor, 0.25)
+        self.assertEqual([record.raw_quantity_tonnes for record in refreshed], [8.0, 1.0])
+
+    def test_trade_panel_stacks_years_and_matches_single_year_loads(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            for year, quantity in ((2023, 5), (2024, 7)):
+                reporter = root / f"UNComtrade_{year}_Import_ByPartner" / "reporter_100"
+                reporter.mkdir(parents=True)
+                (reporter / f"100_260400_M_{year}_partners.csv").write_text(
+                    f"partnerCode,qtyUnitAbbr,qty\n300,t,1\n200,t,{quantity}\n", encoding="utf-8"
+                )
+            hs = {"post_trade_1": {"260400": 0.5}}
+            panel = load_trade_panel(settings(trade_root=root, post_trade_hs=hs), "post_trade_1", [2024, 2023])
+            single = load_trade_records(settings(trade_root=root, year=2023, post_trade_hs=hs), "post_trade_1")
+        rows = panel["260400"]
+        self.assertEqual(rows.years, (2024, 2023))
+        self.assertEqual(rows.year.tolist(), [2024, 2024, 2023, 2023])
+        self.assertEqual(rows.exporter_ids.tolist(), [200, 300, 200, 300])
+        self.assertEqual(rows.tonnes.tolist(), [7.0, 1.0, 5.0, 1.0])
+        self.assertEqual([record.raw_quantity_tonnes for record in single], rows.tonnes[2:].tolist())
+
+    def test_shared_hs_codes_are_owned_by_one_transition_before_loading(self) -> None:
+        route = route_from_options(False, False, True)
+        hs = {
+            "post_trade_1": {"260400": 0.5},
+            "post_trade_3": {"282200": 0.1, "283324": 0.2},
+            "post_trade_4": {"283324": 0.3, " 282200 ": 0.4},
+        }
+        downstream = _owned_hs_codes(settings(post_trade_hs=hs), route)
+        upstream = _owned_hs_codes(settings(post_trade_hs=hs, shared_hs_trade_owner="upstream"), route)
+        self.assertEqual(downstream["post_trade_1"], {"260400"})
+        self.assertEqual(downstream["post_trade_3"], set())
+        self.assertEqual(downstream["post_trade_4"], {"282200", "283324"})
+        self.assertEqual(upstream["post_trade_3"], {"282200", "283324"})
+        self.assertEqual(upstream["post_trade_4"], set())
+
+    def test_file_index_is_persisted_and_rebuilt_when_folders_change(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            reporter = root / "UNComtrade_2024_Import_ByPartner" / "reporter_100"
+            reporter.mkdir(parents=True)
+            (reporter / "100_260400_M_2024_partners.csv").write_text("partnerCode\n", encoding="utf-8")
+            (reporter / "100_750110_M_2024_partners.csv").write_text("partnerCode\n", encoding="utf-8")
+            index = load_file_index(root, 2024)
+            self.assertEqual(index.hs_codes, ["260400", "750110"])
+            self.assertEqual(index.relative_paths("260400"), ["reporter_100/100_260400_M_2024_partners.csv"])
+            self.assertTrue((root / "UNComtrade_2024_Import_ByPartner" / "_compiled" / "file_index.json").exists())
+            self.assertIs(load_file_index(root, 2024), index)
+
+            second = root / "UNComtrade_2024_Import_ByPartner" / "reporter_200"
+            second.mkdir()
+            (second / "200_260400_M_2024_partners.csv").write_text("partnerCode\n", encoding="utf-8")
+            rebuilt = load_file_index(root, 2024)
+        self.assertEqual(len(rebuilt.paths("260400")), 2)
+        self.assertEqual(rebuilt.paths("283691"), [])
+
 
 class ScalingTests(unittest.TestCase):
     def test_chemistry_weighted_factor_matches_production_shares(self) -> None:
@@ -217,6 +411,24 @@ class ScalingTests(unittest.TestCase):
         )
         self.assertAlmostEqual(record.manual_conversion_factor, 0.3)
 
+    def test_chemistry_tables_reuse_country_shares_and_global_fallback(self) -> None:
+        production = ProductionData(
+            totals={"cathode": {1: 100.0, 3: 10.0}},
+            labels={},
+            cathode_chemistry={},
+            stage_chemistry={"cathode": {"LFP": {1: 75.0}, "NCA": {1: 25.0, 2: 0.0}}},
+        )
+        tables = ChemistryTables(production)
+        self.assertEqual(tables.shares("cathode", 1), {"LFP": 0.75, "NCA": 0.25})
+        self.assertIs(tables.shares("cathode", 1), tables.shares("cathode", 1))
+        self.assertIs(tables.shares("cathode", 2), tables.shares("cathode", 3))
+        self.assertEqual(tables.shares("cathode", 3), _chemistry_shares(production, "cathode", 3))
+        self.assertEqual(tables.production_split("cathode", 3), (10.0, {"OTHER": 10.0}))
+        self.assertEqual(
+            _chemistry_values(production, 1, 20.0, tables=tables),
+            _chemistry_values(production, 1, 20.0),
+        )
+
     def test_only_producer_exporters_receive_production_scaling(self) -> None:
         producer = TradeRecord("post_trade_1", "260400", 2, 1, 20.0, 0.5)
         non_source = TradeRecord("post_trade_1", "260400", 2, 3, 4.0, 0.5)
@@ -333,8 +545,405 @@ class BalanceTests(unittest.TestCase):
         cathode_nodes = [node for node in result.nodes.values() if node.stage == "P:cathode"]
         self.assertEqual({node.label for node in cathode_nodes}, {"NMC", "NCA", "Mining to Unknown Destination"})
 
+    def test_changed_transition_is_rebuilt_and_unchanged_ones_are_replayed(self) -> None:
+        route = RouteSpec(
+            key="test_segments",
+            production_stages=(
+                ProductionStage("mining", "Mining"),
+                ProductionStage("refining", "Refining"),
+                ProductionStage("cathode", "Cathode"),
+            ),
+            transitions=(
+                TransitionSpec("post_trade_1", "1st Post Trade", "mining", "refining"),
+                TransitionSpec("post_trade_2", "2nd Post Trade", "refining", "cathode"),
+            ),
+        )
+        production = ProductionData(
+            totals={"mining": {1: 10.0, 2: 4.0}, "refining": {2: 8.0}, "cathode": {1: 5.0, 3: 2.0}},
+            labels={1: "Country 1", 2: "Country 2", 3: "Country 3"},
+            cathode_chemistry={"NMC": {1: 3.0}, "LFP": {1: 2.0}},
+        )
+
+        def trades(second_factor: float) -> dict[str, list[TradeRecord]]:
+            return {
+                "post_trade_1": [TradeRecord("post_trade_1", "A", 2, 1, 6.0, 1.0, 1.0)],
+                "post_trade_2": [
+                    TradeRecord("post_trade_2", "B", 1, 2, 10.0, second_factor, second_factor),
+                    TradeRecord("post_trade_2", "B", 3, 2, 3.0, second_factor, second_factor),
+                ],
+            }
+
+        configured = settings(route="test_segments", cathode_view="country_chemistry")
+        clear_segment_cache()
+        build_flow_graph(configured, route, production, reference(1, 2, 3), trades(0.5))
+        self.assertEqual(len(_SEGMENTS), 2)
+        changed = trades(0.25)
+        incremental = build_flow_graph(configured, route, production, reference(1, 2, 3), changed)
+        self.assertEqual(len(_SEGMENTS), 3)
+        display_only = settings(
+            route="test_segments",
+            cathode_view="country_chemistry",
+            theme="light",
+            image_width=900,
+            label_font_size=20,
+            output_root=Path("elsewhere"),
+            trade_read_workers=1,
+            monte_carlo_draws=10,
+        )
+        restyled = build_flow_graph(display_only, route, production, reference(1, 2, 3), trades(0.25))
+        self.assertEqual(len(_SEGMENTS), 3)
+        self.assertEqual(restyled, incremental)
+        build_flow_graph(settings(route="test_segments"), route, production, reference(1, 2, 3), trades(0.25))
+        self.assertEqual(len(_SEGMENTS), 5)
+
+        segments = [segment for segment, _ in _SEGMENTS._entries.values()]
+        self.assertEqual(_SEGMENTS.nbytes, sum(segment.nbytes for segment in segments))
+        bounded = _SegmentCache(segments[3].nbytes + segments[4].nbytes)
+        for position, segment in enumerate(segments):
+            bounded.put(str(position), segment)
+        self.assertIsNone(bounded.get("0"))
+        self.assertIs(bounded.get("4"), segments[4])
+        self.assertLessEqual(bounded.nbytes, bounded.max_bytes)
+        oversized = _SegmentCache(1)
+        oversized.put("0", segments[0])
+        self.assertEqual((len(oversized), oversized.nbytes), (0, 0))
+
+        clear_segment_cache()
+        rebuilt = trades(0.25)
+        full = build_flow_graph(configured, route, production, reference(1, 2, 3), rebuilt)
+        self.assertEqual(incremental, full)
+        self.assertEqual(
+            [vars(record) for records in changed.values() for record in records],
+            [vars(record) for records in rebuilt.values() for record in records],
+        )
+        clear_segment_cache()
+
+    def test_sparse_balance_engine_matches_scalar_engine_on_many_countries(self) -> None:
+        generator = np.random.default_rng(7)
+        country_ids = list(range(1, 301))
+        route = RouteSpec(
+            key="test_engines",
+            production_stages=(
+                ProductionStage("mining", "Mining"),
+                ProductionStage("refining", "Refining"),
+                ProductionStage("cathode", "Cathode"),
+            ),
+            transitions=(
+                TransitionSpec("post_trade_1", "1st Post Trade", "mining", "refining"),
+                TransitionSpec("post_trade_2", "2nd Post Trade", "refining", "cathode"),
+            ),
+        )
+        production = ProductionData(
+            totals={
+                stage.key: {
+                    country_id: float(generator.gamma(1.0, 50.0))
+                    for country_id in country_ids
+                    if generator.random() < 0.4
+                }
+                for stage in route.production_stages
+            },
+            labels={country_id: f"Country {country_id}" for country_id in country_ids},
+            cathode_chemistry={"NMC": {1: 3.0}, "LFP": {2: 2.0}},
+        )
+
+        def trades() -> dict[str, list[TradeRecord]]:
+            rows = np.random.default_rng(11)
+            return {
+                transition.key: [
+                    TradeRecord(
+                        transition.key,
+                        str(rows.integers(1, 4)),
+                        int(importer_id),
+                        int(exporter_id),
+                        float(rows.gamma(1.0, 20.0)),
+                        0.8,
+                        0.8,
+                    )
+                    for importer_id, exporter_id in rows.integers(1, 301, size=(2000, 2))
+                    if importer_id != exporter_id
+                ]
+                for transition in route.transitions
+            }
+
+        results = {}
+        for engine in ("scalar", "sparse"):
+            records = trades()
+            results[engine] = build_flow_graph(
+                settings(route="test_engines", balance_engine=engine),
+                route,
+                production,
+                reference(*country_ids),
+                records,
+            )
+            if engine == "sparse":
+                table = TradeTable.from_records(records["post_trade_2"])
+                scalar = scalar_balance(table, production.totals["refining"], production.totals["cathode"])
+                sparse = sparse_balance(table, production.totals["refining"], production.totals["cathode"])
+                for name in ("exports", "imports", "domestic", "untraded", "unknown_source", "excess"):
+                    self.assertEqual(dict(getattr(sparse, name)), dict(getattr(scalar, name)), name)
+        self.assertEqual(results["sparse"], results["scalar"])
+        check = _verify_balance(results["sparse"].balance_rows, results["sparse"].stage_rows)
+        self.assertLess(check["max_post_trade_balance_residual"], 1e-6)
+        self.assertGreater(len(results["sparse"].balance_rows), 200)
+
+    def test_factor_sweep_matches_full_builds_at_every_grid_point(self) -> None:
+        route = RouteSpec(
+            key="test_sweep",
+            production_stages=(
+                ProductionStage("mining", "Mining"),
+                ProductionStage("refining", "Refining"),
+                ProductionStage("cathode", "Cathode"),
+            ),
+            transitions=(
+                TransitionSpec("post_trade_1", "1st Post Trade", "mining", "refining"),
+                TransitionSpec("post_trade_2", "2nd Post Trade", "refining", "cathode"),
+            ),
+        )
+        production = ProductionData(
+            totals={"mining": {1: 10.0, 2: 4.0}, "refining": {2: 8.0, 4: 1.0}, "cathode": {1: 5.0, 3: 2.0}},
+            labels={},
+            cathode_chemistry={},
+        )
+
+        def trades(first: float, second: float) -> dict[str, TradeTable]:
+            return {
+                "post_trade_1": TradeTable.from_records([
+                    TradeRecord("post_trade_1", "A", 2, 1, 6.0, first, first),
+                    TradeRecord("post_trade_1", "A", 5, 1, 3.0, first, first),
+                    TradeRecord("post_trade_1", "A", 4, 5, 2.0, first, first),
+                ]),
+                "post_trade_2": TradeTable.from_records([
+                    TradeRecord("post_trade_2", "B", 1, 2, 10.0, second, second),
+                    TradeRecord("post_trade_2", "B", 3, 2, 3.0, second, second),
+                    TradeRecord("post_trade_2", "B", 6, 4, 4.0, second, second),
+                ]),
+            }
+
+        configured = settings(route="test_sweep")
+        inputs = RunInputs(route, display_stages(route), production, trades(1.0, 0.5), reference(1, 2, 3, 4, 5, 6))
+        grid = {"A": [0.5, 1.0], "B": [0.1, 0.5, 2.0]}
+        sweep = sweep_conversion_factors(configured, inputs, grid)
+        self.assertEqual(sweep.points.shape, (6, 2))
+        self.assertEqual(sweep.points[1].tolist(), [0.5, 0.5])
+        self.assertEqual(len(sweep.frame()), 6)
+        with self.assertRaises(ValueError):
+            sweep_conversion_factors(configured, inputs, {"C": [1.0]})
+
+        for point, (first, second) in enumerate(sweep.points.tolist()):
+            result = build_flow_graph(configured, route, production, inputs.reference, trades(first, second))
+            graph = result.graph
+            sizes = np.zeros((2, len(graph.nodes)))
+            np.add.at(sizes[0], list(graph.targets), list(graph.values))
+            np.add.at(sizes[1], list(graph.sources), list(graph.values))
+            for node, size in zip(graph.nodes, sizes.max(axis=0).tolist()):
+                self.assertAlmostEqual(sweep.node_size(node.key)[point], size, places=9, msg=node.key)
+            self.assertTrue(set(sweep.node_keys) >= {node.key for node in graph.nodes})
+            rows = result.balance_rows
+            for position, transition in enumerate(sweep.transitions):
+                mask = rows.column("transition") == transition
+                self.assertAlmostEqual(
+                    sweep.unknown_source[point, position], rows.column("unknown_source")[mask].sum(), places=9
+                )
+                self.assertAlmostEqual(
+                    sweep.unknown_destination[point, position],
+                    rows.column("excess_to_unknown_destination")[mask].sum(),
+                    places=9,
+                )
+
+        model = build_flow_model(configured, route, production, inputs.trade_by_transition)
+        self.assertEqual(model.parameters, (("post_trade_1", "A"), ("post_trade_2", "B")))
+        self.assertEqual(model.base_factors.tolist(), [1.0, 0.5])
+
+    def test_monte_carlo_bands_cover_the_point_estimate_and_annotate_hovers(self) -> None:
+        route = RouteSpec(
+            key="test_uncertainty",
+            production_stages=(ProductionStage("refining", "Refining"), ProductionStage("cathode", "Cathode")),
+            transitions=(TransitionSpec("post_trade_1", "1st Post Trade", "refining", "cathode"),),
+        )
+        production = ProductionData(
+            totals={"refining": {1: 10.0, 2: 8.0}, "cathode": {1: 5.0, 3: 6.0}},
+            labels={},
+            cathode_chemistry={},
+        )
+        table = TradeTable.from_records([
+            TradeRecord("post_trade_1", "B", 3, 1, 10.0, 0.5, 0.5),
+            TradeRecord("post_trade_1", "B", 3, 2, 4.0, 0.5, 0.5),
+            TradeRecord("post_trade_1", "B", 4, 2, 6.0, 0.5, 0.5),
+        ])
+        inputs = RunInputs(route, display_stages(route), production, {"post_trade_1": table}, reference(1, 2, 3, 4))
+        configured = settings(
+            route="test_uncertainty",
+            monte_carlo_draws=4000,
+            monte_carlo_seed=3,
+            factor_distributions={"B": parse_distribution(("triangular", 0.3, 0.5, 0.9), "B")},
+            production_distributions={"cathode": parse_distribution(("normal", 1.0, 0.1), "cathode")},
+        )
+        bands = monte_carlo_bands(configured, inputs)
+        result = build_flow_graph(configured, route, production, inputs.reference, {"post_trade_1": table})
+        post_key = "T:post_trade_1:country:3"
+        position = bands.node_keys.index(post_key)
+        self.assertAlmostEqual(bands.nodes.point[position], 7.0)
+        low, median, high = bands.nodes.bands[:, position].tolist()
+        self.assertLess(low, median)
+        self.assertLess(median, high)
+        self.assertEqual(set(bands.node_band(post_key)), {"p5", "p50", "p95"})
+        self.assertEqual(
+            monte_carlo_bands(configured, inputs).nodes.bands.tolist(), bands.nodes.bands.tolist()
+        )
+
+        frame = bands.frame(configured, route.key, {node.key: node.hover for node in result.graph.nodes})
+        links = frame[frame["element"] == "link"]
+        self.assertLessEqual(
+            {
+                (result.graph.nodes[source].key, result.graph.nodes[target].key)
+                for source, target in zip(result.graph.sources, result.graph.targets)
+            },
+            set(zip(links["source_key"], links["target_key"])),
+        )
+        self.assertTrue((frame["p5"] <= frame["p95"]).all())
+        self.assertEqual(frame["draws"].unique().tolist(), [4000])
+
+        figure = make_figure(
+            graph=result.graph,
+            stages=inputs.stages,
+            metal="Ni",
+            route=route.key,
+            reference_quantity=10.0,
+            theme="dark",
+            sort_mode="size",
+            label_font_size=12,
+            node_annotations=bands.hover_annotations(),
+        )
+        hovers = [text for text in figure.data[0].node.customdata if text.startswith("Country 3 (C3)<br>7 t")]
+        self.assertTrue(any("<br>P5-P95: " in text for text in hovers))
+
+        fixed = monte_carlo_bands(
+            settings(
+                route="test_uncertainty",
+                monte_carlo_draws=10,
+                factor_distributions={"B": parse_distribution(("uniform", 0.5, 0.5), "B")},
+            ),
+            inputs,
+        )
+        np.testing.assert_allclose(fixed.links.bands, np.repeat(fixed.links.point[None], 3, axis=0))
+        for spec in (("normal", 1.0), ("uniform", 2.0, 1.0), ("beta", 1.0, 1.0), "normal"):
+            with self.assertRaises(ValueError):
+                parse_distribution(spec, "spec")
+
+    def test_factor_sensitivity_matches_finite_differences_across_the_cap_kink(self) -> None:
+        route = RouteSpec(
+            key="test_sensitivity",
+            production_stages=(
+                ProductionStage("mining", "Mining"),
+                ProductionStage("refining", "Refining"),
+                ProductionStage("cathode", "Cathode"),
+            ),
+            transitions=(
+                TransitionSpec("post_trade_1", "1st Post Trade", "mining", "refining"),
+                TransitionSpec("post_trade_2", "2nd Post Trade", "refining", "cathode"),
+            ),
+        )
+        production = ProductionData(
+            totals={"mining": {1: 10.0, 2: 4.0}, "refining": {1: 3.0, 2: 8.0}, "cathode": {2: 5.0, 3: 2.0}},
+            labels={},
+            cathode_chemistry={},
+        )
+
+        def trades(first: float, second: float) -> dict[str, TradeTable]:
+            return {
+                "post_trade_1": TradeTable.from_records([
+                    TradeRecord("post_trade_1", "A", 1, 2, 6.1, first, first),
+                    TradeRecord("post_trade_1", "A", 7, 2, 1.3, first, first),
+                    TradeRecord("post_trade_1", "A", 2, 5, 3.0, first, first),
+                    TradeRecord("post_trade_1", "A", 2, 1, 2.0, first, first),
+                ]),
+                "post_trade_2": TradeTable.from_records([
+                    TradeRecord("post_trade_2", "B", 3, 2, 10.1, second, second),
+                    TradeRecord("post_trade_2", "B", 7, 2, 2.7, second, second),
+                    TradeRecord("post_trade_2", "B", 7, 1, 3.0, second, second),
+                ]),
+            }
+
+        configured = settings(route="test_sensitivity")
+
+        def node_sizes(first: float, second: float) -> dict[str, float]:
+            graph = build_flow_graph(configured, route, production, reference(1, 2, 3, 5, 7), trades(first, second)).graph
+            sizes = np.zeros((2, len(graph.nodes)))
+            np.add.at(sizes[0], list(graph.targets), list(graph.values))
+            np.add.at(sizes[1], list(graph.sources), list(graph.values))
+            return dict(zip((node.key for node in graph.nodes), sizes.max(axis=0).tolist()))
+
+        step = 1e-6
+        # Exporter 2 ships 7.4 * first against 4 t of mining, so the cap binds
+        # above 4 / 7.4, and 12.8 * second against 8 t of refining, above 0.625.
+        for first, second in ((1.0, 0.9), (0.5, 0.2), (4.0 / 7.4, 0.5), (0.3, 0.625)):
+            result = build_flow_graph(configured, route, production, reference(1, 2, 3, 5, 7), trades(first, second))
+            rows = result.sensitivity_rows
+            self.assertEqual(set(rows.columns), set(SENSITIVITY_COLUMNS))
+            base = node_sizes(first, second)
+            shifted = {
+                "A": (node_sizes(first + step, second), node_sizes(first - step, second)),
+                "B": (node_sizes(first, second + step), node_sizes(first, second - step)),
+            }
+            reported = {
+                (row["hs_code"], row["node_key"]): row for row in rows if row["node_key"] in base
+            }
+            for hs_code, (above, below) in shifted.items():
+                for key, size in base.items():
+                    rising = (above.get(key, 0.0) - size) / step
+                    falling = (size - below.get(key, 0.0)) / step
+                    row = reported.get((hs_code, key))
+                    self.assertAlmostEqual(row["derivative"] if row else 0.0, rising, places=4, msg=(hs_code, key))
+                    self.assertEqual(bool(row and row["at_kink"]), abs(rising - falling) > 1e-3, msg=(hs_code, key))
+                    if row and size > 0:
+                        factor = first if hs_code == "A" else second
+                        self.assertAlmostEqual(row["elasticity"], row["derivative"] * factor / size)
+            kinked = {row["node_key"] for row in rows if row["at_kink"]}
+            self.assertEqual(bool(kinked), first == 4.0 / 7.4 or second == 0.625)
+            # Capped exporters hold their production exactly; no rounding noise is reported.
+            self.assertFalse(any(abs(row["derivative"]) <= 1e-9 and not row["at_kink"] for row in rows))
+
+        clear_segment_cache()
+        cached = build_flow_graph(configured, route, production, reference(1, 2, 3, 5, 7), trades(1.0, 0.5))
+        again = build_flow_graph(configured, route, production, reference(1, 2, 3, 5, 7), trades(1.0, 0.5))
+        self.assertEqual(cached.sensitivity_rows, again.sensitivity_rows)
+        sparse = build_flow_graph(
+            settings(route="test_sensitivity", balance_engine="sparse"),
+            route,
+            production,
+            reference(1, 2, 3, 5, 7),
+            trades(1.0, 0.5),
+        )
+        self.assertEqual(sparse.sensitivity_rows, cached.sensitivity_rows)
+
 
 class TradeOnlyBalanceTests(unittest.TestCase):
+    def test_compact_production_keeps_dict_views_and_membership_masks(self) -> None:
+        production = ProductionData(
+            totals={"mining": {30: 4.0, 10: 2.0}, "cathode": {20: 5.0}},
+            labels={10: "Country 10", 20: "Country 20", 30: "Country 30"},
+            cathode_chemistry={"NMC": {20: 3.0}},
+            stage_chemistry={"cathode": {"NMC": {20: 3.0}, "LFP": {40: 1.0}}},
+        )
+        arrays = compact_production(production)
+
+        self.assertEqual(arrays.index.ids.tolist(), [10, 20, 30, 40])
+        self.assertEqual(arrays.members_of("mining").tolist(), [True, False, True, False])
+        self.assertEqual(arrays.totals_of("mining").tolist(), [2.0, 0.0, 4.0, 0.0])
+        self.assertEqual(arrays.member_ids("cathode"), {20})
+        self.assertEqual(dict(arrays.totals["mining"]), {10: 2.0, 30: 4.0})
+        self.assertEqual(arrays.totals["cathode"].get(10, 0.0), 0.0)
+        self.assertNotIn(20, arrays.totals["mining"])
+        self.assertEqual(dict(arrays.stage_chemistry["cathode"]["LFP"]), {40: 1.0})
+        self.assertEqual(dict(arrays.cathode_chemistry["NMC"]), {20: 3.0})
+        mining = arrays.totals["mining"]
+        self.assertEqual(list(mining.keys()), [10, 30])
+        self.assertEqual(list(mining.values()), [2.0, 4.0])
+        self.assertEqual(list(mining.items()), [(10, 2.0), (30, 4.0)])
+        self.assertEqual(arrays.index.vector(mining)[0].tolist(), [2.0, 0.0, 4.0, 0.0])
+        with self.assertRaises(KeyError):
+            arrays.members_of("battery")
+
     def test_trade_only_chemistry_uses_production_shares_not_production_total(self) -> None:
         production = ProductionData(
             totals={"cathode": {1: 5.0}},
@@ -436,6 +1045,70 @@ class TradeOnlyBalanceTests(unittest.TestCase):
         self.assertAlmostEqual(processing_deficit["unknown_source"], 2.0)
         self.assertEqual(processing_deficit["unknown_destination"], 0.0)
 
+        self.assertEqual(result.stage_rows.column("country_id").tolist(), [2, 1, 3, 2])
+        self.assertEqual(
+            result.stage_rows.column("country_name").tolist(),
+            ["Country 2", "Country 1", "Country 3", "Country 2"],
+        )
+        self.assertEqual(list(result.stage_rows.to_frame(STAGE_COLUMNS).columns), STAGE_COLUMNS)
+        self.assertEqual(list(result.balance_rows.to_frame(BALANCE_COLUMNS).columns), BALANCE_COLUMNS)
+        self.assertEqual(len(result.balance_rows), 6)
+        self.assertLess(_verify_balance(result.balance_rows, result.stage_rows)["max_stage_material_balance_residual"], 1e-9)
+
+        unbalanced = AuditTable()
+        unbalanced.append(2, {"country_id": np.array([1, 2]), "material_balance_residual": np.array([0.0, -0.5])})
+        with self.assertRaisesRegex(ValueError, "max_stage_residual=0.5"):
+            _verify_balance(AuditTable(), unbalanced)
+
+
+    def test_stage_sweep_handles_every_country_run_at_once(self) -> None:
+        members = np.array([[True, True, False, True], [False, True, True, True]])
+        incoming = np.array([[0.0, 2.0, 0.0, 0.0], [0.0, 1.0, 0.0, 5.0]])
+        outgoing = np.array([[4.0, 0.0, 0.0, 1.0], [0.0, 0.0, 3.0, 0.0]])
+        flows = _sweep_stage_flows(members, incoming, outgoing)
+        self.assertEqual(flows.intrinsic_source[:, 0].tolist(), [4.0, 0.0])
+        self.assertEqual(flows.unknown_source.tolist(), [[0.0, 0.0, 0.0, 1.0], [0.0, 2.0, 0.0, 0.0]])
+        self.assertEqual(flows.unknown_destination.tolist(), [[0.0, 2.0, 0.0, 0.0], [0.0, 0.0, 0.0, 0.0]])
+        self.assertEqual(flows.domestic.tolist(), [[0.0, 0.0, 0.0, 0.0], [0.0, 3.0, 0.0, 0.0]])
+        self.assertEqual(flows.terminal_absorption[:, -1].tolist(), [0.0, 5.0])
+        self.assertEqual(flows.node_size.tolist(), [[4.0, 2.0, 0.0, 1.0], [0.0, 3.0, 3.0, 5.0]])
+        self.assertFalse(flows.material_residual.any())
+
+    def test_trade_table_and_record_lists_build_the_same_graph(self) -> None:
+        route = RouteSpec(
+            key="test_pair",
+            production_stages=(ProductionStage("mining", "Mining"), ProductionStage("refining", "Refining")),
+            transitions=(TransitionSpec("post_trade_1", "Mining to Refining", "mining", "refining"),),
+        )
+        production = ProductionData(
+            totals={"mining": {1: 5.0, 3: 1.0}, "refining": {2: 7.0}},
+            labels={},
+            cathode_chemistry={},
+        )
+        records = [
+            TradeRecord("post_trade_1", "A", 2, 1, 20.0, 0.5, 0.5, source_files=["a.csv", "b.csv"]),
+            TradeRecord("post_trade_1", "A", 4, 3, 6.0, 0.5, 0.5, source_files=["b.csv"]),
+            TradeRecord("post_trade_1", "B", 2, 5, 4.0, 1.0, 1.0, target_product="X"),
+        ]
+        table = TradeTable.from_records(records)
+        self.assertEqual(table.source_paths, ("a.csv", "b.csv"))
+        self.assertEqual(table.hs_codes, ("A", "B"))
+
+        for use_production_data in (True, False):
+            configured = settings(route="test_pair", use_production_data=use_production_data)
+            copies = TradeTable.from_records(records).records()
+            from_records = build_flow_graph(configured, route, production, reference(1, 2, 3, 4, 5), {"post_trade_1": copies})
+            from_table = build_flow_graph(
+                configured, route, production, reference(1, 2, 3, 4, 5),
+                {"post_trade_1": TradeTable.from_records(records)},
+            )
+            self.assertEqual(from_table, from_records)
+            self.assertEqual(from_table.conversion_rows[0]["source_files"], "a.csv | b.csv")
+            self.assertEqual(
+                [record.classification for record in copies],
+                ["producer_to_producer", "producer_to_non_target", "non_source_to_producer"],
+            )
+
 
 class ProductionTests(unittest.TestCase):
     def test_mixed_source_filename_tag_records_each_active_stage(self) -> None:
@@ -562,6 +1235,109 @@ class ProductionTests(unittest.TestCase):
                     route,
                 )
 
+    def test_reference_table_is_cached_until_the_workbook_changes(self) -> None:
+        clear_reference_cache()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir) / "reference.xlsx"
+            pd.DataFrame(
+                {"id": [1, "World"], "text": ["Alpha", "World"], "region": ["Asia", None], "color": ["#abc", None]}
+            ).to_excel(path, index=False)
+            table = load_reference_table(path)
+            self.assertIs(load_reference_table(path), table)
+            self.assertEqual(table.maps.colors, {1: "#AABBCC"})
+
+            maps = load_reference(path, {1, 7})
+            self.assertEqual(maps.names[7], "Country 7")
+            self.assertEqual(maps.regions[7], "Unknown")
+            self.assertIn(7, maps.colors)
+            self.assertNotIn(7, table.maps.colors)
+            self.assertIs(load_reference(path, {1}), table.maps)
+
+            pd.DataFrame({"id": [1], "text": ["Renamed"]}).to_excel(path, index=False)
+            os.utime(path, ns=(path.stat().st_atime_ns, path.stat().st_mtime_ns + 1_000_000_000))
+            self.assertEqual(load_reference_table(path).maps.names, {1: "Renamed"})
+
+    def test_parsed_workbooks_are_shared_by_content_hash(self) -> None:
+        route = RouteSpec("one", (ProductionStage("mining", "Mining"),), ())
+        with tempfile.TemporaryDirectory() as temp_dir:
+            first = Path(temp_dir) / "first" / "usgs.xlsx"
+            second = Path(temp_dir) / "second" / "usgs.xlsx"
+            first.parent.mkdir()
+            second.parent.mkdir()
+            pd.DataFrame(
+                {"id": [1, None], "reporterDesc": ["A", "Other"], "status": ["all", "all"], 2024: [4.0, 2.0]}
+            ).to_excel(first, sheet_name="nickel_mining", index=False)
+            # xlsx files carry a creation timestamp, so copy the bytes rather than writing twice.
+            second.write_bytes(first.read_bytes())
+            parsed = load_workbook(first, persist=True)
+            self.assertIs(load_workbook(second), parsed)
+            self.assertTrue((first.parent / "_parsed" / f"{parsed.digest}.pkl").exists())
+            # Workbooks are only pickled when the caller asks for it.
+            clear_workbook_cache()
+            self.assertEqual(load_workbook(second).digest, parsed.digest)
+            self.assertFalse((second.parent / "_parsed").exists())
+            # Forgetting a workbook removes its own pickle and leaves its neighbours' alone.
+            neighbour = first.parent / "_parsed" / f"{'0' * 64}.pkl"
+            neighbour.write_bytes(b"")
+            forget_workbook(first)
+            self.assertEqual(list((first.parent / "_parsed").iterdir()), [neighbour])
+            neighbour.unlink()
+            forget_workbook(first)
+            self.assertFalse((first.parent / "_parsed").exists())
+            self.assertEqual(
+                parsed.values.loc[parsed.values["year"].eq(2024), "value"].tolist(), [4.0, 2.0]
+            )
+            self.assertEqual(parsed.rows["stage"].tolist(), ["mining", "mining"])
+
+            clear_workbook_cache()
+            self.assertEqual(load_workbook(first).digest, parsed.digest)
+            # load_production persists configured roots unless they are uploads.
+            sources = dict(
+                production_source="usgs",
+                production_roots={"usgs": second},
+                production_all_status_sources=frozenset({"usgs"}),
+            )
+            clear_workbook_cache()
+            load_production(settings(**sources, production_upload_sources=frozenset({"usgs"})), route)
+            self.assertFalse((second.parent / "_parsed").exists())
+            clear_workbook_cache()
+            production = load_production(settings(**sources), route)
+            self.assertTrue((second.parent / "_parsed" / f"{parsed.digest}.pkl").exists())
+        self.assertEqual(production.totals["mining"], {1: 4.0})
+        self.assertEqual([row["description"] for row in production.ignored_rows], ["Other"])
+
+    def test_stages_sharing_a_workbook_read_one_parsed_copy(self) -> None:
+        route = RouteSpec(
+            "three",
+            (
+                ProductionStage("mining", "Mining"),
+                ProductionStage("processing", "Processing"),
+                ProductionStage("refining", "Refining"),
+            ),
+            (),
+        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            workbook = Path(temp_dir) / "ma_2026.xlsx"
+            with pd.ExcelWriter(workbook) as writer:
+                for offset, stage in enumerate(("mining", "processing", "refining")):
+                    pd.DataFrame(
+                        {"id": [1], "reporterDesc": ["A"], "product": ["Total"], "status": ["all"], 2024: [offset + 1.0]}
+                    ).to_excel(writer, sheet_name=f"nickel_{stage}", index=False)
+            session = _WorkbookSession()
+            self.assertIs(session.open(workbook), session.open(workbook))
+            production = load_production(
+                settings(
+                    production_source="ma_2026",
+                    production_roots={"ma_2026": workbook},
+                    production_all_status_sources=frozenset({"ma_2026"}),
+                ),
+                route,
+            )
+        self.assertEqual(
+            {stage: values[1] for stage, values in production.totals.items()},
+            {"mining": 1.0, "processing": 2.0, "refining": 3.0},
+        )
+
     def test_missing_route_stage_file_reports_the_stage(self) -> None:
         with tempfile.TemporaryDirectory() as temp_dir:
             pd.DataFrame({"id": [1], "Desc": ["Country 1"], "2024": [10.0]}).to_excel(
@@ -613,6 +1389,33 @@ class RendererTests(unittest.TestCase):
         self.assertEqual(node_rows["Unknown source"], ("Unknown source", "#8b929a"))
         self.assertEqual(list(trace.link.color).count("rgba(0,0,0,0)"), 1)
 
+    def test_graph_builder_sums_links_by_node_id_and_renders_without_keys(self) -> None:
+        stages = display_stages(ROUTES["intermediate"])
+        source_stage = stages[0].key
+        target_stage = stages[-1].key
+        graph = GraphBuilder(reference(1, 2), {})
+        source = graph.ensure_country(source_stage, 1)
+        target = graph.ensure_country_chemistry(target_stage, 2, "NMC")
+        self.assertEqual((source, target), (0, 1))
+        self.assertEqual(graph.ensure_country(source_stage, 1), source)
+        self.assertEqual((graph.nodes[target].country_id, graph.nodes[target].chemistry), (2, "NMC"))
+        graph.add_link(source, target, 2.0)
+        graph.add_link(source, target, 3.0)
+        graph.add_link(source, target, 0.0)
+        sankey = graph.sankey_graph()
+        self.assertEqual((sankey.sources, sankey.targets, sankey.values), ((0,), (1,), (5.0,)))
+        self.assertEqual(sankey.link_count, 2)
+
+        options = dict(
+            stages=stages, metal="Ni", route="intermediate", reference_quantity=10.0,
+            theme="light", sort_mode="size", label_font_size=16, preserved_country_ids=frozenset({2}),
+            flow_transparency_threshold=10.0,
+        )
+        from_graph = make_figure(graph=sankey, **options)
+        from_specs = make_figure(nodes=graph.node_map(), links=graph.link_specs(), **options)
+        self.assertEqual(from_graph.to_plotly_json(), from_specs.to_plotly_json())
+        self.assertEqual(list(from_graph.data[0].link.color), ["rgba(51, 102, 153, 0.34)"])
+
     def test_renderer_uses_dynamic_stage_count(self) -> None:
         stages = display_stages(ROUTES["intermediate"])
         nodes = {
@@ -0,0 +1,167 @@
+"""Persistent (year, HS code) -> reporter file index for raw trade folders.
+
+One walk of a ``UNComtrade_<year>_Import_ByPartner`` folder records every
+``<reporter>_<hs>_M_<year>_partners.csv`` path by HS code. The index is kept in
+memory and written to ``_compiled/file_index.json`` beside the data, so later
+runs answer "which files exist for year Y, HS H" with one dictionary lookup
+instead of a recursive glob per HS code. It is rebuilt whenever the
+modification times of the year folder's top-level entries change.
+
+The ``download_audit_added_hs_<year>.csv`` files are not used as a seed: they
+cover only the HS codes added by the most recent download batch and record
+absolute paths from the machine that downloaded them.
+"""
+from __future__ import annotations
+
+import json
+import os
+import re
+import threading
+from pathlib import Path
+
+
+CACHE_DIRECTORY = "_compiled"
+INDEX_FILE = "file_index.json"
+INDEX_FORMAT = 1
+YEAR_FOLDER_PATTERN = re.compile(r"^UNComtrade_(\d{4})_Import_ByPartner$")
+PARTNER_FILE_PATTERN = re.compile(
+    r"^(?P<importer>[^_]+)_(?:.*_)?(?P<hs>[^_]+)_M_(?P<year>\d{4})_partners\.csv$"
+)
+
+_INDEXES: dict[Path, "TradeFileIndex"] = {}
+_LOCK = threading.Lock()
+
+
+def year_folder(trade_root: Path, year: int) -> Path:
+    return Path(trade_root) / f"UNComtrade_{int(year)}_Import_ByPartner"
+
+
+def discover_years(trade_root: Path) -> list[int]:
+    years: list[int] = []
+    if not Path(trade_root).exists():
+        return years
+    for child in Path(trade_root).iterdir():
+        match = YEAR_FOLDER_PATTERN.fullmatch(child.name) if child.is_dir() else None
+        if match:
+            years.append(int(match.group(1)))
+    return sorted(set(years))
+
+
+def importer_from_name(name: str) -> int | None:
+    try:
+        importer_id = int(name.split("_", 1)[0])
+    except ValueError:
+        return None
+    return importer_id or None
+
+
+def tree_signature(year_root: Path) -> dict[str, int]:
+    """Modification times of the top-level entries below a year folder.
+
+    Adding, removing, or renaming a reporter file (including replacing one by
+    renaming a new file over it) updates its reporter folder, so one
+    ``scandir`` of the year folder detects those changes without listing every
+    CSV file. A file overwritten in place leaves its folder's modification
+    time unchanged and is not detected.
+    """
+    signature: dict[str, int] = {}
+    with os.scandir(year_root) as entries:
+        for entry in entries:
+            if entry.name == CACHE_DIRECTORY:
+                continue
+            signature[entry.name] = entry.stat().st_mtime_ns
+    return dict(sorted(signature.items()))
+
+
+class TradeFileIndex:
+    def __init__(
+        self,
+        year_root: Path,
+        year: int,
+        signature: dict[str, int],
+        files: dict[str, list[str]],
+    ) -> None:
+        self.year_root = year_root
+        self.year = year
+        self.signature = signature
+        self._files = files
+
+    @property
+    def hs_codes(self) -> list[str]:
+        return sorted(self._files)
+
+    def relative_paths(self, hs_code: str) -> list[str]:
+        return list(self._files.get(hs_code, ()))
+
+    def paths(self, hs_code: str) -> list[Path]:
+        """Files for one HS code, in the order ``sorted(rglob(...))`` returned."""
+        return [self.year_root / name for name in self._files.get(hs_code, ())]
+
+    def to_json(self) -> dict[str, object]:
+        return {
+            "format": INDEX_FORMAT,
+            "year": self.year,
+            "signature": self.signature,
+            "files": self._files,
+        }
+
+
+def build_file_index(year_root: Path, year: int) -> TradeFileIndex:
+    signature = tree_signature(year_root)
+    by_hs: dict[str, list[Path]] = {}
+    for path in year_root.rglob(f"*_M_{int(year)}_partners.csv"):
+        if CACHE_DIRECTORY in path.relative_to(year_root).parts:
+            continue
+        match = PARTNER_FILE_PATTERN.fullmatch(path.name)
+        if match is not None:
+            by_hs.setdefault(match.group("hs"), []).append(path)
+    files = {
+        hs_code: [path.relative_to(year_root).as_posix() for path in sorted(paths)]
+        for hs_code, paths in sorted(by_hs.items())
+    }
+    return TradeFileIndex(year_root, int(year), signature, files)
+
+
+def _read_persisted(year_root: Path, year: int, signature: dict[str, int]) -> TradeFileIndex | None:
+    try:
+        payload = json.loads((year_root / CACHE_DIRECTORY / INDEX_FILE).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if (
+        payload.get("format") != INDEX_FORMAT
+        or payload.get("year") != int(year)
+        or payload.get("signature") != signature
+    ):
+        return None
+    files = {str(hs): [str(name) for name in names] for hs, names in dict(payload.get("files", {})).items()}
+    return TradeFileIndex(year_root, int(year), signature, files)
+
+
+def _persist(index: TradeFileIndex) -> None:
+    directory = index.year_root / CACHE_DIRECTORY
+    try:
+        directory.mkdir(exist_ok=True)
+        temporary = directory / f".{INDEX_FILE}.tmp"
+        temporary.write_text(json.dumps(index.to_json()), encoding="utf-8")
+        temporary.replace(directory / INDEX_FILE)
+    except OSError:
+        # A read-only data folder still gets the in-memory index.
+        pass
+
+
+def load_file_index(trade_root: Path, year: int) -> TradeFileIndex:
+    """Return the current file index for one year folder, rebuilding it if stale."""
+    year_root = year_folder(trade_root, year)
+    if not year_root.exists():
+        raise FileNotFoundError(f"Raw import folder does not exist: {year_root}")
+    signature = tree_signature(year_root)
+    with _LOCK:
+        index = _INDEXES.get(year_root)
+        if index is not None and index.signature == signature:
+            return index
+        index = _read_persisted(year_root, year, signature)
+        if index is None:
+            index = build_file_index(year_root, year)
+            _persist(index)
+        _INDEXES[year_root] = index
+        return index
@@ -0,0 +1,366 @@
+"""Compiled import-by-partner trade store.
+
+The raw ``UNComtrade_<year>_Import_ByPartner`` trees hold one small CSV per
+reporter and HS code. ``compile_trade_year`` turns one year tree into a sparse
+exporter x importer matrix per HS code, with World rows already dropped and
+tonnes already summed, so ``load_trade_records`` maps one file per HS code
+instead of walking and parsing the raw tree on every run.
+
+Each matrix is a ``<hs>.coo.npy`` array of (exporter, importer, tonnes,
+source_end) records whose exporter and importer are positions in the year's
+shared ``countries.npy`` dictionary. ``<hs>.sources.npy`` lists the raw file
+ids behind each pair; pair ``i`` owns ``sources[source_end[i - 1]:source_end[i]]``
+and the ids index ``TradeFileIndex.relative_paths(hs)``. Plain ``.npy`` files
+are opened with ``mmap_mode="r"``, so web workers share the operating
+system's page cache instead of each holding a private copy.
+
+Run ``python trade_store.py`` from this folder (or ``--trade-root``/``--year``)
+after adding or replacing raw files. A partition is only used while the
+directory signature recorded at compile time still matches the raw tree;
+otherwise the loader silently falls back to the raw CSV files.
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import pandas as pd
+
+from models import EPSILON
+from trade_index import (
+    CACHE_DIRECTORY,
+    TradeFileIndex,
+    discover_years,
+    importer_from_name,
+    load_file_index,
+)
+
+
+STORE_FORMAT = 2
+COUNTRIES_FILE = "countries.npy"
+COO_DTYPE = np.dtype([
+    ("exporter", "<i4"),
+    ("importer", "<i4"),
+    ("tonnes", "<f8"),
+    ("source_end", "<i8"),
+])
+TRADE_COLUMNS = frozenset({"partnerCode", "qtyUnitAbbr", "qty", "netWgt", "netWeight"})
+_TONNE_UNITS = ("t", "ton", "tonne", "tonnes")
+_HEADER_POSITIONS: dict[tuple[str, ...], dict[str, int]] = {}
+
+
+def _column_positions(header: list[str]) -> dict[str, int]:
+    """Positions of the used Comtrade columns, resolved once per header layout."""
+    key = tuple(header)
+    positions = _HEADER_POSITIONS.get(key)
+    if positions is None:
+        positions = {}
+        for position, name in enumerate(header):
+            if name in TRADE_COLUMNS and name not in positions:
+                positions[name] = position
+        _HEADER_POSITIONS[key] = positions
+    return positions
+
+
+def _to_number(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return float("nan")
+
+
+def _numbers(values: list[str]) -> np.ndarray:
+    return np.array([_to_number(value) for value in values], dtype=np.float64)
+
+
+def _quantity_to_tonnes(columns: dict[str, list[str]], row_count: int) -> np.ndarray:
+    tonnes = np.full(row_count, np.nan)
+    has_quantity_schema = False
+    if "qtyUnitAbbr" in columns and "qty" in columns:
+        has_quantity_schema = True
+        quantity = _numbers(columns["qty"])
+        unit = np.array([value.strip().lower() for value in columns["qtyUnitAbbr"]], dtype=object)
+        kilograms = unit == "kg"
+        tonnes[kilograms] = quantity[kilograms] / 1000.0
+        metric_tons = np.isin(unit, _TONNE_UNITS)
+        tonnes[metric_tons] = quantity[metric_tons]
+
+    # UN Comtrade exports in this data series use both netWgt and netWeight.
+    # Apply the fallback row by row: a file can mix rows reported in kg with
+    # rows whose qty unit is N/A but whose net weight is still available.
+    for weight_column in ("netWgt", "netWeight"):
+        if weight_column not in columns:
+            continue
+        has_quantity_schema = True
+        missing = np.isnan(tonnes)
+        tonnes[missing] = _numbers(columns[weight_column])[missing] / 1000.0
+
+    present = ~np.isnan(tonnes)
+    if present.any():
+        tonnes[~present] = 0.0
+        return tonnes
+    if has_quantity_schema:
+        # A few reporter/HS files contain the expected Comtrade quantity
+        # columns but no reported values. They contribute zero trade rather
+        # than invalidating every other reporter in the scenario.
+        return np.zeros(row_count)
+    raise ValueError(
+        "Raw trade file is missing usable qty/qtyUnitAbbr and netWgt/netWeight columns."
+    )
+
+
+def read_partner_file(path: Path) -> tuple[np.ndarray, np.ndarray] | None:
+    """Return partner codes and tonnes as float arrays, or None without a partner column.
+
+    Partner files share one fixed Comtrade export layout, so only the used
+    columns are pulled out of each row by position. ``utf-8-sig`` drops the
+    byte-order mark the exports start with; blank or non-numeric values
+    become NaN, as with ``pd.to_numeric(errors="coerce")``.
+    """
+    with path.open("r", encoding="utf-8-sig", newline="") as handle:
+        reader = csv.reader(handle)
+        header = next(reader, None)
+        if header is None:
+            raise pd.errors.EmptyDataError("No columns to parse from file")
+        positions = _column_positions(header)
+        if "partnerCode" not in positions:
+            return None
+        columns: dict[str, list[str]] = {name: [] for name in positions}
+        fields = list(positions.items())
+        for row in reader:
+            if not row:
+                continue
+            width = len(row)
+            for name, position in fields:
+                columns[name].append(row[position] if position < width else "")
+    partners = _numbers(columns["partnerCode"])
+    return partners, _quantity_to_tonnes(columns, len(partners))
+
+
+def _empty_rows(files: list[str]) -> dict[str, np.ndarray]:
+    return {
+        "files": np.array(files, dtype=str),
+        "file_id": np.empty(0, dtype=np.int32),
+        "exporter_id": np.empty(0, dtype=np.int64),
+        "importer_id": np.empty(0, dtype=np.int64),
+        "tonnes": np.empty(0, dtype=np.float64),
+    }
+
+
+def _file_rows(path: Path) -> tuple[int, np.ndarray, np.ndarray] | None:
+    importer_id = importer_from_name(path.name)
+    if importer_id is None:
+        return None
+    parsed = read_partner_file(path)
+    if parsed is None:
+        return None
+    partners, tonnes = parsed
+    present = ~np.isnan(partners)
+    exporters = partners[present].astype(np.int64)
+    tonnes = tonnes[present]
+    keep = (exporters != 0) & (tonnes > EPSILON)
+    if not keep.any():
+        return None
+    return importer_id, exporters[keep], tonnes[keep]
+
+
+def read_bilateral_rows(
+    year_root: Path,
+    paths: list[Path],
+    max_workers: int = 1,
+) -> dict[str, np.ndarray]:
+    """Concatenate the bilateral rows of one HS code's partner files.
+
+    Rows keep the file and row order of the raw files. Rows without a partner
+    code, partnerCode=0 World aggregates, and rows at or below ``EPSILON``
+    tonnes are removed with masks. With ``max_workers > 1`` the files are
+    parsed on a bounded thread pool; results are collected in path order, so
+    the output does not depend on the worker count.
+    """
+    files = [path.relative_to(year_root).as_posix() for path in paths]
+    workers = max(1, min(int(max_workers), len(paths)))
+    if workers == 1:
+        parsed = [_file_rows(path) for path in paths]
+    else:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="trade-csv") as executor:
+            parsed = list(executor.map(_file_rows, paths))
+    parts = [(file_id, *result) for file_id, result in enumerate(parsed) if result is not None]
+    if not parts:
+        return _empty_rows(files)
+    sizes = [part[2].size for part in parts]
+    return {
+        "files": np.array(files, dtype=str),
+        "file_id": np.repeat(np.array([part[0] for part in parts], dtype=np.int32), sizes),
+        "exporter_id": np.concatenate([part[2] for part in parts]),
+        "importer_id": np.repeat(np.array([part[1] for part in parts], dtype=np.int64), sizes),
+        "tonnes": np.concatenate([part[3] for part in parts]),
+    }
+
+
+def aggregate_bilateral(rows: dict[str, np.ndarray]) -> dict[str, Any]:
+    """Sum bilateral rows per (exporter, importer), sorted by exporter then importer.
+
+    ``np.bincount`` adds the weights sequentially in row order, so the totals
+    are bit-identical to accumulating the same rows one at a time.
+    """
+    if rows["tonnes"].size == 0:
+        return {
+            "exporter_id": np.empty(0, dtype=np.int64),
+            "importer_id": np.empty(0, dtype=np.int64),
+            "tonnes": np.empty(0, dtype=np.float64),
+            "file_ids": [],
+        }
+    pairs = np.stack([rows["exporter_id"], rows["importer_id"]], axis=1)
+    unique_pairs, inverse = np.unique(pairs, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    tonnes = np.bincount(inverse, weights=rows["tonnes"], minlength=len(unique_pairs))
+    pair_files = np.unique(np.stack([inverse, rows["file_id"].astype(np.int64)], axis=1), axis=0)
+    boundaries = np.flatnonzero(np.diff(pair_files[:, 0])) + 1
+    file_ids = [group.tolist() for group in np.split(pair_files[:, 1], boundaries)]
+    return {
+        "exporter_id": unique_pairs[:, 0],
+        "importer_id": unique_pairs[:, 1],
+        "tonnes": tonnes,
+        "file_ids": file_ids,
+    }
+
+
+def _save_array(path: Path, array: np.ndarray) -> None:
+    temporary = path.with_name(f".{path.name}.tmp")
+    with temporary.open("wb") as handle:
+        np.save(handle, array, allow_pickle=False)
+    temporary.replace(path)
+
+
+def country_dictionary(*id_arrays: np.ndarray) -> np.ndarray:
+    """Sorted country ids; ``searchsorted`` against it yields dense positions."""
+    arrays = [np.asarray(ids, dtype=np.int64) for ids in id_arrays]
+    return np.unique(np.concatenate(arrays)) if arrays else np.empty(0, dtype=np.int64)
+
+
+def source_lists(file_ids: list[list[int]]) -> tuple[np.ndarray, np.ndarray]:
+    """Flatten per-pair file id lists into cumulative ends and concatenated ids."""
+    ends = np.cumsum([len(ids) for ids in file_ids], dtype=np.int64)
+    flat = [file_id for ids in file_ids for file_id in ids]
+    return ends, np.array(flat, dtype=np.int32)
+
+
+def compile_trade_year(trade_root: Path, year: int, max_workers: int = 1) -> dict[str, Any]:
+    """Compile one raw year folder into per-HS sparse matrices and return its manifest."""
+    index = load_file_index(trade_root, year)
+    year_root = index.year_root
+    store_root = year_root / CACHE_DIRECTORY
+    store_root.mkdir(exist_ok=True)
+    for pattern in ("*.npz", "*.npy"):
+        for stale in store_root.glob(pattern):
+            stale.unlink()
+    grouped_by_hs: dict[str, dict[str, Any]] = {}
+    compiled: dict[str, int] = {}
+    skipped: dict[str, str] = {}
+    for hs_code in index.hs_codes:
+        paths = index.paths(hs_code)
+        names = [path.name for path in paths]
+        if len(set(names)) != len(names):
+            # Leave duplicate layouts to the raw loader, which reports them.
+            skipped[hs_code] = "duplicate file names"
+            continue
+        rows = read_bilateral_rows(year_root, paths, max_workers)
+        grouped_by_hs[hs_code] = aggregate_bilateral(rows)
+        compiled[hs_code] = int(rows["tonnes"].size)
+
+    countries = country_dictionary(
+        *(grouped[axis] for grouped in grouped_by_hs.values() for axis in ("exporter_id", "importer_id"))
+    )
+    _save_array(store_root / COUNTRIES_FILE, countries)
+    for hs_code, grouped in grouped_by_hs.items():
+        source_end, source_ids = source_lists(grouped["file_ids"])
+        matrix = np.empty(len(grouped["tonnes"]), dtype=COO_DTYPE)
+        matrix["exporter"] = np.searchsorted(countries, grouped["exporter_id"])
+        matrix["importer"] = np.searchsorted(countries, grouped["importer_id"])
+        matrix["tonnes"] = grouped["tonnes"]
+        matrix["source_end"] = source_end
+        _save_array(store_root / f"{hs_code}.coo.npy", matrix)
+        _save_array(store_root / f"{hs_code}.sources.npy", source_ids)
+
+    manifest = {
+        "format": STORE_FORMAT,
+        "year": int(year),
+        "signature": index.signature,
+        "hs_codes": compiled,
+        "skipped": skipped,
+    }
+    (store_root / "manifest.json").write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+    return manifest
+
+
+class CompiledTradeYear:
+    def __init__(self, year_root: Path, hs_codes: dict[str, int]) -> None:
+        self.year_root = year_root
+        self.hs_codes = hs_codes
+
+    def matrix(self, hs_code: str) -> dict[str, np.ndarray] | None:
+        """Memory-mapped COO columns for one HS code, or None when it was not compiled."""
+        if hs_code not in self.hs_codes:
+            return None
+        store_root = self.year_root / CACHE_DIRECTORY
+        try:
+            countries = np.load(store_root / COUNTRIES_FILE, mmap_mode="r", allow_pickle=False)
+            matrix = np.load(store_root / f"{hs_code}.coo.npy", mmap_mode="r", allow_pickle=False)
+            source_ids = np.load(store_root / f"{hs_code}.sources.npy", mmap_mode="r", allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+        if matrix.dtype != COO_DTYPE:
+            return None
+        return {
+            "countries": countries,
+            "exporter_index": matrix["exporter"],
+            "importer_index": matrix["importer"],
+            "tonnes": matrix["tonnes"],
+            "source_end": matrix["source_end"],
+            "source_ids": source_ids,
+        }
+
+
+def open_trade_year(index: TradeFileIndex) -> CompiledTradeYear | None:
+    """Return the compiled store matching a file index, or None when absent or stale."""
+    manifest_path = index.year_root / CACHE_DIRECTORY / "manifest.json"
+    try:
+        manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if manifest.get("format") != STORE_FORMAT or manifest.get("year") != index.year:
+        return None
+    if manifest.get("signature") != index.signature:
+        return None
+    return CompiledTradeYear(index.year_root, dict(manifest.get("hs_codes", {})))
+
+
+def main() -> None:
+    default_root = Path(os.environ.get(
+        "SANKEY_TRADE_ROOT",
+        os.environ.get("SANKEY_DATA_ROOT", str(Path(__file__).resolve().parents[1] / "data")),
+    ))
+    parser = argparse.ArgumentParser(
+        description="Compile UNComtrade import-by-partner folders into per-HS trade partitions."
+    )
+    parser.add_argument("--trade-root", type=Path, default=default_root)
+    parser.add_argument("--year", type=int, action="append", help="Year to compile; repeatable. Defaults to all.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Partner files parsed concurrently.")
+    args = parser.parse_args()
+    years = args.year or discover_years(args.trade_root)
+    for year in years:
+        manifest = compile_trade_year(args.trade_root, year, args.workers)
+        print(
+            f"{year}: {len(manifest['hs_codes'])} HS partitions, "
+            f"{sum(manifest['hs_codes'].values())} bilateral rows"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+"""Struct-of-arrays form of one transition's trade records.
+
+A ``TradeTable`` holds the same fields as a list of ``TradeRecord`` objects,
+one aligned NumPy column per field. HS codes and target products are stored as
+codes into small per-table category tuples, classification and adjustment
+reason as codes into the module-level ``CLASSIFICATIONS`` and
+``ADJUSTMENT_REASONS`` tuples, and provenance as ids into the table's
+``source_paths`` in CSR form (``source_end`` / ``source_ids``), so each raw
+partner file path is stored once per table instead of once per record.
+
+``load_trade_table`` builds tables directly from the bilateral matrices, and
+the flow builders work on tables. ``records`` and ``update_records`` convert to
+and from ``TradeRecord`` lists for callers that still use them.
+"""
+from __future__ import annotations
+
+import hashlib
+from dataclasses import dataclass
+from typing import Any, Sequence
+
+import numpy as np
+
+from models import TradeRecord
+
+
+CLASSIFICATIONS = (
+    "producer_to_producer",
+    "producer_to_non_target",
+    "non_source_to_producer",
+    "non_source_to_non_target",
+    "",
+)
+PRODUCER_TO_PRODUCER = 0
+PRODUCER_TO_NON_TARGET = 1
+NON_SOURCE_TO_PRODUCER = 2
+NON_SOURCE_TO_NON_TARGET = 3
+UNCLASSIFIED = 4
+
+ADJUSTMENT_REASONS = (
+    "",
+    "ignored: no upstream production and no downstream production",
+    "non-source exporter; preserved without production scaling",
+    "production cap applied to exporter total",
+    "manual factor retained; exporter production cap not binding",
+    "trade-only mode; manual factor retained without production scaling",
+)
+IGNORED = 1
+NON_SOURCE_EXPORTER = 2
+CAP_APPLIED = 3
+CAP_NOT_BINDING = 4
+TRADE_ONLY = 5
+
+# Columns the builders fill in; ``update_records`` copies them back.
+COMPUTED_COLUMNS = (
+    "manual_conversion_factor",
+    "chemistry_factor_basis",
+    "chemistry_factor_detail",
+    "classification",
+    "converted_quantity_before_scaling",
+    "available_source_production",
+    "exporter_total_before_scaling",
+    "production_scaling_multiplier",
+    "effective_conversion_factor",
+    "final_trade_quantity_tonnes",
+    "included_in_sankey",
+    "adjustment_reason",
+)
+# The arrays behind those columns, as ``computed_state`` copies them.
+COMPUTED_ARRAYS = (
+    "manual_conversion_factor",
+    "chemistry_factor_basis",
+    "chemistry_factor_detail",
+    "classification_code",
+    "converted_quantity_before_scaling",
+    "available_source_production",
+    "exporter_total_before_scaling",
+    "production_scaling_multiplier",
+    "effective_conversion_factor",
+    "final_trade_quantity_tonnes",
+    "included_in_sankey",
+    "reason_code",
+)
+
+
+def _codes(values: Sequence[str]) -> tuple[tuple[str, ...], Any]:
+    categories: dict[str, int] = {}
+    codes = np.fromiter(
+        (categories.setdefault(value, len(categories)) for value in values), dtype=np.int32, count=len(values)
+    )
+    return tuple(categories), codes
+
+
+def _strings(count: int) -> Any:
+    values = np.empty(count, dtype=object)
+    values.fill("")
+    return values
+
+
+@dataclass
+class TradeTable:
+    transition: str
+    hs_codes: tuple[str, ...]
+    hs_index: Any
+    target_products: tuple[str, ...]
+    product_index: Any
+    importer_id: Any
+    exporter_id: Any
+    raw_quantity_tonnes: Any
+    manual_conversion_factor: Any
+    configured_conversion_factor: Any
+    source_paths: tuple[str, ...]
+    source_end: Any
+    source_ids: Any
+    chemistry_factor_basis: Any
+    chemistry_factor_detail: Any
+    classification_code: Any
+    converted_quantity_before_scaling: Any
+    available_source_production: Any
+    exporter_total_before_scaling: Any
+    production_scaling_multiplier: Any
+    effective_conversion_factor: Any
+    final_trade_quantity_tonnes: Any
+    included_in_sankey: Any
+    reason_code: Any
+
+    @classmethod
+    def from_columns(
+        cls,
+        transition: str,
+        *,
+        hs_codes: Sequence[str],
+        target_products: Sequence[str],
+        importer_id: Any,
+        exporter_id: Any,
+        raw_quantity_tonnes: Any,
+        manual_conversion_factor: Any,
+        configured_conversion_factor: Any,
+        source_files: Sequence[Sequence[str]],
+    ) -> "TradeTable":
+        """Build an unprepared table; ``hs_codes`` and ``target_products`` are per row."""
+        count = len(importer_id)
+        hs_categories, hs_index = _codes(hs_codes)
+        product_categories, product_index = _codes(target_products)
+        paths: dict[str, int] = {}
+        ids: list[int] = []
+        ends: list[int] = []
+        for files in source_files:
+            ids.extend(paths.setdefault(path, len(paths)) for path in files)
+            ends.append(len(ids))
+        return cls(
+            transition=transition,
+            hs_codes=hs_categories,
+            hs_index=hs_index,
+            target_products=product_categories,
+            product_index=product_index,
+            importer_id=np.asarray(importer_id, dtype=np.int64),
+            exporter_id=np.asarray(exporter_id, dtype=np.int64),
+            raw_quantity_tonnes=np.asarray(raw_quantity_tonnes, dtype=float),
+            manual_conversion_factor=np.array(manual_conversion_factor, dtype=float),
+            configured_conversion_factor=np.asarray(configured_conversion_factor, dtype=float),
+            source_paths=tuple(paths),
+            source_end=np.asarray(ends, dtype=np.int64),
+            source_ids=np.asarray(ids, dtype=np.int32),
+            chemistry_factor_basis=_strings(count),
+            chemistry_factor_detail=_strings(count),
+            classification_code=np.full(count, UNCLASSIFIED, dtype=np.int8),
+            converted_quantity_before_scaling=np.zeros(count),
+            available_source_production=np.zeros(count),
+            exporter_total_before_scaling=np.zeros(count),
+            production_scaling_multiplier=np.ones(count),
+            effective_conversion_factor=np.zeros(count),
+            final_trade_quantity_tonnes=np.zeros(count),
+            included_in_sankey=np.ones(count, dtype=bool),
+            reason_code=np.zeros(count, dtype=np.int8),
+        )
+
+    @classmethod
+    def empty(cls, transition: str) -> "TradeTable":
+        return cls.from_columns(
+            transition,
+            hs_codes=(),
+            target_products=(),
+            importer_id=(),
+            exporter_id=(),
+            raw_quantity_tonnes=(),
+            manual_conversion_factor=(),
+            configured_conversion_factor=(),
+            source_files=(),
+        )
+
+    @classmethod
+    def from_records(cls, records: Sequence[TradeRecord], transition: str = "") -> "TradeTable":
+        table = cls.from_columns(
+            records[0].transition if records else transition,
+            hs_codes=[record.hs_code for record in records],
+            target_products=[record.target_product for record in records],
+            importer_id=[record.importer_id for record in records],
+            exporter_id=[record.exporter_id for record in records],
+            raw_quantity_tonnes=[record.raw_quantity_tonnes for record in records],
+            manual_conversion_factor=[record.manual_conversion_factor for record in records],
+            configured_conversion_factor=[record.configured_conversion_factor for record in records],
+            source_files=[record.source_files for record in records],
+        )
+        table.chemistry_factor_basis[:] = [record.chemistry_factor_basis for record in records]
+        table.chemistry_factor_detail[:] = [record.chemistry_factor_detail for record in records]
+        return table
+
+    def __len__(self) -> int:
+        return int(len(self.importer_id))
+
+    @property
+    def nbytes(self) -> int:
+        arrays = [value for value in vars(self).values() if isinstance(value, np.ndarray)]
+        return int(sum(array.nbytes for array in arrays)) + sum(len(path) + 49 for path in self.source_paths)
+
+    def hs_code_values(self) -> Any:
+        return np.asarray(self.hs_codes, dtype=object)[self.hs_index] if self.hs_codes else _strings(0)
+
+    def target_product_values(self) -> Any:
+        return np.asarray(self.target_products, dtype=object)[self.product_index] if self.target_products else _strings(0)
+
+    def classification_values(self) -> Any:
+        return np.asarray(CLASSIFICATIONS, dtype=object)[self.classification_code]
+
+    def adjustment_reason_values(self) -> Any:
+        return np.asarray(ADJUSTMENT_REASONS, dtype=object)[self.reason_code]
+
+    def source_file_lists(self) -> list[list[str]]:
+        paths = self.source_paths
+        ids = self.source_ids.tolist()
+        files: list[list[str]] = []
+        start = 0
+        for end in self.source_end.tolist():
+            files.append([paths[file_id] for file_id in ids[start:end]])
+            start = end
+        return files
+
+    def input_digest(self) -> str:
+        """Digest of the loaded columns and the current factors and chemistry notes."""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr((self.transition, self.hs_codes, self.target_products, self.source_paths)).encode())
+        digest.update(repr((self.chemistry_factor_basis.tolist(), self.chemistry_factor_detail.tolist())).encode())
+        for column in (
+            self.hs_index,
+            self.product_index,
+            self.importer_id,
+            self.exporter_id,
+            self.raw_quantity_tonnes,
+            self.manual_conversion_factor,
+            self.configured_conversion_factor,
+            self.source_end,
+            self.source_ids,
+        ):
+            digest.update(len(column).to_bytes(8, "little"))
+            digest.update(np.ascontiguousarray(column).tobytes())
+        return digest.hexdigest()
+
+    def computed_state(self) -> dict[str, Any]:
+        """Copies of the builder-filled arrays, for ``restore_computed``."""
+        return {name: getattr(self, name).copy() for name in COMPUTED_ARRAYS}
+
+    def restore_computed(self, state: dict[str, Any]) -> None:
+        for name in COMPUTED_ARRAYS:
+            setattr(self, name, state[name].copy())
+
+    def _computed_values(self) -> dict[str, list[Any]]:
+        return {
+            "manual_conversion_factor": self.manual_conversion_factor.tolist(),
+            "chemistry_factor_basis": self.chemistry_factor_basis.tolist(),
+            "chemistry_factor_detail": self.chemistry_factor_detail.tolist(),
+            "classification": self.classification_values().tolist(),
+            "converted_quantity_before_scaling": self.converted_quantity_before_scaling.tolist(),
+            "available_source_production": self.available_source_production.tolist(),
+            "exporter_total_before_scaling": self.exporter_total_before_scaling.tolist(),
+            "production_scaling_multiplier": self.production_scaling_multiplier.tolist(),
+            "effective_conversion_factor": self.effective_conversion_factor.tolist(),
+            "final_trade_quantity_tonnes": self.final_trade_quantity_tonnes.tolist(),
+            "included_in_sankey": self.included_in_sankey.tolist(),
+            "adjustment_reason": self.adjustment_reason_values().tolist(),
+        }
+
+    def records(self) -> list[TradeRecord]:
+        """Materialize one ``TradeRecord`` per row."""
+        computed = self._computed_values()
+        return [
+            TradeRecord(
+                transition=self.transition,
+                hs_code=hs_code,
+                importer_id=importer_id,
+                exporter_id=exporter_id,
+                raw_quantity_tonnes=quantity,
+                configured_conversion_factor=configured,
+                target_product=target_product,
+                source_files=source_files,
+                **{name: values[position] for name, values in computed.items()},
+            )
+            for position, (hs_code, importer_id, exporter_id, quantity, configured, target_product, source_files)
+            in enumerate(
+                zip(
+                    self.hs_code_values().tolist(),
+                    self.importer_id.tolist(),
+                    self.exporter_id.tolist(),
+                    self.raw_quantity_tonnes.tolist(),
+                    self.configured_conversion_factor.tolist(),
+                    self.target_product_values().tolist(),
+                    self.source_file_lists(),
+                )
+            )
+        ]
+
+    def update_records(self, records: Sequence[TradeRecord]) -> None:
+        """Copy the builder-filled columns back onto the records this table came from."""
+        computed = self._computed_values()
+        for position, record in enumerate(records):
+            for name in COMPUTED_COLUMNS:
+                setattr(record, name, computed[name][position])
+
+
+def as_trade_table(records: "TradeTable | Sequence[TradeRecord]", transition: str = "") -> TradeTable:
+    if isinstance(records, TradeTable):
+        return records
+    return TradeTable.from_records(records, transition)
+
+
+def sync_records(records: "TradeTable | Sequence[TradeRecord]", table: TradeTable) -> None:
+    """Write ``table`` back when the caller passed ``TradeRecord`` objects."""
+    if not isinstance(records, TradeTable):
+        table.update_records(records)
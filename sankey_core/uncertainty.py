@@ -0,0 +1,204 @@
+"""Monte Carlo uncertainty bands for production-basis runs.
+
+``FACTOR_DISTRIBUTIONS`` gives an HS code's conversion factor a distribution
+and ``PRODUCTION_DISTRIBUTIONS`` a stage's production a relative multiplier,
+drawn independently per country. ``monte_carlo_bands`` draws
+``MONTE_CARLO_DRAWS`` settings and evaluates them all in one
+``FlowModel.evaluate`` call over the run's loaded inputs, so one draw costs a
+few array rows rather than a pipeline run. The result holds percentile bands
+per link and per node at the country-view granularity of ``factor_sweep``.
+
+Distributions are tuples: ``("uniform", low, high)``,
+``("triangular", low, mode, high)``, ``("normal", mean, sd)`` and
+``("lognormal", median, sigma)``. Negative draws are set to zero.
+"""
+from __future__ import annotations
+
+from collections.abc import Mapping
+from dataclasses import dataclass
+from typing import Any
+
+import numpy as np
+import pandas as pd
+
+from factor_sweep import FlowModel, build_flow_model
+from models import EPSILON, RunInputs, Settings
+
+
+DISTRIBUTION_PARAMETERS = {"uniform": 2, "triangular": 3, "normal": 2, "lognormal": 2}
+BAND_COLUMNS = [
+    "metal",
+    "year",
+    "route",
+    "element",
+    "node_key",
+    "source_key",
+    "target_key",
+    "label",
+    "draws",
+    "point_estimate",
+    "mean",
+    "std",
+]
+
+
+def parse_distribution(spec: Any, name: str) -> tuple[Any, ...]:
+    """Validate one distribution tuple and return it with float parameters."""
+    try:
+        kind, *raw = spec
+        kind = str(kind).strip().lower()
+        parameters = [float(value) for value in raw]
+    except (TypeError, ValueError) as exc:
+        raise ValueError(f"{name} must be a tuple such as ('normal', mean, sd).") from exc
+    if DISTRIBUTION_PARAMETERS.get(kind) != len(parameters):
+        expected = ", ".join(f"{key} ({count} values)" for key, count in DISTRIBUTION_PARAMETERS.items())
+        raise ValueError(f"{name} must be one of: {expected}.")
+    if not all(np.isfinite(parameters)):
+        raise ValueError(f"{name} parameters must be finite.")
+    if kind == "uniform" and parameters[0] > parameters[1]:
+        raise ValueError(f"{name} needs low <= high.")
+    if kind == "triangular" and not parameters[0] <= parameters[1] <= parameters[2]:
+        raise ValueError(f"{name} needs low <= mode <= high.")
+    if kind == "normal" and parameters[1] < 0:
+        raise ValueError(f"{name} needs a non-negative standard deviation.")
+    if kind == "lognormal" and (parameters[0] <= 0 or parameters[1] < 0):
+        raise ValueError(f"{name} needs a positive median and a non-negative sigma.")
+    return (kind, *parameters)
+
+
+def sample(spec: tuple[Any, ...], generator: np.random.Generator, size: Any) -> Any:
+    kind, *parameters = spec
+    if kind == "uniform":
+        draws = generator.uniform(parameters[0], parameters[1], size)
+    elif kind == "triangular":
+        low, mode, high = parameters
+        draws = np.full(size, low) if high == low else generator.triangular(low, mode, high, size)
+    elif kind == "normal":
+        draws = generator.normal(parameters[0], parameters[1], size)
+    else:
+        draws = parameters[0] * np.exp(parameters[1] * generator.standard_normal(size))
+    return np.maximum(draws, 0.0)
+
+
+def _percentile_label(percentile: float) -> str:
+    return f"p{percentile:g}"
+
+
+@dataclass(frozen=True)
+class ElementBands:
+    """Point estimate and draw statistics of aligned nodes or links."""
+
+    point: Any
+    mean: Any
+    std: Any
+    bands: Any
+
+    @classmethod
+    def from_draws(cls, point: Any, draws: Any, percentiles: tuple[float, ...]) -> "ElementBands":
+        return cls(
+            point=point,
+            mean=draws.mean(axis=0),
+            std=draws.std(axis=0),
+            bands=np.percentile(draws, percentiles, axis=0).reshape(len(percentiles), -1),
+        )
+
+    def active(self) -> Any:
+        """Elements with a flow in the point estimate or any band."""
+        return (self.point > EPSILON) | (self.bands > EPSILON).any(axis=0)
+
+
+@dataclass(frozen=True)
+class UncertaintyBands:
+    """Percentile bands of every country-view node and link of a run."""
+
+    draws: int
+    percentiles: tuple[float, ...]
+    node_keys: tuple[str, ...]
+    nodes: ElementBands
+    link_keys: tuple[tuple[str, str], ...]
+    links: ElementBands
+
+    def node_band(self, key: str) -> dict[str, float]:
+        position = self.node_keys.index(key)
+        return {
+            _percentile_label(percentile): float(value)
+            for percentile, value in zip(self.percentiles, self.nodes.bands[:, position].tolist())
+        }
+
+    def hover_annotations(self) -> dict[str, str]:
+        """``{node_key: text}`` with the outer percentile band of each active node."""
+        low, high = self.nodes.bands[0], self.nodes.bands[-1]
+        label = f"P{self.percentiles[0]:g}-P{self.percentiles[-1]:g}"
+        return {
+            key: f"{label}: {low[position]:,.0f} to {high[position]:,.0f} t"
+            for position, key in enumerate(self.node_keys)
+            if self.nodes.point[position] > EPSILON or high[position] > EPSILON
+        }
+
+    def frame(self, settings: Settings, route: str, labels: Mapping[str, str]) -> pd.DataFrame:
+        """One row per active node, then per active link."""
+        percentile_columns = [_percentile_label(percentile) for percentile in self.percentiles]
+        blocks = []
+        for element, keys, bands in (
+            ("node", [(key, "", "") for key in self.node_keys], self.nodes),
+            ("link", [("", source, target) for source, target in self.link_keys], self.links),
+        ):
+            active = bands.active()
+            chosen = [entry for entry, keep in zip(keys, active.tolist()) if keep]
+            block = pd.DataFrame(chosen, columns=["node_key", "source_key", "target_key"])
+            block["label"] = [
+                labels.get(node, node) if node else f"{labels.get(source, source)} -> {labels.get(target, target)}"
+                for node, source, target in chosen
+            ]
+            block["element"] = element
+            block["point_estimate"] = bands.point[active]
+            block["mean"] = bands.mean[active]
+            block["std"] = bands.std[active]
+            for column, values in zip(percentile_columns, bands.bands):
+                block[column] = values[active]
+            blocks.append(block)
+        frame = pd.concat(blocks, ignore_index=True)
+        frame["metal"] = settings.metal
+        frame["year"] = settings.year
+        frame["route"] = route
+        frame["draws"] = self.draws
+        return frame[BAND_COLUMNS + percentile_columns]
+
+
+def _draw_inputs(settings: Settings, model: FlowModel, generator: np.random.Generator) -> tuple[Any, Any]:
+    draws = settings.monte_carlo_draws
+    factors = np.tile(model.base_factors, (draws, 1))
+    for hs_code, spec in settings.factor_distributions.items():
+        factors[:, model.parameter_columns(hs_code)] = sample(spec, generator, (draws, 1))
+    if not settings.production_distributions:
+        return factors, None
+    stage_totals = np.repeat(model.stage_totals[None], draws, axis=0)
+    for stage, spec in settings.production_distributions.items():
+        if stage in model.stages:
+            position = model.stages.index(stage)
+            stage_totals[:, position] *= sample(spec, generator, (draws, len(model.countries)))
+    return factors, stage_totals
+
+
+def monte_carlo_bands(
+    settings: Settings,
+    inputs: RunInputs,
+    model: FlowModel | None = None,
+) -> UncertaintyBands:
+    """Draw ``settings.monte_carlo_draws`` factor and production settings and band the flows."""
+    if settings.monte_carlo_draws < 1:
+        raise ValueError("MONTE_CARLO_DRAWS must be at least 1 for uncertainty bands.")
+    model = model or build_flow_model(settings, inputs.route, inputs.production, inputs.trade_by_transition)
+    generator = np.random.default_rng(settings.monte_carlo_seed)
+    factors, stage_totals = _draw_inputs(settings, model, generator)
+    batch = model.evaluate(factors, stage_totals)
+    point = model.evaluate(model.base_factors[None]).links
+    percentiles = settings.uncertainty_percentiles
+    return UncertaintyBands(
+        draws=settings.monte_carlo_draws,
+        percentiles=percentiles,
+        node_keys=model.node_keys,
+        nodes=ElementBands.from_draws(model.node_sizes(point)[0], model.node_sizes(batch.links), percentiles),
+        link_keys=model.link_keys,
+        links=ElementBands.from_draws(point[0], batch.links, percentiles),
+    )
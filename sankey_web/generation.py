@@ -1,25 +1,17 @@
 from __future__ import annotations
 
-import importlib
 import json
 import math
-import sys
 from pathlib import Path
 from types import SimpleNamespace
 from typing import Any
 
 from . import settings
-from .inventory import session_storage_key, source_paths, validate_session_id
+from .inventory import core_module, session_storage_key, source_paths, validate_session_id
 
 
 def _load_core() -> tuple[Any, Any]:
-    core_root = settings.MANUAL_CORE_ROOT.resolve()
-    if not core_root.exists():
-        raise FileNotFoundError(f"Manual Sankey core does not exist: {core_root}")
-    core_text = str(core_root)
-    if core_text not in sys.path:
-        sys.path.insert(0, core_text)
-    return importlib.import_module("pipeline"), importlib.import_module("routes")
+    return core_module("pipeline"), core_module("routes")
 
 
 def active_route(payload: dict[str, Any]) -> dict[str, Any]:
@@ -157,8 +149,10 @@ def _config_module(payload: dict[str, Any], session_id: str, output_root: Path)
         PRODUCTION_SOURCE=first_source,
         PRODUCTION_ROOTS=existing_roots,
         PRODUCTION_ALL_STATUS_SOURCES=set(settings.ALL_STATUS_SOURCE_KEYS),
+        PRODUCTION_UPLOAD_SOURCES=set(settings.UPLOAD_SOURCE_KEYS),
         PRODUCTION_SHEETS=statuses,
         TRADE_ROOT=settings.TRADE_ROOT,
+        TRADE_READ_WORKERS=settings.TRADE_READ_WORKERS,
         REFERENCE_FILE=settings.REFERENCE_FILE,
         OUTPUT_ROOT=output_root,
         REFERENCE_QUANTITY=_number(payload.get("referenceQuantity", 10000), "Reference quantity", minimum=1.0),
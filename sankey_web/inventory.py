@@ -2,11 +2,12 @@ from __future__ import annotations
 
 import re
 import hashlib
+import importlib
+import sys
 from pathlib import Path
+from types import ModuleType
 from typing import Any
 
-import pandas as pd
-
 from . import settings
 
 
@@ -39,49 +40,41 @@ def inspect_workbook(path: Path, source_key: str, label: str) -> dict[str, Any]:
     coverage: dict[str, dict[str, dict[str, Any]]] = {}
     workbook_statuses: set[str] = set()
     workbook_years: set[int] = set()
-    with pd.ExcelFile(path) as excel:
-        for sheet_name in excel.sheet_names:
-            match = SHEET_PATTERN.fullmatch(sheet_name.strip())
-            if match is None:
-                continue
-            frame = pd.read_excel(excel, sheet_name=sheet_name)
-            normalized_columns = {str(column).strip().casefold() for column in frame.columns}
-            stage = match.group(2).casefold()
-            required_columns = set(BASE_REQUIRED_COLUMNS)
-            if stage in PRODUCT_REQUIRED_STAGES:
-                required_columns.add("product")
-            missing = sorted(required_columns - normalized_columns)
-            if missing:
-                raise ValueError(
-                    f"Workbook {path.name}, sheet={sheet_name} is missing columns: {missing}"
-                )
-            metal = METAL_KEYS[match.group(1).casefold()]
-            years = sorted(
-                {
-                    int(column)
-                    for column in frame.columns
-                    if str(column).strip().isdigit() and 1900 <= int(column) <= 2200
-                }
-            )
-            status_column = next(
-                column for column in frame.columns if str(column).strip().casefold() == "status"
-            )
-            statuses = sorted(
-                {
-                    str(value).strip()
-                    for value in frame[status_column].dropna()
-                    if str(value).strip()
-                },
-                key=str.casefold,
+    workbook = core_module("production_cache").load_workbook(
+        path,
+        persist=source_key not in settings.UPLOAD_SOURCE_KEYS,
+    )
+    for sheet_name, sheet in workbook.sheets.items():
+        match = SHEET_PATTERN.fullmatch(sheet_name.strip())
+        if match is None:
+            continue
+        normalized_columns = {str(column).strip().casefold() for column in sheet.columns}
+        stage = match.group(2).casefold()
+        required_columns = set(BASE_REQUIRED_COLUMNS)
+        if stage in PRODUCT_REQUIRED_STAGES:
+            required_columns.add("product")
+        missing = sorted(required_columns - normalized_columns)
+        if missing:
+            raise ValueError(
+                f"Workbook {path.name}, sheet={sheet_name} is missing columns: {missing}"
             )
-            workbook_statuses.update(statuses)
-            workbook_years.update(years)
-            coverage.setdefault(metal, {})[stage] = {
-                "sheet": sheet_name,
-                "years": years,
-                "statuses": statuses,
-                "rows": int(len(frame)),
+        metal = METAL_KEYS[match.group(1).casefold()]
+        years = sorted(
+            {
+                int(column)
+                for column in sheet.columns
+                if str(column).strip().isdigit() and 1900 <= int(column) <= 2200
             }
+        )
+        statuses = list(sheet.statuses)
+        workbook_statuses.update(statuses)
+        workbook_years.update(years)
+        coverage.setdefault(metal, {})[stage] = {
+            "sheet": sheet_name,
+            "years": years,
+            "statuses": statuses,
+            "rows": sheet.row_count,
+        }
     if not coverage:
         raise ValueError(
             "No supported production sheets were found. Expected names such as nickel_mining."
@@ -106,6 +99,12 @@ def upload_path(session_id: str, source_key: str) -> Path:
     return settings.UPLOAD_ROOT / session_key / f"{source_key}.xlsx"
 
 
+def discard_workbook(path: Path) -> None:
+    """Delete an uploaded workbook together with its parsed-workbook cache entries."""
+    core_module("production_cache").forget_workbook(path)
+    Path(path).unlink(missing_ok=True)
+
+
 def source_paths(session_id: str) -> dict[str, Path | None]:
     session_id = validate_session_id(session_id)
     paths: dict[str, Path | None] = {}
@@ -139,34 +138,32 @@ def source_catalog(session_id: str) -> list[dict[str, Any]]:
     return catalog
 
 
+def core_module(name: str) -> ModuleType:
+    """Import a module from the bundled flat-layout ``sankey_core`` folder."""
+    core_root = settings.MANUAL_CORE_ROOT.resolve()
+    if not core_root.exists():
+        raise FileNotFoundError(f"Manual Sankey core does not exist: {core_root}")
+    core_text = str(core_root)
+    if core_text not in sys.path:
+        sys.path.insert(0, core_text)
+    return importlib.import_module(name)
+
+
 def available_trade_years() -> list[int]:
-    years: list[int] = []
-    pattern = re.compile(r"^UNComtrade_(\d{4})_Import_ByPartner$")
-    if not settings.TRADE_ROOT.exists():
-        return years
-    for child in settings.TRADE_ROOT.iterdir():
-        match = pattern.fullmatch(child.name) if child.is_dir() else None
-        if match:
-            years.append(int(match.group(1)))
-    return sorted(set(years))
+    trade_index = core_module("trade_index")
+    return [
+        year
+        for year in trade_index.discover_years(settings.TRADE_ROOT)
+        if trade_index.load_file_index(settings.TRADE_ROOT, year).hs_codes
+    ]
 
 
 def reference_countries() -> list[dict[str, Any]]:
-    if not settings.REFERENCE_FILE.exists():
-        raise FileNotFoundError(f"Reference workbook does not exist: {settings.REFERENCE_FILE}")
-    frame = pd.read_excel(settings.REFERENCE_FILE)
-    if "id" not in frame.columns:
-        raise ValueError("Reference workbook is missing the id column.")
-    name_column = "text" if "text" in frame.columns else "reporterDesc"
-    iso3_column = "reporterCodeIsoAlpha3" if "reporterCodeIsoAlpha3" in frame.columns else None
+    table = core_module("loaders").load_reference_table(settings.REFERENCE_FILE)
     countries: list[dict[str, Any]] = []
-    for _, row in frame.iterrows():
-        try:
-            country_id = int(row["id"])
-        except (TypeError, ValueError):
-            continue
-        name = str(row.get(name_column, "")).strip()
-        iso3 = str(row.get(iso3_column, "")).strip() if iso3_column else ""
+    for country_id, raw_name, raw_iso3 in table.entries:
+        name = str(raw_name if raw_name is not None else "").strip()
+        iso3 = str(raw_iso3 if raw_iso3 is not None else "").strip()
         if not name or name.casefold() == "nan":
             continue
         if iso3.casefold() == "nan":
@@ -57,5 +57,6 @@ RUNTIME_ROOT = PROJECT_ROOT / ".runtime"
 UPLOAD_ROOT = RUNTIME_ROOT / "uploads"
 ARTIFACT_ROOT = RUNTIME_ROOT / "artifacts"
 MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+TRADE_READ_WORKERS = max(1, int(os.environ.get("SANKEY_TRADE_READ_WORKERS", "4")))
 SUPPORTED_METALS = ("Li", "Co", "Ni", "Mn")
 STAGE_ORDER = ("mining", "processing", "refining", "pro_ref", "pcam", "cathode", "battery")
@@ -11,6 +11,8 @@ from . import settings
 from .generation import active_route, generate
 from .inventory import (
     available_trade_years,
+    core_module,
+    discard_workbook,
     inspect_workbook,
     reference_countries,
     session_storage_key,
@@ -87,7 +89,7 @@ def create_app(test_config: dict[str, Any] | None = None) -> Flask:
             temporary = destination.with_name(f".{destination.stem}.uploading.xlsx")
             file.save(temporary)
             if temporary.stat().st_size > settings.MAX_UPLOAD_BYTES:
-                temporary.unlink(missing_ok=True)
+                discard_workbook(temporary)
                 raise ValueError("The uploaded workbook exceeds the 20 MB limit.")
             try:
                 inventory = inspect_workbook(
@@ -96,8 +98,9 @@ def create_app(test_config: dict[str, Any] | None = None) -> Flask:
                     settings.SOURCE_DEFINITIONS[source_key]["label"],
                 )
             except Exception:
-                temporary.unlink(missing_ok=True)
+                discard_workbook(temporary)
                 raise
+            core_module("production_cache").forget_workbook(temporary)
             temporary.replace(destination)
             inventory["path"] = str(destination)
             return jsonify({"ok": True, "source": inventory, "sources": source_catalog(session_id)})
@@ -108,8 +111,7 @@ def create_app(test_config: dict[str, Any] | None = None) -> Flask:
     def remove_upload(source_key: str):
         try:
             session_id = validate_session_id(request.args.get("sessionId", ""))
-            path = upload_path(session_id, source_key)
-            path.unlink(missing_ok=True)
+            discard_workbook(upload_path(session_id, source_key))
             return jsonify({"ok": True, "sources": source_catalog(session_id)})
         except (ValueError, OSError) as exc:
             return _json_error(str(exc))
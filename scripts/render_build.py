@@ -15,6 +15,11 @@ def main() -> None:
         cwd=ROOT,
         check=True,
     )
+    subprocess.run(
+        [sys.executable, str(ROOT / "sankey_core" / "trade_store.py")],
+        cwd=ROOT / "sankey_core",
+        check=True,
+    )
 
     from plotly.io import get_chrome
 
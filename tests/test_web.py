@@ -115,6 +115,7 @@ class WebTests(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         payload = response.get_json()
         self.assertTrue(payload["ok"])
+        self.assertIn(2024, payload["tradeYears"])
         sources = {source["key"]: source for source in payload["sources"]}
         self.assertTrue(sources["usgs"]["available"])
         self.assertTrue(sources["ma_2026"]["available"])
@@ -139,6 +140,12 @@ class WebTests(unittest.TestCase):
         other_source = next(item for item in other_session["sources"] if item["key"] == "scinsight")
         self.assertFalse(other_source["available"])
 
+        uploads = list(settings.UPLOAD_ROOT.rglob("*"))
+        self.assertEqual([path.name for path in uploads if path.is_file()], ["scinsight.xlsx"])
+        response = self.client.delete("/api/uploads/scinsight?sessionId=test_session_123")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([path for path in settings.UPLOAD_ROOT.rglob("*") if path.is_file()])
+
     def test_invalid_upload_returns_a_specific_schema_error(self) -> None:
         response = self.client.post(
             "/api/uploads/benchmark",